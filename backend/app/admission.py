@@ -0,0 +1,226 @@
+"""
+Admission control for the image ingestion path (gallery uploads, resumable
+upload finalize, moodboard uploads).
+
+Decoding a full-resolution original takes width x height x bands bytes, plus
+the full-size copies the resizing makes, so a burst of parallel uploads can
+take more memory than the pod has. Every upload therefore reads the image
+header first (cheap: nothing is decoded) and waits for:
+
+* a slot: at most INGEST_MAX_CONCURRENT images are processed at once,
+* its estimated memory within INGEST_MEMORY_BUDGET_MB (an image larger than
+  the whole budget is admitted once nothing else is running).
+
+Waiting uploads are served in arrival order. When the queue is full or an
+upload waited longer than INGEST_QUEUE_TIMEOUT_SECONDS the request fails with
+503, and one API key can't have more than INGEST_PER_CLIENT_MAX uploads
+admitted or queued (429). Both carry a `Retry-After` estimated from recent
+processing times, so clients back off instead of the server running out of
+memory.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import BinaryIO, Deque, Optional, Tuple, Union
+
+from fastapi import HTTPException, Request
+from PIL import Image
+
+from app.config import (
+    INGEST_MAX_CONCURRENT,
+    INGEST_MAX_QUEUE,
+    INGEST_MEMORY_BUDGET_MB,
+    INGEST_PER_CLIENT_MAX,
+    INGEST_QUEUE_TIMEOUT_SECONDS,
+)
+from app.metrics import (
+    INGEST_IN_FLIGHT,
+    INGEST_QUEUED,
+    INGEST_REJECTIONS,
+    INGEST_RESERVED_BYTES,
+    INGEST_WAIT,
+)
+from app.resize_engine import resize_engine
+
+MAX_RETRY_AFTER_SECONDS = 60
+
+
+def client_key(request: Request) -> str:
+    """Who an upload is accounted to: its API key's name, else the client address."""
+    key_name = getattr(request.state, "api_key_name", None)
+    if key_name:
+        return f"key:{key_name}"
+    return f"addr:{request.client.host if request.client else ''}"
+
+
+def estimate_memory(source: Union[Path, BinaryIO], size: int, copies: int = 2) -> int:
+    """
+    Peak bytes of processing an image: its encoded `size` (held in memory)
+    plus `copies` decoded buffers, full-size ones unless the resize engine
+    shrinks while decoding. Only the header is read; a file
+    object is rewound. Unreadable images cost their size only, they fail
+    right after decoding starts.
+    """
+    try:
+        with Image.open(source) as img:
+            width, height = img.size
+            bands = len(img.getbands())
+    except Exception:
+        return size
+    finally:
+        if not isinstance(source, Path):
+            source.seek(0)
+    return size + resize_engine.memory_estimate(width, height, bands, copies)
+
+
+class IngestLimiter:
+    def __init__(
+        self,
+        max_concurrent: int,
+        memory_budget: int,
+        max_queue: int,
+        per_client: int,
+        queue_timeout: float,
+    ):
+        self.max_concurrent = max_concurrent
+        self.memory_budget = memory_budget
+        self.max_queue = max_queue
+        self.per_client = per_client
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.reserved = 0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self._clients: Counter = Counter()
+        # Moving average of how long an admitted upload is processed
+        self._hold_seconds = 1.0
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog is likely processed."""
+        backlog = len(self._waiters) + 1
+        seconds = self._hold_seconds * backlog / self.max_concurrent
+        return max(1, min(MAX_RETRY_AFTER_SECONDS, math.ceil(seconds)))
+
+    def _reject(self, status_code: int, reason: str, detail: str):
+        INGEST_REJECTIONS.labels(reason).inc()
+        raise HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(self.retry_after())},
+        )
+
+    def _fits(self, cost: int) -> bool:
+        if self.active >= self.max_concurrent:
+            return False
+        return self.active == 0 or self.reserved + cost <= self.memory_budget
+
+    def _grant(self, cost: int):
+        self.active += 1
+        self.reserved += cost
+        INGEST_IN_FLIGHT.set(self.active)
+        INGEST_RESERVED_BYTES.set(self.reserved)
+
+    def _wake(self):
+        # Strictly in order: a large image at the head isn't starved by
+        # small ones overtaking it
+        while self._waiters:
+            cost, future = self._waiters[0]
+            if future.done():  # timed out or cancelled
+                self._waiters.popleft()
+                continue
+            if not self._fits(cost):
+                break
+            self._waiters.popleft()
+            self._grant(cost)
+            future.set_result(None)
+        INGEST_QUEUED.set(len(self._waiters))
+
+    async def acquire(self, client: str, cost: int):
+        if self._clients[client] >= self.per_client:
+            self._reject(
+                429,
+                "client_limit",
+                f"Too many concurrent uploads, at most {self.per_client} per client",
+            )
+        cost = min(cost, self.memory_budget)
+        if not self._waiters and self._fits(cost):
+            self._grant(cost)
+            self._clients[client] += 1
+            INGEST_WAIT.observe(0)
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._reject(503, "queue_full", "Server busy processing uploads, retry later")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((cost, future))
+        INGEST_QUEUED.set(len(self._waiters))
+        self._clients[client] += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._release_client(client)
+            self._wake()
+            self._reject(503, "timeout", "Timed out waiting for upload processing, retry later")
+        except asyncio.CancelledError:
+            # The slot may have been granted just before the cancellation
+            if future.done() and not future.cancelled():
+                self.release(client, cost, 0)
+            else:
+                self._release_client(client)
+                self._wake()
+            raise
+        INGEST_WAIT.observe(time.perf_counter() - start)
+
+    def _release_client(self, client: str):
+        self._clients[client] -= 1
+        if self._clients[client] <= 0:
+            del self._clients[client]
+
+    def release(self, client: str, cost: int, held_seconds: Optional[float]):
+        self.active -= 1
+        self.reserved -= min(cost, self.memory_budget)
+        self._release_client(client)
+        if held_seconds:
+            self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held_seconds
+        INGEST_IN_FLIGHT.set(self.active)
+        INGEST_RESERVED_BYTES.set(self.reserved)
+        self._wake()
+
+    @asynccontextmanager
+    async def admit(self, client: str, cost: int):
+        """Holds a processing slot and `cost` bytes of the budget for the block."""
+        await self.acquire(client, cost)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(client, cost, time.perf_counter() - start)
+
+
+ingest_limiter = IngestLimiter(
+    max_concurrent=INGEST_MAX_CONCURRENT,
+    memory_budget=int(INGEST_MEMORY_BUDGET_MB * 1024 * 1024),
+    max_queue=INGEST_MAX_QUEUE,
+    per_client=INGEST_PER_CLIENT_MAX,
+    queue_timeout=INGEST_QUEUE_TIMEOUT_SECONDS,
+)
+
+
+@asynccontextmanager
+async def admit_upload(request: Request, source: Union[Path, BinaryIO], copies: int = 2):
+    """
+    Admits the processing of an uploaded image (a file object or the path of
+    a staged upload) for the requesting client, for the duration of the block.
+    """
+    if isinstance(source, Path):
+        size = os.path.getsize(source)
+    else:
+        size = source.seek(0, os.SEEK_END)
+        source.seek(0)
+    cost = await asyncio.to_thread(estimate_memory, source, size, copies)
+    async with ingest_limiter.admit(client_key(request), cost):
+        yield
@@ -1,8 +1,141 @@
+"""
+Named API keys.
+
+Keys are kept in API_KEYS_FILE (a PickleDB file) as `name -> {"sha256": ...,
+"created": ...}`: only their hash is stored. The key from the `apikey`
+environment variable is always valid too, under the name "default".
+
+Lookups hash the presented key and look the digest up in a dict, so checking
+a request costs the same whatever (and however many) keys exist and never
+compares secrets byte by byte. The file is watched and reloaded when it
+changes, so keys can be added or revoked without a restart:
+
+    python -m app.apikeys add <name>     # prints the new key once
+    python -m app.apikeys remove <name>
+    python -m app.apikeys list
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import secrets
+from datetime import datetime
+from typing import Dict, Optional
+
 from pickledb import PickleDB
 
+from app.config import API_KEY, API_KEYS_FILE, API_KEYS_RELOAD_SECONDS
+
+DEFAULT_KEY_NAME = "default"
+
+
+def _digest(key: str) -> bytes:
+    return hashlib.sha256(key.encode("utf-8", "surrogateescape")).digest()
+
+
 class KeyManager:
-    def __init__(self, keyfile: str):
-        self.db = PickleDB(keyfile)
-    
-    def verify(self, key: str):
-        return key in self.db
\ No newline at end of file
+    def __init__(self, keyfile: str, default_key: Optional[str] = None):
+        self.keyfile = keyfile
+        self.default_key = default_key
+        self._names: Dict[bytes, str] = {}
+        self._mtime: Optional[float] = None
+        self.reload()
+
+    def _open(self) -> PickleDB:
+        # Called from sync code or worker threads, where PickleDB runs its
+        # methods to completion
+        db = PickleDB(self.keyfile)
+        db.load()
+        return db
+
+    def reload(self):
+        """Rebuilds the lookup cache from the key file."""
+        try:
+            mtime = os.stat(self.keyfile).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        names = {}
+        if self.default_key:
+            names[_digest(self.default_key)] = DEFAULT_KEY_NAME
+        if mtime is not None:
+            for name, entry in self._open().db.items():
+                names[bytes.fromhex(entry["sha256"])] = name
+        # Swapped in one assignment: lookups never see a partial cache
+        self._names = names
+        self._mtime = mtime
+
+    def changed(self) -> bool:
+        try:
+            mtime = os.stat(self.keyfile).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        return mtime != self._mtime
+
+    def identify(self, key: Optional[str]) -> Optional[str]:
+        """The name of a valid key, None for a missing or unknown key."""
+        if not key:
+            return None
+        return self._names.get(_digest(key))
+
+    def verify(self, key: str) -> bool:
+        return self.identify(key) is not None
+
+    def add(self, name: str) -> str:
+        """Creates a key called `name` and returns it (it can't be shown again)."""
+        key = secrets.token_urlsafe(32)
+        db = self._open()
+        if db.db.get(name) is not None or name == DEFAULT_KEY_NAME:
+            raise ValueError(f"A key named {name!r} already exists")
+        db.set(name, {"sha256": _digest(key).hex(), "created": datetime.now().isoformat()})
+        db.save()
+        self.reload()
+        return key
+
+    def remove(self, name: str) -> bool:
+        db = self._open()
+        removed = db.remove(name)
+        if removed:
+            db.save()
+            self.reload()
+        return removed
+
+    def names(self) -> Dict[str, str]:
+        """Key names with their creation time."""
+        return {name: entry.get("created", "") for name, entry in self._open().db.items()}
+
+
+key_manager = KeyManager(API_KEYS_FILE, default_key=API_KEY)
+
+
+async def watch_api_keys():
+    """Background task: reloads the keys when the key file changes."""
+    while True:
+        await asyncio.sleep(API_KEYS_RELOAD_SECONDS)
+        if key_manager.changed():
+            try:
+                await asyncio.to_thread(key_manager.reload)
+                print(f"Reloaded API keys from {API_KEYS_FILE}")
+            except Exception as e:  # keep the previous keys
+                print(f"Could not reload API keys from {API_KEYS_FILE}: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage named API keys")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("add", help="create a key").add_argument("name")
+    commands.add_parser("remove", help="revoke a key").add_argument("name")
+    commands.add_parser("list", help="list key names")
+    args = parser.parse_args()
+
+    if args.command == "add":
+        print(key_manager.add(args.name))
+    elif args.command == "remove":
+        if not key_manager.remove(args.name):
+            raise SystemExit(f"No key named {args.name!r}")
+    else:
+        for name, created in sorted(key_manager.names().items()):
+            print(f"{name}\t{created}")
+
+
+if __name__ == "__main__":
+    main()
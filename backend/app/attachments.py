@@ -0,0 +1,180 @@
+"""
+Reference-counted index of moodboard attachment files.
+
+For every moodboard we keep how many images in its sections point at each
+attachment url. Edits adjust the counts, so files that just became
+unreferenced are known without scanning the board or listing the
+attachment directory. Those files are not deleted right away: they are
+scheduled, and the background sweeper unlinks them once they stayed
+unreferenced for ATTACHMENT_GC_GRACE_SECONDS. Re-adding the url in the
+meantime (e.g. undo in the editor) cancels the deletion.
+"""
+import asyncio
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set
+
+from app.config import ATTACHMENT_GC_GRACE_SECONDS
+from app.metrics import CACHE_ENTRIES
+from app.storage import media_key, media_storage
+
+SWEEP_INTERVAL_SECONDS = 60
+
+# moodboard_id -> attachment url -> number of images referencing it.
+# Urls whose count drops to zero are removed from the Counter.
+attachment_refs: Dict[str, Counter] = {}
+# moodboard_id -> attachment url -> time.monotonic() when it became unreferenced
+pending_deletions: Dict[str, Dict[str, float]] = {}
+# Boards whose attachment directory has been checked for orphans (once per
+# process, the first time the board is indexed).
+_reconciled: Set[str] = set()
+CACHE_ENTRIES.labels("pending_attachment_deletions").set_function(
+    lambda: sum(len(pending) for pending in pending_deletions.values())
+)
+
+
+def attachment_url(moodboard_id: str, filename: str) -> str:
+    return f"/moodboard-media/{moodboard_id}/attached_photos/{filename}"
+
+
+def _section_urls(sections) -> Iterable[str]:
+    for section in sections:
+        if section.type == "images":
+            for img in section.images:
+                yield img.url
+
+
+def _schedule(moodboard_id: str, url: str):
+    pending_deletions.setdefault(moodboard_id, {}).setdefault(url, time.monotonic())
+
+
+def _unschedule(moodboard_id: str, url: str):
+    pending = pending_deletions.get(moodboard_id)
+    if pending and pending.pop(url, None) is not None and not pending:
+        del pending_deletions[moodboard_id]
+
+
+def replace_references(moodboard_id: str, sections):
+    """
+    Recounts a moodboard whose sections were replaced wholesale (loading it,
+    or a full save). Urls that are no longer referenced get scheduled for
+    deletion, urls referenced again are kept.
+    """
+    old = attachment_refs.get(moodboard_id, Counter())
+    new = Counter(_section_urls(sections))
+    attachment_refs[moodboard_id] = new
+    for url in old.keys() - new.keys():
+        _schedule(moodboard_id, url)
+    for url in new.keys() - old.keys():
+        _unschedule(moodboard_id, url)
+
+
+def update_references(moodboard_id: str, added: List[str], removed: List[str]):
+    """Applies the image urls added to and removed from a moodboard by an edit."""
+    refs = attachment_refs.setdefault(moodboard_id, Counter())
+    for url in added:
+        if not refs[url]:
+            _unschedule(moodboard_id, url)
+        refs[url] += 1
+    for url in removed:
+        refs[url] -= 1
+        if refs[url] <= 0:
+            del refs[url]
+            _schedule(moodboard_id, url)
+
+
+def schedule_if_unreferenced(moodboard_id: str, url: str):
+    """
+    Schedules a file that may not be referenced at all, e.g. a fresh upload
+    the editor has not saved into a section yet.
+    """
+    if not attachment_refs.get(moodboard_id, {}).get(url):
+        _schedule(moodboard_id, url)
+
+
+def release_references(moodboard_id: str):
+    """
+    Drops the counts of a moodboard whose sections were unloaded from the
+    cache. They are rebuilt when the sections are loaded again, but kept as
+    long as files of the board are pending deletion, since the sweeper
+    checks those against the counts.
+    """
+    if moodboard_id not in pending_deletions:
+        attachment_refs.pop(moodboard_id, None)
+
+
+def forget_moodboard(moodboard_id: str):
+    attachment_refs.pop(moodboard_id, None)
+    pending_deletions.pop(moodboard_id, None)
+    _reconciled.discard(moodboard_id)
+
+
+def _attachment_key(moodboard_id: str, url: str) -> Optional[str]:
+    """Only files directly inside the moodboard's own attachment dir are ever deleted."""
+    key = media_key(url)
+    directory, _, filename = key.rpartition("/")
+    if directory != f"moodboard-media/{moodboard_id}/attached_photos" or filename in ("", ".", ".."):
+        return None
+    return key
+
+
+def _list_attachments(moodboard_id: str) -> List[str]:
+    prefix = f"moodboard-media/{moodboard_id}/attached_photos"
+    return [key.rsplit("/", 1)[1] for key in media_storage.list(prefix)]
+
+
+async def reconcile_attachments():
+    """
+    Schedules attachment files that no image references, e.g. left behind
+    before the index existed or by an interrupted edit. This is the only
+    place that lists attachment directories: each board is checked once, the
+    first time its sections are loaded.
+    """
+    for moodboard_id in list(attachment_refs):
+        if moodboard_id in _reconciled:
+            continue
+        filenames = await asyncio.to_thread(_list_attachments, moodboard_id)
+        if moodboard_id not in attachment_refs:
+            continue  # unloaded or deleted meanwhile
+        for filename in filenames:
+            schedule_if_unreferenced(moodboard_id, attachment_url(moodboard_id, filename))
+        _reconciled.add(moodboard_id)
+
+
+def sweep_attachments(now: Optional[float] = None) -> int:
+    """
+    Deletes scheduled files whose grace period has passed and that are still
+    unreferenced. Returns the number of deleted files.
+    """
+    now = time.monotonic() if now is None else now
+    deleted = 0
+    for moodboard_id, pending in list(pending_deletions.items()):
+        refs = attachment_refs.get(moodboard_id)
+        if refs is None:
+            continue  # not indexed; checked again once its sections are loaded
+        expired = [
+            url for url, since in pending.items() if now - since >= ATTACHMENT_GC_GRACE_SECONDS
+        ]
+        for url in expired:
+            del pending[url]
+            key = _attachment_key(moodboard_id, url)
+            if refs.get(url) or key is None:
+                continue
+            try:
+                media_storage.delete(key)
+                deleted += 1
+            except Exception as e:  # OSError, S3 errors
+                print(f"Could not delete unreferenced attachment {key}: {e}")
+        if not pending:
+            pending_deletions.pop(moodboard_id, None)
+    return deleted
+
+
+async def sweep_unreferenced_attachments():
+    """Background task: reconciles newly loaded boards and sweeps periodically."""
+    while True:
+        await reconcile_attachments()
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+        deleted = sweep_attachments()
+        if deleted:
+            print(f"Deleted {deleted} unreferenced moodboard attachment(s)")
@@ -0,0 +1,576 @@
+"""
+Export of the library as one tar stream, full or incremental, and restore.
+
+Archive layout (paths are storage keys, so it doesn't depend on the storage
+layout, packs or backend):
+
+    metadata/galleries/<id>/metadata.yaml
+    metadata/moodboards/<id>/moodboard.yaml (+ moodboard.ops.jsonl)
+    galleries/<id>/images_full/<file>             originals
+    galleries/<id>/images_{small,thumb}/<file>    with `derivatives` only
+    moodboard-media/<id>/attached_photos/<file>
+    manifest.json                                 always last
+
+The manifest records, per gallery and moodboard, its lastUpdateDate and the
+stat of its metadata files, and per media file its size, mtime and sha256.
+An incremental export is given the previous manifest: galleries and
+moodboards whose markers are unchanged are skipped without touching their
+files at all (no stat per image, unlike rsync), and of the changed ones only
+files whose checksum differs are written. The new manifest describes the
+whole library again, including what was deleted since, so each incremental
+export only needs the manifest of the one before.
+
+The tar is written as it is read (nothing is staged on disk), optionally
+throttled to a rate in bytes per second. `restore` applies a full export and
+then the incremental ones in order, renders renditions that weren't exported
+from the originals and reloads the caches.
+
+    python -m app.backup export -o full.tar [--derivatives] [--rate-limit-mb 20]
+    python -m app.backup export -o incr.tar --since full.manifest.json
+    python -m app.backup restore full.tar incr.tar
+
+The same runs over HTTP as POST /export and POST /import (app.routers.backup).
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import queue
+import shutil
+import tarfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+import yaml
+
+from app.config import GALLERIES_ROOT_DIR, MOODBOARDS_ROOT_DIR
+from app.database import YAML_LOADER, list_gallery_ids, read_metadata_header
+from app.moodboard_db import JOURNAL_FILENAME, list_moodboard_ids
+from app.storage import is_media_key, media_storage
+from app.thumb_pack import packed_location
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_FORMAT = 1
+CHUNK_SIZE = 1024 * 1024
+GALLERY_METADATA_FILES = ("metadata.yaml",)
+MOODBOARD_METADATA_FILES = ("moodboard.yaml", JOURNAL_FILENAME)
+
+
+class Throttle:
+    """Sleeps so that no more than `rate` bytes per second pass (0: unlimited)."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.sent = 0
+
+    def __call__(self, nbytes: int):
+        if self.rate <= 0:
+            return
+        self.sent += nbytes
+        ahead = self.sent / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class ThrottledWriter(io.RawIOBase):
+    def __init__(self, out: BinaryIO, rate: float):
+        self.out = out
+        self.throttle = Throttle(rate)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.throttle(len(data))
+        self.out.write(data)
+        return len(data)
+
+
+def _stat_marker(path: Path) -> Optional[List[float]]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+def _local_stat(key: str) -> Optional[Tuple[int, float]]:
+    """(size, mtime) of a media file on the local volume, None if it isn't one."""
+    if media_storage.presigns or packed_location(key) is not None:
+        return None
+    try:
+        stat = os.stat(media_storage.path(key))
+    except (FileNotFoundError, ValueError):
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def _checksum(key: str) -> Tuple[int, str]:
+    digest = hashlib.sha256()
+    size = 0
+    with media_storage.open_read(key) as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+def _gallery_media_keys(metadata: dict, derivatives: bool) -> Iterator[str]:
+    fields = ("full", "small", "thumb") if derivatives else ("full",)
+    for image in metadata.get("images") or []:
+        for field in fields:
+            url = (image.get("sizes") or {}).get(field)
+            if url:
+                key = url.lstrip("/")
+                if is_media_key(key):
+                    yield key
+
+
+class Exporter:
+    def __init__(self, tar: tarfile.TarFile, previous: Optional[dict], derivatives: bool):
+        self.tar = tar
+        self.previous = previous or {}
+        self.derivatives = derivatives
+        self.stats = {"files": 0, "bytes": 0, "skipped_files": 0, "unchanged": 0}
+
+    def _add_bytes(self, name: str, data: bytes, mtime: float):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def _add_metadata(self, kind: str, object_id: str, directory: Path, names) -> Dict[str, List[float]]:
+        markers = {}
+        for name in names:
+            path = directory / name
+            try:
+                data = path.read_bytes()
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            self._add_bytes(f"metadata/{kind}/{object_id}/{name}", data, mtime)
+            markers[name] = [len(data), mtime]
+        return markers
+
+    def _add_media(self, keys, previous_files: dict) -> dict:
+        files = {}
+        for key in keys:
+            before = previous_files.get(key)
+            local = _local_stat(key)
+            if before and local and [local[0], local[1]] == before[:2]:
+                files[key] = before  # quick check, like rsync: not read at all
+                self.stats["skipped_files"] += 1
+                continue
+            try:
+                size, checksum = _checksum(key)
+            except (FileNotFoundError, KeyError) as e:
+                print(f"Skipping missing file {key}: {e}")
+                continue
+            mtime = local[1] if local else None
+            files[key] = [size, mtime, checksum]
+            if before and before[2] == checksum:
+                self.stats["skipped_files"] += 1
+                continue
+            info = tarfile.TarInfo(key)
+            info.size = size
+            info.mtime = mtime or time.time()
+            with media_storage.open_read(key) as f:
+                self.tar.addfile(info, f)
+            self.stats["files"] += 1
+            self.stats["bytes"] += size
+        return files
+
+    def export_galleries(self) -> Dict[str, dict]:
+        previous = self.previous.get("galleries", {})
+        entries = {}
+        for gallery_id in sorted(list_gallery_ids()):
+            directory = GALLERIES_ROOT_DIR / gallery_id
+            metadata_path = directory / "metadata.yaml"
+            if not metadata_path.exists():
+                continue  # e.g. the moodboards directory
+            try:
+                header = read_metadata_header(metadata_path, "images")
+            except (OSError, yaml.YAMLError) as e:
+                print(f"Skipping gallery {gallery_id}: {e}")
+                continue
+            marker = {
+                "lastUpdateDate": str(header.get("lastUpdateDate")),
+                "metadata": {"metadata.yaml": _stat_marker(metadata_path)},
+            }
+            before = previous.get(gallery_id)
+            if before and {k: before.get(k) for k in marker} == marker:
+                entries[gallery_id] = before
+                self.stats["unchanged"] += 1
+                continue
+            self._add_metadata("galleries", gallery_id, directory, GALLERY_METADATA_FILES)
+            with open(metadata_path) as f:
+                metadata = yaml.load(f, Loader=YAML_LOADER) or {}
+            files = self._add_media(
+                _gallery_media_keys(metadata, self.derivatives), (before or {}).get("files", {})
+            )
+            entries[gallery_id] = {**marker, "files": files}
+        return entries
+
+    def export_moodboards(self) -> Dict[str, dict]:
+        previous = self.previous.get("moodboards", {})
+        entries = {}
+        for moodboard_id in sorted(list_moodboard_ids()):
+            directory = MOODBOARDS_ROOT_DIR / moodboard_id
+            try:
+                header = read_metadata_header(directory / "moodboard.yaml", "sections")
+            except (OSError, yaml.YAMLError) as e:
+                print(f"Skipping moodboard {moodboard_id}: {e}")
+                continue
+            marker = {
+                "lastUpdateDate": str(header.get("lastUpdateDate")),
+                "metadata": {name: _stat_marker(directory / name) for name in MOODBOARD_METADATA_FILES},
+            }
+            before = previous.get(moodboard_id)
+            if before and {k: before.get(k) for k in marker} == marker:
+                entries[moodboard_id] = before
+                self.stats["unchanged"] += 1
+                continue
+            self._add_metadata("moodboards", moodboard_id, directory, MOODBOARD_METADATA_FILES)
+            # All attachments, referenced or not: the board's journal may
+            # reference any of them
+            keys = sorted(media_storage.list(f"moodboard-media/{moodboard_id}/attached_photos"))
+            files = self._add_media(keys, (before or {}).get("files", {}))
+            entries[moodboard_id] = {**marker, "files": files}
+        return entries
+
+
+def _deleted(previous: dict, galleries: dict, moodboards: dict) -> dict:
+    deleted = {"galleries": [], "moodboards": [], "files": []}
+    for kind, current in (("galleries", galleries), ("moodboards", moodboards)):
+        for object_id, entry in previous.get(kind, {}).items():
+            if object_id not in current:
+                deleted[kind].append(object_id)
+            else:
+                deleted["files"].extend(sorted(entry.get("files", {}).keys() - current[object_id]["files"].keys()))
+    return deleted
+
+
+def export_library(
+    out: BinaryIO, previous: Optional[dict] = None, derivatives: bool = False, rate: float = 0
+) -> dict:
+    """
+    Writes the tar stream to `out` (incremental if the `previous` manifest
+    is given) and returns the new manifest, which is also its last member.
+    """
+    if previous is not None and previous.get("format") != MANIFEST_FORMAT:
+        raise ValueError("Not a manifest of this export format")
+    if previous is not None and previous.get("derivatives") != derivatives:
+        previous = None  # other file selection: export everything again
+    writer = ThrottledWriter(out, rate)
+    with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        exporter = Exporter(tar, previous, derivatives)
+        galleries = exporter.export_galleries()
+        moodboards = exporter.export_moodboards()
+        manifest = {
+            "format": MANIFEST_FORMAT,
+            "created": datetime.now().isoformat(),
+            "base": previous.get("created") if previous else None,
+            "derivatives": derivatives,
+            "stats": exporter.stats,
+            "deleted": _deleted(previous or {}, galleries, moodboards),
+            "galleries": galleries,
+            "moodboards": moodboards,
+        }
+        exporter._add_bytes(MANIFEST_NAME, json.dumps(manifest).encode(), time.time())
+    return manifest
+
+
+def _member_target(name: str) -> Tuple[str, Optional[Path]]:
+    """("metadata", path) / ("media", None) / ("manifest", None) for a member name."""
+    if name == MANIFEST_NAME:
+        return "manifest", None
+    parts = name.split("/")
+    if any(p in ("", ".", "..") for p in parts):
+        raise ValueError(f"Invalid archive member: {name}")
+    if len(parts) == 4 and parts[0] == "metadata" and _valid_id(parts[2]):
+        if parts[1] == "galleries" and parts[3] in GALLERY_METADATA_FILES:
+            return "metadata", GALLERIES_ROOT_DIR / parts[2] / parts[3]
+        if parts[1] == "moodboards" and parts[3] in MOODBOARD_METADATA_FILES:
+            return "metadata", MOODBOARDS_ROOT_DIR / parts[2] / parts[3]
+    if is_media_key(name) and _valid_id(parts[1]):
+        return "media", None
+    raise ValueError(f"Unexpected archive member: {name}")
+
+
+def _valid_id(object_id) -> bool:
+    """Whether a gallery or moodboard id names one directory of its own."""
+    return (
+        isinstance(object_id, str)
+        and object_id not in ("", ".", "..", MOODBOARDS_ROOT_DIR.name)
+        and "/" not in object_id
+        and not object_id.startswith(".")
+    )
+
+
+def _check_deletions(deleted: dict):
+    """Raises ValueError unless every recorded deletion names a single object or media file."""
+    if not isinstance(deleted, dict) or not all(isinstance(v, list) for v in deleted.values()):
+        raise ValueError("Invalid deletions in manifest")
+    for kind in ("galleries", "moodboards"):
+        for object_id in deleted.get(kind, []):
+            if not _valid_id(object_id):
+                raise ValueError(f"Invalid deleted {kind} id in manifest: {object_id!r}")
+    for key in deleted.get("files", []):
+        # <prefix>/<object id>/<size dir>/<file name>
+        if not (isinstance(key, str) and is_media_key(key) and all(map(_valid_id, key.split("/")[1::2]))):
+            raise ValueError(f"Invalid deleted file in manifest: {key!r}")
+
+
+def _apply_deletions(deleted: dict):
+    for gallery_id in deleted.get("galleries", []):
+        media_storage.delete_prefix(f"galleries/{gallery_id}")
+        shutil.rmtree(GALLERIES_ROOT_DIR / gallery_id, ignore_errors=True)
+    for moodboard_id in deleted.get("moodboards", []):
+        media_storage.delete_prefix(f"moodboard-media/{moodboard_id}")
+        shutil.rmtree(MOODBOARDS_ROOT_DIR / moodboard_id, ignore_errors=True)
+    for key in deleted.get("files", []):
+        media_storage.delete(key)
+
+
+def new_touched() -> dict:
+    return {"galleries": set(), "moodboards": set(), "files": 0, "deleted": {}}
+
+
+def restore_archive(source: BinaryIO, touched: Optional[dict] = None) -> dict:
+    """
+    Restores one exported tar stream (read sequentially, never seeked) and
+    returns what it touched. Deletions recorded in its manifest are applied
+    at the end. `touched` (see `new_touched`) is filled in as files are
+    written, so a caller knows what changed even if the restore fails.
+    """
+    if touched is None:
+        touched = new_touched()
+    with tarfile.open(fileobj=source, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            kind, path = _member_target(member.name)
+            data = tar.extractfile(member)
+            if kind == "manifest":
+                manifest = json.load(data)
+                deleted = manifest.get("deleted", {})
+                _check_deletions(deleted)  # before anything is deleted
+                touched["deleted"] = deleted
+                _apply_deletions(deleted)
+            elif kind == "metadata":
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if path.name == "moodboard.yaml":
+                    # A journal in the archive follows; one on disk is stale
+                    (path.parent / JOURNAL_FILENAME).unlink(missing_ok=True)
+                    touched["moodboards"].add(path.parent.name)
+                elif path.name == "metadata.yaml":
+                    touched["galleries"].add(path.parent.name)
+                temp = path.with_name(f".{path.name}.restore")
+                with open(temp, "wb") as f:
+                    shutil.copyfileobj(data, f, CHUNK_SIZE)
+                os.replace(temp, path)
+            else:
+                with media_storage.open_write(member.name) as f:
+                    shutil.copyfileobj(data, f, CHUNK_SIZE)
+                touched["files"] += 1
+    return touched
+
+
+def render_missing_renditions(gallery_ids) -> int:
+    """
+    Renders the small and thumbnail renditions of restored galleries whose
+    files aren't there (exports without derivatives) from the originals.
+    Returns how many were written.
+    """
+    from app.config import SMALL_SIZE, THUMB_SIZE
+    from app.resize_engine import resize_engine
+
+    written = 0
+    for gallery_id in gallery_ids:
+        metadata_path = GALLERIES_ROOT_DIR / gallery_id / "metadata.yaml"
+        if not metadata_path.exists():
+            continue
+        with open(metadata_path) as f:
+            metadata = yaml.load(f, Loader=YAML_LOADER) or {}
+        for image in metadata.get("images") or []:
+            sizes = image.get("sizes") or {}
+            missing = [
+                (sizes[field].lstrip("/"), box, field)
+                for field, box in (("small", SMALL_SIZE), ("thumb", THUMB_SIZE))
+                if sizes.get(field) and not media_storage.exists(sizes[field].lstrip("/"))
+            ]
+            if not missing or not sizes.get("full"):
+                continue
+            try:
+                with media_storage.open_read(sizes["full"].lstrip("/")) as f:
+                    content = f.read()
+                with resize_engine.open(content) as original:
+                    original.load()
+                    for key, box, field in missing:
+                        with media_storage.open_write(key) as out_file:
+                            original.resize(box).save_jpeg(out_file, field)
+                        written += 1
+            except Exception as e:  # missing or undecodable original
+                print(f"Could not render renditions of {sizes['full']}: {e}")
+    return written
+
+
+def reload_caches(touched: dict):
+    """Brings the in-process caches in line with restored files."""
+    from app.changes import record_change
+    from app.contact_sheet import invalidate_contact_sheet
+    from app.database import find_gallery, load_galleries_from_filesystem
+    from app.models import GalleryThumbnail, MoodboardThumbnail
+    from app.moodboard_db import find_moodboard, load_moodboards_from_filesystem
+    from app.moodboard_preview import forget_preview, preview_urls
+    from app.thumb_cache import thumbnail_cache
+    from app.thumb_pack import forget_packs
+
+    for gallery_id in touched["galleries"] | set(touched["deleted"].get("galleries", [])):
+        forget_packs(gallery_id)
+        thumbnail_cache.invalidate_prefix(f"galleries/{gallery_id}/")
+        invalidate_contact_sheet(gallery_id)
+    render_missing_renditions(touched["galleries"])
+    load_galleries_from_filesystem()
+    load_moodboards_from_filesystem()
+    for gallery_id in touched["galleries"]:
+        gallery = find_gallery(gallery_id)
+        if gallery:
+            record_change("gallery", gallery_id, "upsert", GalleryThumbnail.from_gallery(gallery).model_dump())
+    for moodboard_id in touched["moodboards"] | set(touched["deleted"].get("moodboards", [])):
+        forget_preview(moodboard_id)  # not part of exports: re-rendered if missing
+    for moodboard_id in touched["moodboards"]:
+        mb = find_moodboard(moodboard_id)
+        if mb:
+            thumbnail = MoodboardThumbnail.from_moodboard(mb, preview_urls(moodboard_id))
+            record_change("moodboard", moodboard_id, "upsert", thumbnail.model_dump())
+    for kind, name in (("galleries", "gallery"), ("moodboards", "moodboard")):
+        for object_id in touched["deleted"].get(kind, []):
+            record_change(name, object_id, "delete")
+
+
+class ChunkQueue(io.RawIOBase):
+    """
+    Bounded hand-over of bytes between a worker thread and the event loop,
+    usable as a file on the thread's side: `write` for exports, `read` for
+    restores. The bound is what applies back-pressure to the producer.
+    """
+
+    def __init__(self, max_chunks: int = 8):
+        # bytes, None at the end, or the exception that stopped the producer
+        self.chunks: "queue.Queue[Optional[Union[bytes, Exception]]]" = queue.Queue(max_chunks)
+        self.closed_by_peer = threading.Event()
+        self.aborted = threading.Event()
+        self._buffer = bytearray()
+        self._pending = b""
+
+    # --- producer side ---
+    def writable(self) -> bool:
+        return True
+
+    def put(self, chunk: Optional[bytes]):
+        while True:
+            if self.closed_by_peer.is_set():
+                raise BrokenPipeError("Consumer went away")
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= CHUNK_SIZE:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def abort(self):
+        """The producer gives up: reads fail instead of waiting for more."""
+        self.aborted.set()
+
+    def finish(self):
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+        self.put(None)
+
+    # --- consumer side ---
+    def get(self) -> Optional[Union[bytes, Exception]]:
+        """
+        The next chunk as put, None at the end or once either side gave up:
+        a getter waiting in a worker thread never outlives the stream.
+        """
+        while not (self.closed_by_peer.is_set() or self.aborted.is_set()):
+            try:
+                return self.chunks.get(timeout=1)
+            except queue.Empty:
+                continue
+        return None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while not self._pending:
+            try:
+                chunk = self.chunks.get(timeout=1)
+            except queue.Empty:
+                if self.aborted.is_set():
+                    raise EOFError("Stream interrupted")
+                continue
+            if chunk is None:
+                self.chunks.put(None)  # stay at EOF for further reads
+                return 0
+            self._pending = chunk
+        n = min(len(target), len(self._pending))
+        target[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def _load_manifest(path: str) -> dict:
+    with open(path) as f:
+        data = json.load(f)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or restore the library as tar streams")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export")
+    export.add_argument("-o", "--output", required=True, help="tar file to write")
+    export.add_argument("--since", help="manifest of the previous export: incremental export")
+    export.add_argument("--derivatives", action="store_true", help="also small and thumbnail renditions")
+    export.add_argument("--rate-limit-mb", type=float, default=0, help="MB/s, 0 for unlimited")
+    export.add_argument("--manifest", help="where to save the manifest (default: <output>.manifest.json)")
+    restore = commands.add_parser("restore")
+    restore.add_argument("archives", nargs="+", help="full export, then incremental ones in order")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        previous = _load_manifest(args.since) if args.since else None
+        with open(args.output, "wb") as out:
+            manifest = export_library(out, previous, args.derivatives, args.rate_limit_mb * 1024 * 1024)
+        manifest_path = args.manifest or f"{os.path.splitext(args.output)[0]}.manifest.json"
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+        print(f"Exported {manifest['stats']} to {args.output}, manifest {manifest_path}")
+    else:
+        for archive in args.archives:
+            with open(archive, "rb") as f:
+                touched = restore_archive(f)
+            reload_caches(touched)
+            print(
+                f"{archive}: {len(touched['galleries'])} galleries, {len(touched['moodboards'])} moodboards, "
+                f"{touched['files']} files restored"
+            )
+
+
+if __name__ == "__main__":
+    main()
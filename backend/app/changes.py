@@ -0,0 +1,212 @@
+"""
+Change log of galleries and moodboards, so clients (and other replicas) can
+apply deltas instead of refetching lists and documents.
+
+Every save or purge appends an entry with the next version number to
+CHANGE_LOG_PATH, a JSON-lines file on the shared volume:
+
+    {"v": 42, "kind": "gallery", "id": "...", "op": "upsert", "summary": {...}}
+
+`summary` is the list item (GalleryThumbnail / MoodboardThumbnail) of an
+upsert, so list views can be updated without a request; `op` "delete"
+removes the item. Versions are assigned under an exclusive flock, so all
+processes sharing the volume write one sequence. Each process tails the
+file into memory; `/changes?since=N` and the SSE stream read from there.
+
+The file is compacted every COMPACT_EVERY versions: only the latest entry
+per object is kept (a client that missed older ones still ends up with the
+current state), and at most CHANGE_LOG_MAX_ENTRIES of those. The first line
+records the `floor`: clients behind it are told to resync (refetch the
+lists) and continue from the current version.
+"""
+import asyncio
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from app.config import CHANGE_LOG_MAX_ENTRIES, CHANGE_LOG_PATH
+
+COMPACT_EVERY = 1000
+POLL_INTERVAL_SECONDS = 0.5
+# Bytes read from the end of the log to find the last version
+_TAIL_BYTES = 64 * 1024
+
+
+def _last_version(f) -> int:
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - _TAIL_BYTES))
+    lines = f.read().splitlines()
+    for line in reversed(lines):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue  # cut off by a crash (or the start of the tail)
+        return entry.get("v", entry.get("floor", 0))
+    return 0
+
+
+def _open_locked():
+    """The log file opened for appending, exclusively locked."""
+    while True:
+        f = open(CHANGE_LOG_PATH, "a+b")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            current = os.stat(CHANGE_LOG_PATH).st_ino
+        except FileNotFoundError:
+            current = None
+        if current == os.fstat(f.fileno()).st_ino:
+            return f
+        f.close()  # replaced by a compaction meanwhile
+
+
+def _compact(f, last_version: int):
+    f.seek(0)
+    floor = 0
+    latest = {}
+    for line in f.read().splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if "floor" in entry:
+            floor = entry["floor"]
+            continue
+        key = (entry["kind"], entry["id"])
+        latest.pop(key, None)
+        latest[key] = entry  # re-inserted: ordered by last change
+    entries = list(latest.values())
+    if len(entries) > CHANGE_LOG_MAX_ENTRIES:
+        floor = max(floor, entries[-CHANGE_LOG_MAX_ENTRIES - 1]["v"])
+        entries = entries[-CHANGE_LOG_MAX_ENTRIES:]
+    temp = f"{CHANGE_LOG_PATH}.tmp"
+    with open(temp, "w") as out:
+        out.write(json.dumps({"floor": floor, "v": last_version}) + "\n")
+        for entry in entries:
+            out.write(json.dumps(entry) + "\n")
+    os.replace(temp, CHANGE_LOG_PATH)
+
+
+def record_change(kind: str, object_id: str, op: str, summary: Optional[dict] = None):
+    """Appends a change ("upsert" or "delete") of a gallery or moodboard."""
+    entry = {"kind": kind, "id": object_id, "op": op, "t": round(time.time(), 3)}
+    if summary is not None:
+        entry["summary"] = summary
+    try:
+        with _open_locked() as f:
+            version = _last_version(f) + 1
+            if f.tell() == 0:
+                f.write(json.dumps({"floor": 0}).encode() + b"\n")
+            f.write(json.dumps({"v": version, **entry}).encode() + b"\n")
+            f.flush()
+            if version % COMPACT_EVERY == 0:
+                _compact(f, version)
+    except OSError as e:
+        # The change itself was saved; clients only miss the delta
+        print(f"Could not record {op} of {kind} {object_id}: {e}")
+        return
+    change_log.refresh()
+
+
+class ChangeLog:
+    """In-memory tail of the change log file."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inode = None
+        self._offset = 0
+        self.floor = 0
+        self.version = 0
+        self.entries: List[dict] = []
+        self._versions: List[int] = []
+
+    def _reset(self):
+        self._inode = None
+        self._offset = 0
+        self.floor = 0
+        self.entries = []
+        self._versions = []
+
+    def refresh(self) -> bool:
+        """Reads what was appended since the last call. Returns whether anything was."""
+        with self._lock:
+            try:
+                stat = os.stat(CHANGE_LOG_PATH)
+            except FileNotFoundError:
+                return False
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._reset()  # compacted: read it again from the start
+                self._inode = stat.st_ino
+            if stat.st_size == self._offset:
+                return False
+            with open(CHANGE_LOG_PATH, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+            # Only complete lines; a line being written is read next time
+            complete = data.rfind(b"\n") + 1
+            self._offset += complete
+            before = self.version
+            for line in data[:complete].splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if "floor" in entry:
+                    self.floor = max(self.floor, entry["floor"])
+                    self.version = max(self.version, entry.get("v", 0))
+                    continue
+                if self._versions and entry["v"] <= self._versions[-1]:
+                    continue
+                self.entries.append(entry)
+                self._versions.append(entry["v"])
+                self.version = entry["v"]
+            # Bounded like the file; what's dropped here forces a resync
+            excess = len(self.entries) - 2 * CHANGE_LOG_MAX_ENTRIES
+            if excess > 0:
+                self.floor = max(self.floor, self._versions[excess - 1])
+                del self.entries[:excess]
+                del self._versions[:excess]
+            return self.version != before
+
+    def since(self, version: int) -> Tuple[int, List[dict], bool]:
+        """(current version, changes after `version`, whether a resync is needed)."""
+        with self._lock:
+            if version < self.floor or version > self.version:
+                return self.version, [], True
+            start = bisect.bisect_right(self._versions, version)
+            return self.version, self.entries[start:], False
+
+
+change_log = ChangeLog()
+
+# Set (and replaced) whenever new changes were read
+_changed = asyncio.Event()
+
+
+def _notify():
+    global _changed
+    changed, _changed = _changed, asyncio.Event()
+    changed.set()
+
+
+async def wait_for_change(timeout: float):
+    """Waits until new changes were read, at most `timeout` seconds."""
+    try:
+        await asyncio.wait_for(_changed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def watch_changes():
+    """Background task: tails the log (also written by other replicas)."""
+    notified = None
+    while True:
+        await asyncio.to_thread(change_log.refresh)
+        if change_log.version != notified:
+            notified = change_log.version
+            _notify()
+        await asyncio.sleep(POLL_INTERVAL_SECONDS)
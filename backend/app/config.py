@@ -25,7 +25,161 @@ print(f"GALLERIES_ROOT_DIR is {GALLERIES_ROOT_DIR}")
 print(f"MOODBOARDS_ROOT_DIR is {MOODBOARDS_ROOT_DIR}")
 print(f"API key is {API_KEY}")
 
+# Named API keys (see app/apikeys.py), in addition to the `apikey` above.
+# The file is checked for changes every API_KEYS_RELOAD_SECONDS.
+API_KEYS_FILE = os.getenv("API_KEYS_FILE", str(GALLERIES_ROOT_DIR / ".apikeys.json"))
+API_KEYS_RELOAD_SECONDS = float(os.getenv("API_KEYS_RELOAD_SECONDS", "5"))
+
 # Define the image sizes for automatic resizing (width, height)
 # These remain as hardcoded constants as they are application-specific logic.
 THUMB_SIZE = (400, 400)
 SMALL_SIZE = (1920, 1080)
+# JPEG encoding of those sizes (see app/jpeg_encoder.py): "adaptive" picks
+# the lowest quality in [JPEG_MIN_QUALITY, JPEG_MAX_QUALITY] whose SSIM to
+# the rendition reaches JPEG_TARGET_SSIM; "fixed" always uses JPEG_QUALITY
+JPEG_ENCODING = os.getenv("JPEG_ENCODING", "adaptive").lower()
+if JPEG_ENCODING not in ("adaptive", "fixed"):
+    raise ValueError(f"JPEG_ENCODING must be 'adaptive' or 'fixed', not {JPEG_ENCODING!r}")
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "85"))
+JPEG_MIN_QUALITY = int(os.getenv("JPEG_MIN_QUALITY", "60"))
+JPEG_MAX_QUALITY = int(os.getenv("JPEG_MAX_QUALITY", "90"))
+JPEG_TARGET_SSIM = float(os.getenv("JPEG_TARGET_SSIM", "0.97"))
+if not 1 <= JPEG_MIN_QUALITY <= JPEG_QUALITY <= JPEG_MAX_QUALITY <= 100:
+    raise ValueError("JPEG qualities must satisfy 1 <= JPEG_MIN_QUALITY <= JPEG_QUALITY <= JPEG_MAX_QUALITY <= 100")
+# Library producing those sizes from uploads: "pillow" (default) or "vips"
+# (needs pyvips and libvips; shrinks while decoding, see app/resize_engine.py)
+RESIZE_ENGINE = os.getenv("RESIZE_ENGINE", "pillow").lower()
+if RESIZE_ENGINE not in ("pillow", "vips"):
+    raise ValueError(f"RESIZE_ENGINE must be 'pillow' or 'vips', not {RESIZE_ENGINE!r}")
+
+# --- Profiling (opt-in) ---
+# When disabled the profiling middleware is not installed at all.
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+# "cprofile" (stdlib) or "pyinstrument" (async-aware, must be installed)
+PROFILER = os.getenv("PROFILER", "cprofile")
+# Fraction of requests profiled at random, in addition to requests carrying
+# the X-Profile header together with a valid API key.
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+# Profiles and the slow-request log are written here (kept outside the
+# statically served galleries directory).
+PROFILING_DIR = Path(os.getenv("PROFILING_DIR", "profiles"))
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "1000"))
+
+# --- Moodboard attachment cleanup ---
+# Attachment files that no image references anymore are deleted by a
+# background sweeper only after this long, so undoing a removal in the
+# editor (or saving an upload late) doesn't lose the file.
+ATTACHMENT_GC_GRACE_SECONDS = float(os.getenv("ATTACHMENT_GC_GRACE_SECONDS", "86400"))
+
+# --- Metadata caches ---
+# Only gallery/moodboard headers are loaded at startup. Image lists and
+# moodboard sections are loaded on first access and the least recently used
+# ones are dropped again above these (approximate) budgets.
+GALLERY_IMAGES_CACHE_MB = float(os.getenv("GALLERY_IMAGES_CACHE_MB", "256"))
+MOODBOARD_SECTIONS_CACHE_MB = float(os.getenv("MOODBOARD_SECTIONS_CACHE_MB", "64"))
+# Bytes of recently served thumbnails kept in memory per worker (0 disables);
+# larger files are never cached
+THUMB_CACHE_MB = float(os.getenv("THUMB_CACHE_MB", "64"))
+THUMB_CACHE_MAX_FILE_KB = float(os.getenv("THUMB_CACHE_MAX_FILE_KB", "512"))
+
+# --- Image file layout ---
+# "flat": images_full/<file> (the original layout). "sharded": two levels of
+# hash-prefix directories, images_full/ab/cd/<file>, for libraries whose
+# directories would otherwise hold tens of thousands of files. Urls are the
+# same in both; convert an existing library with `python -m app.migrate_layout`.
+STORAGE_LAYOUT = os.getenv("STORAGE_LAYOUT", "flat").lower()
+if STORAGE_LAYOUT not in ("flat", "sharded"):
+    raise ValueError(f"STORAGE_LAYOUT must be 'flat' or 'sharded', not {STORAGE_LAYOUT!r}")
+
+# --- File delivery ---
+# "" (default): the app sends image files itself. "x-accel" (nginx) or
+# "x-sendfile": the app answers /galleries and /moodboard-media requests with
+# a header naming the file and the reverse proxy streams it.
+FILE_OFFLOAD = os.getenv("FILE_OFFLOAD", "").lower()
+if FILE_OFFLOAD not in ("", "x-accel", "x-sendfile"):
+    raise ValueError(f"FILE_OFFLOAD must be 'x-accel' or 'x-sendfile', not {FILE_OFFLOAD!r}")
+# nginx internal location prefixing the mount path in X-Accel-Redirect
+FILE_OFFLOAD_PREFIX = os.getenv("FILE_OFFLOAD_PREFIX", "/_protected").rstrip("/")
+
+# --- Media storage ---
+# "local" (default): image files on the volume below the roots above.
+# "s3": image files in an S3-compatible bucket (needs boto3); metadata stays
+# on the volume. Credentials come from the usual AWS_* variables.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+if STORAGE_BACKEND not in ("local", "s3"):
+    raise ValueError(f"STORAGE_BACKEND must be 'local' or 's3', not {STORAGE_BACKEND!r}")
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+# e.g. http://minio:9000 for MinIO; empty for AWS
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "")
+S3_REGION = os.getenv("S3_REGION", "")
+# Prepended to every object key, to share a bucket
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+# "path" is what MinIO and most S3-compatible servers expect
+S3_ADDRESSING_STYLE = os.getenv("S3_ADDRESSING_STYLE", "auto")
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+# Part size of multipart uploads (S3 requires at least 5 MB)
+S3_MULTIPART_CHUNK_MB = max(5.0, float(os.getenv("S3_MULTIPART_CHUNK_MB", "8")))
+S3_PRESIGN_EXPIRES_SECONDS = int(os.getenv("S3_PRESIGN_EXPIRES_SECONDS", "3600"))
+
+# --- Resumable uploads ---
+# Partial uploads are kept here; on the same volume as the galleries so that
+# finished files are moved into place instead of copied (hidden directories
+# are never served or listed as galleries).
+UPLOAD_STAGING_DIR = Path(os.getenv("UPLOAD_STAGING_DIR", str(GALLERIES_ROOT_DIR / ".uploads")))
+# Uploads without any progress for this long are deleted
+UPLOAD_EXPIRY_SECONDS = float(os.getenv("UPLOAD_EXPIRY_SECONDS", "86400"))
+UPLOAD_MAX_SIZE_MB = float(os.getenv("UPLOAD_MAX_SIZE_MB", "2048"))
+
+# --- Upload admission control ---
+# Images decoded at once by the upload endpoints; further uploads queue
+INGEST_MAX_CONCURRENT = max(1, int(os.getenv("INGEST_MAX_CONCURRENT", "4")))
+# Memory the images being processed may take together, estimated from their
+# dimensions before decoding. Keep it well below the pod's memory limit.
+INGEST_MEMORY_BUDGET_MB = float(os.getenv("INGEST_MEMORY_BUDGET_MB", "1024"))
+# Queued uploads beyond this, or waiting longer than the timeout, get a 503
+INGEST_MAX_QUEUE = int(os.getenv("INGEST_MAX_QUEUE", "64"))
+INGEST_QUEUE_TIMEOUT_SECONDS = float(os.getenv("INGEST_QUEUE_TIMEOUT_SECONDS", "30"))
+# Uploads one API key may have processing or queued; more get a 429
+INGEST_PER_CLIENT_MAX = max(1, int(os.getenv("INGEST_PER_CLIENT_MAX", "8")))
+
+# --- Packed renditions ---
+# Sizes ("thumb", "small") whose files are appended to one pack file per
+# gallery instead of one file per image (STORAGE_BACKEND=local only). Move
+# existing files with `python -m app.thumb_pack pack`.
+PACKED_SIZES = frozenset(
+    f"images_{size.strip()}" for size in os.getenv("PACKED_SIZES", "").lower().split(",") if size.strip()
+)
+if not PACKED_SIZES <= {"images_thumb", "images_small"}:
+    raise ValueError(f"PACKED_SIZES may only contain 'thumb' and 'small', not {os.getenv('PACKED_SIZES')!r}")
+if PACKED_SIZES and STORAGE_BACKEND != "local":
+    raise ValueError("PACKED_SIZES needs STORAGE_BACKEND=local")
+# A pack is rewritten once this fraction of it is deleted records
+PACK_COMPACT_RATIO = float(os.getenv("PACK_COMPACT_RATIO", "0.3"))
+
+# --- Change feed ---
+# Log of gallery/moodboard changes served by /changes; on the shared volume
+# so all replicas write (and stream) the same sequence.
+CHANGE_LOG_PATH = os.getenv("CHANGE_LOG_PATH", str(GALLERIES_ROOT_DIR / ".changes.log"))
+# Objects whose latest change is kept; clients further behind resync
+CHANGE_LOG_MAX_ENTRIES = int(os.getenv("CHANGE_LOG_MAX_ENTRIES", "10000"))
+
+# --- Backups ---
+# Default throughput of /export in MB/s so a backup doesn't starve image
+# serving on the same disk and link; 0 for unlimited
+BACKUP_RATE_LIMIT_MB = float(os.getenv("BACKUP_RATE_LIMIT_MB", "0"))
+
+# --- Storage usage and quotas ---
+# Owner (API key name) of every gallery and moodboard created through the API
+USAGE_OWNERS_FILE = os.getenv("USAGE_OWNERS_FILE", str(GALLERIES_ROOT_DIR / ".owners.json"))
+# The usage counters are recounted from storage this often (and at startup)
+USAGE_SCAN_SECONDS = float(os.getenv("USAGE_SCAN_SECONDS", "3600"))
+# Media bytes allowed per API key (its galleries and moodboards together), per
+# gallery and per moodboard; 0 disables a quota. Uploads beyond get a 507.
+QUOTA_KEY_MB = float(os.getenv("QUOTA_KEY_MB", "0"))
+QUOTA_GALLERY_MB = float(os.getenv("QUOTA_GALLERY_MB", "0"))
+QUOTA_MOODBOARD_MB = float(os.getenv("QUOTA_MOODBOARD_MB", "0"))
+
+# --- Moodboard previews ---
+# Collage previews are re-rendered this long after the last save of a
+# moodboard (a burst of edits renders once)
+PREVIEW_DEBOUNCE_SECONDS = float(os.getenv("PREVIEW_DEBOUNCE_SECONDS", "5"))
@@ -0,0 +1,210 @@
+import json
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from PIL import Image
+
+from app.image_table import GalleryRecord
+from app.config import GALLERIES_ROOT_DIR
+from app.storage import media_key, media_storage
+
+# Each mini-thumb is fitted into a TILE_SIZE x TILE_SIZE cell. A sheet holds
+# COLUMNS x ROWS_PER_SHEET cells; bigger galleries spill over into more sheets
+# so that adding or removing an image only re-encodes the sheet it lives on.
+TILE_SIZE = 96
+COLUMNS = 16
+ROWS_PER_SHEET = 64
+CELLS_PER_SHEET = COLUMNS * ROWS_PER_SHEET
+SHEET_QUALITY = 80
+BACKGROUND = (0, 0, 0)
+
+# Re-pack from scratch when more than this fraction of cells is empty.
+MAX_FREE_RATIO = 0.5
+
+CONTACT_SHEET_DIR = "contact_sheet"
+MAP_FILENAME = "map.json"
+
+# Cache: gallery_id -> offset map. Dropped by `invalidate_contact_sheet`.
+contact_sheets: Dict[str, dict] = {}
+# Bumped on every invalidation so a rebuild racing with a save isn't cached.
+_generations: Dict[str, int] = {}
+_locks: Dict[str, threading.Lock] = {}
+
+
+def invalidate_contact_sheet(gallery_id: str):
+    """
+    Marks the cached contact sheet of a gallery as stale. The next call to
+    `get_contact_sheet` diffs the gallery against the stored map and only
+    repaints the cells that changed.
+    """
+    _generations[gallery_id] = _generations.get(gallery_id, 0) + 1
+    contact_sheets.pop(gallery_id, None)
+
+
+def _sheet_dir(gallery_id: str) -> Path:
+    return GALLERIES_ROOT_DIR / gallery_id / CONTACT_SHEET_DIR
+
+
+def _cell_origin(cell: int):
+    """Returns (sheet, x, y) of the top-left corner of a cell."""
+    local = cell % CELLS_PER_SHEET
+    return (
+        cell // CELLS_PER_SHEET,
+        (local % COLUMNS) * TILE_SIZE,
+        (local // COLUMNS) * TILE_SIZE,
+    )
+
+
+def _empty_map(gallery_id: str, version: int = 0) -> dict:
+    return {
+        "galleryId": gallery_id,
+        "version": version,
+        "tileSize": TILE_SIZE,
+        "columns": COLUMNS,
+        "sheets": [],  # sheet urls, indexed by the first element of a tile
+        "cells": {},  # image_id -> cell index
+        "tiles": {},  # image_id -> [sheet, x, y, width, height]
+    }
+
+
+def _load_map(gallery_id: str) -> Optional[dict]:
+    map_path = _sheet_dir(gallery_id) / MAP_FILENAME
+    if not map_path.exists():
+        return None
+    try:
+        with open(map_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error loading contact sheet map from {map_path}: {e}")
+        return None
+
+
+def _render_tile(gallery: GalleryRecord, image) -> Optional[Image.Image]:
+    thumb_key = media_key(image.sizes.thumb)
+    try:
+        with media_storage.open_read(thumb_key) as f, Image.open(f) as img:
+            tile = img.convert("RGB")
+            tile.thumbnail((TILE_SIZE, TILE_SIZE))
+            return tile
+    except Exception as e:  # unreadable file, missing object, ...
+        print(f"Contact sheet: skipping {thumb_key}: {e}")
+        return None
+
+
+def _update_sheets(gallery: GalleryRecord, sheet_map: dict) -> dict:
+    """
+    Brings `sheet_map` in line with `gallery.images`, repainting only the
+    sheets whose cells changed. Returns the (possibly new) map.
+    """
+    images = list(gallery.images)
+    cells: Dict[str, int] = sheet_map["cells"]
+    wanted = {img.id for img in images}
+
+    removed = [image_id for image_id in cells if image_id not in wanted]
+    added = [img for img in images if img.id not in cells]
+    if not removed and not added and sheet_map["sheets"]:
+        return sheet_map
+
+    used_cells = max(cells.values(), default=-1) + 1
+    free_cells = used_cells - len(cells) + len(removed)
+    if used_cells and free_cells / used_cells > MAX_FREE_RATIO:
+        # Too fragmented: lay everything out densely again.
+        sheet_map = _empty_map(gallery.id, sheet_map["version"])
+        cells = sheet_map["cells"]
+        removed, added = [], images
+
+    # Cells (by sheet) that need to be blanked or painted.
+    blank: Dict[int, list] = {}
+    paint: Dict[int, list] = {}
+
+    for image_id in removed:
+        cell = cells.pop(image_id)
+        sheet_map["tiles"].pop(image_id, None)
+        blank.setdefault(cell // CELLS_PER_SHEET, []).append(cell)
+
+    # Refill holes (from these and earlier removals) before growing the sheet.
+    taken = set(cells.values())
+    next_cell = max(taken, default=-1) + 1
+    holes = [c for c in range(next_cell - 1, -1, -1) if c not in taken]
+    for img in added:
+        if holes:
+            cell = holes.pop()
+        else:
+            cell = next_cell
+            next_cell += 1
+        cells[img.id] = cell
+        paint.setdefault(cell // CELLS_PER_SHEET, []).append((img, cell))
+
+    sheet_dir = _sheet_dir(gallery.id)
+    sheet_dir.mkdir(parents=True, exist_ok=True)
+    sheet_count = max(cells.values(), default=-1) // CELLS_PER_SHEET + 1
+
+    for sheet in sorted(set(blank) | set(paint)):
+        sheet_path = sheet_dir / f"sheet_{sheet}.jpg"
+        sheet_cells = [c for c in cells.values() if c // CELLS_PER_SHEET == sheet]
+        if not sheet_cells:
+            if sheet_path.exists():
+                sheet_path.unlink()
+            continue
+        rows = max(c % CELLS_PER_SHEET for c in sheet_cells) // COLUMNS + 1
+        canvas = Image.new("RGB", (COLUMNS * TILE_SIZE, rows * TILE_SIZE), BACKGROUND)
+        if sheet_path.exists() and sheet_map["sheets"]:
+            with Image.open(sheet_path) as previous:
+                keep = min(canvas.height, previous.height)
+                canvas.paste(previous.crop((0, 0, canvas.width, keep)), (0, 0))
+        for cell in blank.get(sheet, []):
+            _, x, y = _cell_origin(cell)
+            canvas.paste(BACKGROUND, (x, y, x + TILE_SIZE, y + TILE_SIZE))
+        for img, cell in paint.get(sheet, []):
+            _, x, y = _cell_origin(cell)
+            canvas.paste(BACKGROUND, (x, y, x + TILE_SIZE, y + TILE_SIZE))
+            tile = _render_tile(gallery, img)
+            if tile is None:
+                continue
+            ox = x + (TILE_SIZE - tile.width) // 2
+            oy = y + (TILE_SIZE - tile.height) // 2
+            canvas.paste(tile, (ox, oy))
+            sheet_map["tiles"][img.id] = [sheet, ox, oy, tile.width, tile.height]
+        canvas.save(sheet_path, "JPEG", quality=SHEET_QUALITY)
+
+    # Drop sheets that fell off the end after removals.
+    for stale in sheet_dir.glob("sheet_*.jpg"):
+        index = stale.stem.split("_", 1)[1]
+        if index.isdigit() and int(index) >= sheet_count:
+            stale.unlink()
+
+    version = sheet_map["version"] + 1
+    sheet_map["version"] = version
+    sheet_map["sheets"] = [
+        f"/galleries/{gallery.id}/{CONTACT_SHEET_DIR}/sheet_{i}.jpg?v={version}"
+        for i in range(sheet_count)
+    ]
+
+    with open(sheet_dir / MAP_FILENAME, "w") as f:
+        json.dump(sheet_map, f)
+
+    return sheet_map
+
+
+def get_contact_sheet(gallery: GalleryRecord) -> dict:
+    """
+    Returns the contact sheet offset map of a gallery, incrementally
+    rebuilding the atlas images first if the gallery changed since the last
+    call. Blocking; call it from a worker thread.
+    """
+    cached = contact_sheets.get(gallery.id)
+    if cached is not None:
+        return cached
+
+    lock = _locks.setdefault(gallery.id, threading.Lock())
+    with lock:
+        cached = contact_sheets.get(gallery.id)
+        if cached is not None:
+            return cached
+        generation = _generations.get(gallery.id, 0)
+        sheet_map = _load_map(gallery.id) or _empty_map(gallery.id)
+        sheet_map = _update_sheets(gallery, sheet_map)
+        if _generations.get(gallery.id, 0) == generation:
+            contact_sheets[gallery.id] = sheet_map
+        return sheet_map
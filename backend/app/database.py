@@ -1,15 +1,162 @@
 import os
 import shutil
+import threading
 import yaml
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional
 import copy
-from app.models import Gallery
-from app.config import GALLERIES_ROOT_DIR
+from app.image_table import GalleryRecord, ImageTable
+from app.config import GALLERIES_ROOT_DIR, GALLERY_IMAGES_CACHE_MB
+from app.metrics import CACHE_ENTRIES, observe_yaml_size, yaml_timer
+from app.contact_sheet import invalidate_contact_sheet
+from app.storage import media_key, media_storage
+from app.thumb_cache import thumbnail_cache
+from app.changes import record_change
+from app.models import GalleryThumbnail
 
-# Cache: gallery_id -> (Gallery, last_mtime)
-galleries_db: Dict[str, Gallery] = {}
+# libyaml is several times faster than the pure-Python parser when available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Cache: gallery_id -> (GalleryRecord, last_mtime). Records keep their images
+# in a compact ImageTable; `to_json()` gives the API's Gallery.
+galleries_db: Dict[str, GalleryRecord] = {}
 galleries_mtime: Dict[str, float] = {}
+CACHE_ENTRIES.labels("galleries_db").set_function(lambda: len(galleries_db))
+# Set once every gallery header has been read (see app.warmup); until then
+# `find_gallery` loads missing galleries on demand.
+galleries_warm = False
+
+# Startup only reads the metadata header of each gallery. Image tables are
+# loaded on first access and kept in LRU order (gallery_id -> approximate
+# bytes); the least recently used ones are dropped once their total exceeds
+# GALLERY_IMAGES_CACHE_MB.
+gallery_images_lru: "OrderedDict[str, int]" = OrderedDict()
+_images_lock = threading.RLock()  # the contact sheet endpoint runs in threads
+CACHE_ENTRIES.labels("gallery_images").set_function(lambda: len(gallery_images_lru))
+
+
+def read_metadata_header(path: Path, list_key: str) -> dict:
+    """
+    Parses only the fields of a metadata file that come before its top-level
+    `list_key:` line (`images` / `sections`). Our writers dump that list
+    last, so this costs the same whatever the number of images.
+    """
+    marker = f"{list_key}:"
+    lines = []
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith(marker):
+                break
+            lines.append(line)
+    return yaml.load("".join(lines), Loader=YAML_LOADER) or {}
+
+
+def _track_images(gallery_id: str, table: ImageTable):
+    """Marks a table as most recently used and enforces the memory budget."""
+    gallery_images_lru[gallery_id] = table.nbytes()
+    gallery_images_lru.move_to_end(gallery_id)
+    budget = GALLERY_IMAGES_CACHE_MB * 1024 * 1024
+    total = sum(gallery_images_lru.values())
+    for gid in list(gallery_images_lru):
+        if total <= budget:
+            break
+        gallery = galleries_db.get(gid)
+        loaded = gallery.loaded_images if gallery else None
+        if gid == gallery_id or (loaded is not None and loaded.modified):
+            continue
+        total -= gallery_images_lru.pop(gid)
+        if gallery:
+            gallery.attach_images(None)
+
+
+def _gallery_images(gallery: GalleryRecord) -> ImageTable:
+    """`GalleryRecord.images`: loads the image table on first access."""
+    with _images_lock:
+        table = gallery.loaded_images
+        if table is not None:
+            if gallery.id in gallery_images_lru:
+                gallery_images_lru.move_to_end(gallery.id)
+            return table
+
+        metadata_path = GALLERIES_ROOT_DIR / gallery.id / "metadata.yaml"
+        try:
+            with yaml_timer("gallery", "load_images"), open(metadata_path, "r") as f:
+                data = yaml.load(f, Loader=YAML_LOADER)
+                table = ImageTable.from_dicts(gallery.id, data.get("images") or [])
+        except (OSError, yaml.YAMLError, KeyError, TypeError, ValueError) as e:
+            # Never hand out an empty table here: saving it would wipe the gallery.
+            print(f"Error loading images of gallery {gallery.id}: {e}")
+            raise
+        observe_yaml_size("gallery", "load_images", metadata_path.stat().st_size)
+        gallery.attach_images(table)
+        _track_images(gallery.id, table)
+        return table
+
+
+GalleryRecord.images_loader = _gallery_images
+
+
+def _gallery_dir(gallery_id: str) -> Optional[Path]:
+    """The directory of a gallery id, or None for ids that aren't a plain name."""
+    gallery_dir = GALLERIES_ROOT_DIR / gallery_id
+    if (
+        not gallery_id
+        or gallery_dir.parent != GALLERIES_ROOT_DIR
+        or gallery_dir.name != gallery_id
+    ):
+        return None
+    return gallery_dir
+
+
+def list_gallery_ids() -> List[str]:
+    # Hidden directories (e.g. the upload staging dir) are not galleries
+    return [d.name for d in GALLERIES_ROOT_DIR.iterdir() if d.is_dir() and not d.name.startswith(".")]
+
+
+def load_gallery(gallery_id: str) -> Optional[GalleryRecord]:
+    """
+    Loads (or refreshes, if its metadata.yaml changed) the header of one
+    gallery into the cache. Returns the cached record, or None if the
+    gallery doesn't exist or can't be read.
+    """
+    gallery_dir = _gallery_dir(gallery_id)
+    if gallery_dir is None:
+        return None
+    metadata_path = gallery_dir / "metadata.yaml"
+    if not metadata_path.exists():
+        return None
+    stat = metadata_path.stat()
+    mtime = stat.st_mtime
+    try:
+        # If not in cache or updated
+        if gallery_id not in galleries_mtime or galleries_mtime[gallery_id] < mtime:
+            # Header only; the image list is loaded on first access
+            with yaml_timer("gallery", "load"):
+                data = read_metadata_header(metadata_path, "images")
+                gallery = GalleryRecord.from_dict(data)
+            with _images_lock:
+                # The warm-up loads in a thread: don't replace what a save
+                # cached meanwhile
+                if galleries_mtime.get(gallery.id, mtime) <= mtime:
+                    galleries_db[gallery.id] = gallery
+                    galleries_mtime[gallery.id] = mtime
+                    gallery_images_lru.pop(gallery.id, None)
+    except (yaml.YAMLError, ValueError, KeyError, TypeError) as e:
+        print(f"Error loading gallery from {metadata_path}: {e}")
+        return None
+    return galleries_db.get(gallery_id)
+
+
+def find_gallery(gallery_id: str) -> Optional[GalleryRecord]:
+    """
+    Returns a cached gallery. While the startup warm-up hasn't reached it
+    yet, the gallery is loaded on demand instead of reported missing.
+    """
+    gallery = galleries_db.get(gallery_id)
+    if gallery is None and not galleries_warm:
+        gallery = load_gallery(gallery_id)
+    return gallery
 
 
 def load_galleries_from_filesystem():
@@ -17,33 +164,21 @@ def load_galleries_from_filesystem():
     Loads or refreshes gallery metadata from metadata.yaml files in each gallery directory,
     using a cache to avoid re-parsing unchanged files.
     """
+    global galleries_warm
     seen_ids = set()
 
-    for gallery_dir in GALLERIES_ROOT_DIR.iterdir():
-        if gallery_dir.is_dir():
-            metadata_path = gallery_dir / "metadata.yaml"
-            if metadata_path.exists():
-                mtime = metadata_path.stat().st_mtime
-                try:
-                    # If not in cache or updated
-                    if (
-                        gallery_dir.name not in galleries_mtime
-                        or galleries_mtime[gallery_dir.name] < mtime
-                    ):
-                        with open(metadata_path, "r") as f:
-                            data = yaml.safe_load(f)
-                            gallery = Gallery(**data)
-                            galleries_db[gallery.id] = gallery
-                            galleries_mtime[gallery.id] = mtime
-                    seen_ids.add(gallery_dir.name)
-                except (yaml.YAMLError, ValueError) as e:
-                    print(f"Error loading gallery from {metadata_path}: {e}")
+    for gallery_id in list_gallery_ids():
+        if load_gallery(gallery_id):
+            seen_ids.add(gallery_id)
 
     # Remove galleries that no longer exist on disk
     removed = set(galleries_db.keys()) - seen_ids
     for gid in removed:
         galleries_db.pop(gid, None)
         galleries_mtime.pop(gid, None)
+        gallery_images_lru.pop(gid, None)
+    galleries_warm = True
+
 
 def remove_leading_slash(input_string):
     if input_string.startswith('/'):
@@ -67,7 +202,7 @@ def remove_leading_parts(input_path):
     
     return new_path
 
-def save_gallery_metadata(gallery: Gallery):
+def save_gallery_metadata(gallery: GalleryRecord):
     """
     Saves a gallery object to its metadata.yaml file and updates cache.
     """
@@ -75,46 +210,65 @@ def save_gallery_metadata(gallery: Gallery):
     gallery_dir.mkdir(parents=True, exist_ok=True)
 
     metadata_path = gallery_dir / "metadata.yaml"
-    yaml_data = gallery.model_dump(by_alias=False, exclude_none=True)
-    # Convert datetime objects to string for YAML serialization
-    if "lastUpdateDate" in yaml_data and hasattr(
-        yaml_data["lastUpdateDate"], "isoformat"
-    ):
-        yaml_data["lastUpdateDate"] = yaml_data["lastUpdateDate"].isoformat()
+    yaml_data = gallery.to_dict()
 
-    with open(metadata_path, "w") as f:
+    with yaml_timer("gallery", "save"), open(metadata_path, "w") as f:
         yaml.dump(yaml_data, f, sort_keys=False)
 
     # Update cache + mtime
-    galleries_db[gallery.id] = gallery
-    galleries_mtime[gallery.id] = metadata_path.stat().st_mtime
+    stat = metadata_path.stat()
+    observe_yaml_size("gallery", "save", stat.st_size)
+    with _images_lock:
+        galleries_db[gallery.id] = gallery
+        galleries_mtime[gallery.id] = stat.st_mtime
+    images = gallery.loaded_images
+    if images is not None:
+        images.modified = False
+        with _images_lock:
+            _track_images(gallery.id, images)
 
+    # The image list may have changed; refresh the contact sheet lazily.
+    invalidate_contact_sheet(gallery.id)
+    record_change("gallery", gallery.id, "upsert", GalleryThumbnail.from_gallery(gallery).model_dump())
 
-def delete_gallery_image(gallery: Gallery, image_id: str):
-    result = next((item for item in gallery.images if item.id == image_id), None)
-    if result:
-        os.remove(GALLERIES_ROOT_DIR / remove_leading_parts(result.sizes.full))
-        os.remove(GALLERIES_ROOT_DIR / remove_leading_parts(result.sizes.thumb))
-        os.remove(GALLERIES_ROOT_DIR / remove_leading_parts(result.sizes.small))
-        gallery.images.remove(result)
+
+def delete_gallery_image(gallery: GalleryRecord, image_id: str):
+    """
+    Removes an image and its files. Images copied between galleries share
+    their data through links (see app.routers.transfers), so only this
+    gallery's own links are removed, never files under another gallery.
+    """
+    row = gallery.images.index_of(image_id)
+    if row >= 0:
+        result = gallery.images[row]
+        for url in (result.sizes.full, result.sizes.thumb, result.sizes.small):
+            key = media_key(url)
+            if key.startswith(f"galleries/{gallery.id}/"):
+                media_storage.delete(key)
+        thumbnail_cache.invalidate(media_key(result.sizes.thumb))
+        gallery.images.delete(row)
         return True
     
     return False
 
 
-def purge_gallery(gallery: Gallery):
+def purge_gallery(gallery: GalleryRecord):
     gallery_dir = GALLERIES_ROOT_DIR / gallery.id
-    if os.path.exists(gallery_dir) and os.path.isdir(gallery_dir):
-        shutil.rmtree(gallery_dir)
+    # Checked first: with local storage, delete_prefix removes the directory
+    existed = os.path.isdir(gallery_dir)
+    media_storage.delete_prefix(f"galleries/{gallery.id}")
+    thumbnail_cache.invalidate_prefix(f"galleries/{gallery.id}/")
+    if existed:
+        shutil.rmtree(gallery_dir, ignore_errors=True)
         print(f"Removed: {gallery_dir}")
     else:
         print("Directory does not exist")
     del galleries_db[gallery.id]
+    gallery_images_lru.pop(gallery.id, None)
+    invalidate_contact_sheet(gallery.id)
+    record_change("gallery", gallery.id, "delete")
 
 
-def update_gallery_meta(gallery: Gallery):
+def update_gallery_meta(gallery: GalleryRecord):
     save_gallery_metadata(gallery)
 
-
-# Load any existing galleries on startup
-load_galleries_from_filesystem()
@@ -1,20 +1,65 @@
-from fastapi import Request, HTTPException, status
+from typing import Optional
+
+from fastapi import Header, HTTPException, status
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
-from app.config import API_KEY
 
-class APIKeyAuthMiddleware(BaseHTTPMiddleware):
+from app.apikeys import key_manager
+from app.metrics import AUTH_REJECTIONS, AUTHENTICATED_REQUESTS
+
+MUTATING_METHODS = frozenset(("POST", "PUT", "PATCH", "DELETE"))
+
+
+class APIKeyAuthMiddleware:
+    """
+    Pure ASGI middleware requiring a valid X-Api-Key on mutating requests.
+    Everything else (all static images, API reads) passes straight through
+    without the request being wrapped or its headers parsed.
+
+    The name of the key is stored in the request state (`api_key_name`), so
+    endpoints can attribute work to it (see app.admission).
+    """
+
+    def __init__(self, app):
+        self.app = app
+        # Resolve the metric children once per key name and method
+        self._counters = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in MUTATING_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        api_key = None
+        for name, value in scope["headers"]:
+            if name == b"x-api-key":
+                api_key = value.decode("latin-1")
+                break
+        key_name = key_manager.identify(api_key)
+        if key_name is None:
+            AUTH_REJECTIONS.inc()
+            response = JSONResponse(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                content={"detail": "Invalid or missing API key"},
+            )
+            await response(scope, receive, send)
+            return
+
+        counter_key = (key_name, scope["method"])
+        counter = self._counters.get(counter_key)
+        if counter is None:
+            counter = self._counters[counter_key] = AUTHENTICATED_REQUESTS.labels(*counter_key)
+        counter.inc()
+        scope.setdefault("state", {})["api_key_name"] = key_name
+        await self.app(scope, receive, send)
+
+
+def require_api_key(x_api_key: Optional[str] = Header(default=None)) -> str:
     """
-    Middleware to check for a valid API key on all POST requests.
-    This uses a class-based approach for middleware.
+    Dependency for reads that need a key as well (the middleware only checks
+    mutating requests), e.g. admin statistics. Returns the key's name.
     """
-    async def dispatch(self, request: Request, call_next):
-        if request.method in ["POST", "PUT", "DELETE"]:
-            api_key = request.headers.get("X-Api-Key")
-            if not api_key or api_key != API_KEY:
-                return JSONResponse(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    content={"detail": "Invalid or missing API key"}
-                )
-        response = await call_next(request)
-        return response
+    key_name = key_manager.identify(x_api_key)
+    if key_name is None:
+        AUTH_REJECTIONS.inc()
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or missing API key")
+    return key_name
@@ -0,0 +1,84 @@
+"""
+Hands file delivery over to the reverse proxy in front of the app.
+
+By default every image byte is read and sent by the uvicorn process. With
+FILE_OFFLOAD set, requests for `/galleries/...` and `/moodboard-media/...`
+still go through the app (middleware, path mapping, 404s, conditional
+requests), but the response only names the file and the proxy streams it:
+
+* `x-accel` - nginx: `X-Accel-Redirect: {FILE_OFFLOAD_PREFIX}/galleries/<path>`,
+  served by an `internal` location aliased to the storage volume (see
+  helm-chart/templates/nginx-configmap.yaml),
+* `x-sendfile` - Apache mod_xsendfile, lighttpd, ...: `X-Sendfile: <absolute path>`.
+"""
+import os
+from fnmatch import fnmatch
+from typing import Optional
+from urllib.parse import quote
+
+from fastapi.responses import FileResponse, Response
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
+
+from app.config import FILE_OFFLOAD, FILE_OFFLOAD_PREFIX
+
+# Headers of the FileResponse that the proxy should still see
+_KEPT_HEADERS = ("content-type", "content-disposition", "last-modified", "etag")
+
+
+def offload_headers(full_path: str, root: str, mount_path: str) -> dict:
+    """The header telling the proxy which file to send."""
+    if FILE_OFFLOAD == "x-accel":
+        relative = os.path.relpath(full_path, root).replace(os.sep, "/")
+        return {"X-Accel-Redirect": quote(f"{FILE_OFFLOAD_PREFIX}{mount_path}/{relative}")}
+    # Header values are sent as latin-1: this passes the path bytes unchanged
+    return {"X-Sendfile": os.fsencode(os.path.abspath(full_path)).decode("latin-1")}
+
+
+def offloaded(response: FileResponse, full_path: str, root: str, mount_path: str) -> Response:
+    """Turns a FileResponse into an empty one the proxy fills in."""
+    headers = {k: v for k, v in response.headers.items() if k in _KEPT_HEADERS}
+    headers.update(offload_headers(str(full_path), root, mount_path))
+    return Response(status_code=response.status_code, headers=headers)
+
+
+def file_response(full_path, root, mount_path: str, **kwargs) -> Response:
+    """FileResponse for a file below `root` (served at `mount_path`), offloaded if enabled."""
+    response = FileResponse(full_path, **kwargs)
+    if not FILE_OFFLOAD:
+        return response
+    return offloaded(response, os.path.realpath(full_path), os.path.realpath(root), mount_path)
+
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class OffloadStaticFiles(StaticFiles):
+    """
+    StaticFiles whose file responses are offloaded to the proxy if enabled.
+    Files whose path below `directory` matches the `immutable` pattern never
+    change once written (content-addressed names) and are cached by clients
+    for good.
+    """
+
+    def __init__(self, *, directory, mount_path: str, immutable: Optional[str] = None, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.mount_path = mount_path.rstrip("/")
+        self.root = os.path.realpath(directory)
+        self.immutable = immutable
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        response = self._file_response(full_path, stat_result, scope, status_code)
+        if self.immutable and fnmatch(os.path.relpath(full_path, self.root), self.immutable):
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    def _file_response(self, full_path, stat_result, scope, status_code: int) -> Response:
+        if not FILE_OFFLOAD:
+            return super().file_response(full_path, stat_result, scope, status_code)
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        # Revalidations are still answered here, the proxy never sees them
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return offloaded(response, full_path, self.root, self.mount_path)
@@ -0,0 +1,437 @@
+"""
+Compact in-memory representation of gallery metadata.
+
+`galleries_db` used to hold a Pydantic `Gallery` per gallery, i.e. an
+`ImageModel`, an `ImageSizes` and three long url strings for every image,
+which dominated the resident memory with large libraries. `ImageTable`
+stores the same data column by column instead:
+
+* ids as 16 raw bytes (they are UUIDs),
+* width, height and dominant color in `array` columns,
+* each url as the gallery's `/galleries/{id}/images_*/` prefix plus the
+  image's filename plus a suffix such as "__400x400.jpg"; the distinct
+  suffixes are kept once per table and referenced by number,
+* placeholders as the decoded WebP bytes.
+
+Rows are validated as `ImageModel` when the table is built, like the
+`Gallery` model did. Values that pass but don't fit these shapes
+(hand-edited metadata, ids that are not UUIDs, ...) are kept verbatim in a
+small per-row overflow dict, so the table round-trips the metadata exactly. Responses are serialized straight
+from the columns (`GalleryRecord.to_json`); `ImageModel` objects are only
+materialized for single images.
+"""
+import binascii
+from array import array
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import pydantic_core
+from pydantic import TypeAdapter
+
+from app.models import Gallery, ImageModel, ImageSizes
+
+SIZE_DIRS = (("full", "images_full"), ("small", "images_small"), ("thumb", "images_thumb"))
+PLACEHOLDER_PREFIX = "data:image/webp;base64,"
+
+# Sentinels in the array columns; the real value is then in the overflow dict
+# (or the field is None when the row has no overflow entry for it).
+_NONE = 0
+_NO_COLOR = -1
+_ODD = 0xFFFFFFFF
+
+_images_adapter = TypeAdapter(List[ImageModel])
+
+
+def _uuid_bytes(value: str) -> Optional[bytes]:
+    """16 bytes for a canonical (lowercase, dashed) UUID string, else None."""
+    if len(value) != 36 or value != value.lower():
+        return None
+    if value[8] != "-" or value[13] != "-" or value[18] != "-" or value[23] != "-":
+        return None
+    try:
+        return bytes.fromhex(value.replace("-", ""))
+    except ValueError:
+        return None
+
+
+def _uuid_str(raw: bytes) -> str:
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def _color_int(value: str) -> Optional[int]:
+    if len(value) != 7 or value[0] != "#":
+        return None
+    try:
+        color = int(value[1:], 16)
+    except ValueError:
+        return None
+    return color if f"#{color:06x}" == value else None
+
+
+def _placeholder_bytes(value: str) -> Optional[bytes]:
+    if not value.startswith(PLACEHOLDER_PREFIX):
+        return None
+    encoded = value[len(PLACEHOLDER_PREFIX):]
+    try:
+        raw = binascii.a2b_base64(encoded)
+    except binascii.Error:
+        return None
+    return raw if binascii.b2a_base64(raw, newline=False).decode() == encoded else None
+
+
+class ImageTable:
+    """The images of one gallery, stored column by column."""
+
+    __slots__ = (
+        "gallery_id",
+        "_prefixes",
+        "_ids",
+        "_filenames",
+        "_suffixes",
+        "_suffix_codes",
+        "_suffix_columns",
+        "_widths",
+        "_heights",
+        "_colors",
+        "_placeholders",
+        "_odd",
+        "modified",
+    )
+
+    def __init__(self, gallery_id: str):
+        self.gallery_id = gallery_id
+        self._prefixes = tuple(f"/galleries/{gallery_id}/{d}/" for _, d in SIZE_DIRS)
+        self._ids = bytearray()
+        self._filenames: List[str] = []
+        self._suffixes: List[str] = []
+        self._suffix_codes: Dict[str, int] = {}
+        self._suffix_columns = tuple(array("I") for _ in SIZE_DIRS)
+        self._widths = array("I")
+        self._heights = array("I")
+        self._colors = array("i")
+        self._placeholders: List[Optional[bytes]] = []
+        # row -> {field: verbatim value} for values the columns can't hold
+        self._odd: Dict[int, Dict[str, Any]] = {}
+        # Set by append/delete until the gallery is saved; an unsaved table
+        # must not be evicted from the cache.
+        self.modified = False
+
+    @classmethod
+    def from_dicts(cls, gallery_id: str, images: List[dict]) -> "ImageTable":
+        """
+        Builds a table from the `images` list of a metadata.yaml. Raises
+        pydantic's ValidationError (a ValueError) for invalid rows.
+        """
+        table = cls(gallery_id)
+        for image in _images_adapter.validate_python(images):
+            table._add(image)
+        return table
+
+    def __len__(self) -> int:
+        return len(self._filenames)
+
+    def __iter__(self) -> Iterator[ImageModel]:
+        for values in self.rows():
+            yield self._model(values)
+
+    def __getitem__(self, row: int) -> ImageModel:
+        return self._model(self._row(row))
+
+    @staticmethod
+    def _model(values: dict) -> ImageModel:
+        return ImageModel.model_construct(
+            id=values["id"],
+            filename=values["filename"],
+            sizes=ImageSizes.model_construct(**values["sizes"]),
+            width=values["width"],
+            height=values["height"],
+            placeholder=values["placeholder"],
+            dominantColor=values["dominantColor"],
+        )
+
+    def append(self, image: ImageModel):
+        self.modified = True
+        self._add(image)
+
+    def _add(self, image: ImageModel):
+        self._append(
+            image.id,
+            image.filename,
+            (image.sizes.full, image.sizes.small, image.sizes.thumb),
+            image.width,
+            image.height,
+            image.placeholder,
+            image.dominantColor,
+        )
+
+    def index_of(self, image_id: str) -> int:
+        """Row of the image with `image_id`, or -1."""
+        for row, odd in self._odd.items():
+            if odd.get("id") == image_id:
+                return row
+        raw = _uuid_bytes(image_id)
+        if raw is None:
+            return -1
+        pos = self._ids.find(raw)
+        while pos != -1:
+            row, offset = divmod(pos, 16)
+            if not offset and "id" not in self._odd.get(row, ()):
+                return row
+            pos = self._ids.find(raw, pos + 1)
+        return -1
+
+    def delete(self, row: int):
+        self.modified = True
+        del self._ids[row * 16 : row * 16 + 16]
+        del self._filenames[row]
+        for column in self._suffix_columns:
+            del column[row]
+        del self._widths[row]
+        del self._heights[row]
+        del self._colors[row]
+        del self._placeholders[row]
+        if self._odd:
+            self._odd = {
+                (r - 1 if r > row else r): odd for r, odd in self._odd.items() if r != row
+            }
+
+    def nbytes(self) -> int:
+        """Approximate memory used by the table, for the cache budget."""
+        # ~50 bytes of object overhead per str/bytes plus 8 per list slot
+        size = len(self._ids) + 58 * len(self) * 2
+        size += sum(len(filename) for filename in self._filenames)
+        size += sum(len(p) for p in self._placeholders if p is not None)
+        for column in (*self._suffix_columns, self._widths, self._heights, self._colors):
+            size += column.itemsize * len(column)
+        return size + 200 * len(self._odd)
+
+    def to_dicts(self) -> List[dict]:
+        """The `images` list as written to metadata.yaml (None values left out)."""
+        return [{k: v for k, v in values.items() if v is not None} for values in self.rows()]
+
+    def rows(self) -> Iterator[dict]:
+        """
+        Yields every image as a dict with all `ImageModel` fields (None
+        included). Walks the columns in one pass, which is much cheaper than
+        materializing the rows one by one.
+        """
+        ids = self._ids.hex()
+        prefix_full, prefix_small, prefix_thumb = self._prefixes
+        suffixes = self._suffixes
+        odd = self._odd
+        columns = zip(
+            self._filenames,
+            *self._suffix_columns,
+            self._widths,
+            self._heights,
+            self._colors,
+            self._placeholders,
+        )
+        for row, (filename, full, small, thumb, width, height, color, placeholder) in enumerate(
+            columns
+        ):
+            if odd and row in odd:
+                yield self._row(row)
+                continue
+            h = ids[row * 32 : row * 32 + 32]
+            yield {
+                "id": f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}",
+                "filename": filename,
+                "sizes": {
+                    "full": prefix_full + filename + suffixes[full],
+                    "small": prefix_small + filename + suffixes[small],
+                    "thumb": prefix_thumb + filename + suffixes[thumb],
+                },
+                "width": width or None,
+                "height": height or None,
+                "placeholder": None
+                if placeholder is None
+                else PLACEHOLDER_PREFIX + binascii.b2a_base64(placeholder, newline=False).decode(),
+                "dominantColor": None if color == _NO_COLOR else f"#{color:06x}",
+            }
+
+    def _append(self, image_id, filename, urls, width, height, placeholder, color):
+        row = len(self)
+        odd: Dict[str, Any] = {}
+
+        raw_id = _uuid_bytes(image_id) if isinstance(image_id, str) else None
+        if raw_id is None:
+            odd["id"] = image_id
+            raw_id = bytes(16)
+        self._ids += raw_id
+        self._filenames.append(filename)
+
+        for i, url in enumerate(urls):
+            start = self._prefixes[i] + filename
+            if isinstance(url, str) and url.startswith(start):
+                suffix = url[len(start):]
+                code = self._suffix_codes.get(suffix)
+                if code is None:
+                    code = self._suffix_codes[suffix] = len(self._suffixes)
+                    self._suffixes.append(suffix)
+            else:
+                odd[SIZE_DIRS[i][0]] = url
+                code = _ODD
+            self._suffix_columns[i].append(code)
+
+        for column, name, value in ((self._widths, "width", width), (self._heights, "height", height)):
+            if value is None:
+                column.append(_NONE)
+            elif isinstance(value, int) and 0 < value < _ODD:
+                column.append(value)
+            else:
+                odd[name] = value
+                column.append(_NONE)
+
+        if color is None:
+            self._colors.append(_NO_COLOR)
+        else:
+            color_int = _color_int(color) if isinstance(color, str) else None
+            if color_int is None:
+                odd["dominantColor"] = color
+                color_int = _NO_COLOR
+            self._colors.append(color_int)
+
+        raw_placeholder = None
+        if placeholder is not None:
+            if isinstance(placeholder, str):
+                raw_placeholder = _placeholder_bytes(placeholder)
+            if raw_placeholder is None:
+                odd["placeholder"] = placeholder
+        self._placeholders.append(raw_placeholder)
+
+        if odd:
+            self._odd[row] = odd
+
+    def _row(self, row: int) -> dict:
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("image row out of range")
+        odd = self._odd.get(row, {})
+        filename = self._filenames[row]
+
+        sizes = {}
+        for i, (name, _) in enumerate(SIZE_DIRS):
+            code = self._suffix_columns[i][row]
+            if code == _ODD:
+                sizes[name] = odd[name]
+            else:
+                sizes[name] = self._prefixes[i] + filename + self._suffixes[code]
+
+        placeholder = self._placeholders[row]
+        if placeholder is not None:
+            placeholder = PLACEHOLDER_PREFIX + binascii.b2a_base64(
+                placeholder, newline=False
+            ).decode()
+        color = self._colors[row]
+
+        return {
+            "id": odd["id"] if "id" in odd else _uuid_str(self._ids[row * 16 : row * 16 + 16]),
+            "filename": filename,
+            "sizes": sizes,
+            "width": odd.get("width", self._widths[row] or None),
+            "height": odd.get("height", self._heights[row] or None),
+            "placeholder": odd.get("placeholder", placeholder),
+            "dominantColor": odd.get(
+                "dominantColor", None if color == _NO_COLOR else f"#{color:06x}"
+            ),
+        }
+
+
+class GalleryRecord:
+    """
+    A gallery as kept in `galleries_db`: the scalar metadata plus an
+    `ImageTable`. `to_json()` gives the `Gallery` returned by the API.
+
+    Records loaded from the metadata header only have no table yet; the
+    `images` property loads it through `images_loader` on first access (the
+    loader may also drop it again later, see `app.database`).
+    """
+
+    __slots__ = ("id", "name", "author", "lastUpdateDate", "coverImageUrl", "_images")
+
+    # Installed by app.database: returns the image table of a record, loading
+    # and attaching it first when needed.
+    images_loader: Optional[Callable[["GalleryRecord"], ImageTable]] = None
+
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        author: str,
+        lastUpdateDate: Optional[datetime] = None,
+        coverImageUrl: Optional[str] = None,
+        images: Optional[ImageTable] = None,
+    ):
+        self.id = id
+        self.name = name
+        self.author = author
+        self.lastUpdateDate = lastUpdateDate or datetime.now()
+        self.coverImageUrl = coverImageUrl
+        self._images = images if images is not None else ImageTable(id)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GalleryRecord":
+        """
+        Builds a record from a parsed metadata.yaml, validating the scalar
+        fields. Without an `images` key (a header-only parse) the image table
+        is left to be loaded on first access.
+        """
+        meta = Gallery.model_validate({k: v for k, v in data.items() if k != "images"})
+        record = cls(
+            id=meta.id,
+            name=meta.name,
+            author=meta.author,
+            lastUpdateDate=meta.lastUpdateDate,
+            coverImageUrl=meta.coverImageUrl,
+        )
+        if "images" in data:
+            record._images = ImageTable.from_dicts(meta.id, data["images"] or [])
+        else:
+            record._images = None
+        return record
+
+    @property
+    def images(self) -> ImageTable:
+        if GalleryRecord.images_loader is not None:
+            return GalleryRecord.images_loader(self)
+        return self._images
+
+    @property
+    def loaded_images(self) -> Optional[ImageTable]:
+        """The image table if it is loaded, without loading it."""
+        return self._images
+
+    def attach_images(self, images: Optional[ImageTable]):
+        """Sets the loaded image table, or drops it with None."""
+        self._images = images
+
+    def to_json(self) -> bytes:
+        """
+        The gallery serialized exactly like a `Gallery` model, without
+        building one: the rows go straight to pydantic's JSON encoder.
+        """
+        return pydantic_core.to_json(
+            {
+                "id": self.id,
+                "name": self.name,
+                "author": self.author,
+                "lastUpdateDate": self.lastUpdateDate,
+                "coverImageUrl": self.coverImageUrl,
+                "images": list(self.images.rows()),
+            }
+        )
+
+    def to_dict(self) -> dict:
+        """The metadata.yaml form (field order as in `Gallery`, None values left out)."""
+        data = {
+            "id": self.id,
+            "name": self.name,
+            "author": self.author,
+            "lastUpdateDate": self.lastUpdateDate.isoformat(),
+            "coverImageUrl": self.coverImageUrl,
+            "images": self.images.to_dicts(),
+        }
+        return {k: v for k, v in data.items() if v is not None}
@@ -0,0 +1,126 @@
+"""
+JPEG encoding of renditions.
+
+With JPEG_ENCODING=adaptive (the default) each rendition gets the lowest
+quality between JPEG_MIN_QUALITY and JPEG_MAX_QUALITY whose decoded result
+still reaches JPEG_TARGET_SSIM against the rendition itself: simple images
+(flat colours, soft gradients) need far fewer bytes than at a fixed quality,
+noisy or detailed ones get more quality where 85 visibly smears them.
+
+The search starts at the former fixed quality (JPEG_QUALITY) and bisects
+below or above it; each probe encodes and decodes the luma and scores it
+with an SSIM vectorized in NumPy, all on the already downscaled rendition
+(the original isn't decoded again). The chosen quality is then written as
+an optimized progressive JPEG, which is smaller again at identical pixels.
+With JPEG_ENCODING=fixed every rendition is written at JPEG_QUALITY,
+optimized and progressive.
+
+Chosen qualities and the bytes compared to the fixed quality are exported
+as metrics per rendition ("small", "thumb", "moodboard").
+"""
+import io
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.config import (
+    JPEG_ENCODING,
+    JPEG_MAX_QUALITY,
+    JPEG_MIN_QUALITY,
+    JPEG_QUALITY,
+    JPEG_TARGET_SSIM,
+)
+from app.metrics import JPEG_BASELINE_BYTES, JPEG_CHOSEN_QUALITY, JPEG_WRITTEN_BYTES
+
+# SSIM constants for 8-bit images and the side of its windows
+_C1 = (0.01 * 255) ** 2
+_C2 = (0.03 * 255) ** 2
+SSIM_WINDOW = 8
+
+
+def _blocks(luma: np.ndarray, offset: int) -> np.ndarray:
+    """`luma` cut into SSIM_WINDOW x SSIM_WINDOW blocks, starting at `offset`."""
+    w = SSIM_WINDOW
+    rows = (luma.shape[0] - offset) // w
+    cols = (luma.shape[1] - offset) // w
+    cropped = luma[offset : offset + rows * w, offset : offset + cols * w]
+    return cropped.reshape(rows, w, cols, w).swapaxes(1, 2).reshape(rows, cols, w * w).astype(np.float32)
+
+
+class SSIMReference:
+    """
+    Mean SSIM against a fixed reference image, over non-overlapping windows
+    on two grids: aligned with the 8x8 JPEG blocks (distortion inside them)
+    and shifted by half a block (blocking at their edges). The reference's
+    statistics are computed once for all candidates.
+    """
+
+    def __init__(self, luma: np.ndarray):
+        self.grids = []
+        for offset in (0, SSIM_WINDOW // 2):
+            x = _blocks(luma, offset)
+            mean = x.mean(axis=2)
+            self.grids.append((offset, x - mean[..., None], mean, x.var(axis=2)))
+
+    def score(self, luma: np.ndarray) -> float:
+        scores = []
+        for offset, x_centered, mu_x, var_x in self.grids:
+            if not x_centered.size:
+                return 1.0  # smaller than a window
+            y = _blocks(luma, offset)
+            mu_y = y.mean(axis=2)
+            y -= mu_y[..., None]
+            var_y = np.einsum("ijk,ijk->ij", y, y) / y.shape[2]
+            cov = np.einsum("ijk,ijk->ij", x_centered, y) / y.shape[2]
+            score = ((2 * mu_x * mu_y + _C1) * (2 * cov + _C2)) / (
+                (mu_x * mu_x + mu_y * mu_y + _C1) * (var_x + var_y + _C2)
+            )
+            scores.append(score.mean())
+        return float(np.mean(scores))
+
+
+def _encode(img: Image.Image, quality: int, final: bool = False) -> bytes:
+    out = io.BytesIO()
+    if final:
+        img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    else:
+        img.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+def choose_quality(img: Image.Image) -> Tuple[int, int]:
+    """(lowest quality reaching JPEG_TARGET_SSIM, size of a plain encode at JPEG_QUALITY)."""
+    # The score only looks at the luma, so the probes encode just that: the
+    # same quantization of Y as in the colour image, at a fraction of the cost
+    luma = img.convert("L")
+    reference = SSIMReference(np.asarray(luma))
+
+    def passes(quality: int) -> bool:
+        with Image.open(io.BytesIO(_encode(luma, quality))) as decoded:
+            return reference.score(np.asarray(decoded)) >= JPEG_TARGET_SSIM
+
+    # Lowest passing quality in [low, high]; `high` itself is used if none does
+    if passes(JPEG_QUALITY):
+        low, high = JPEG_MIN_QUALITY, JPEG_QUALITY
+    else:
+        low, high = JPEG_QUALITY + 1, JPEG_MAX_QUALITY
+    while low < high:
+        middle = (low + high) // 2
+        if passes(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return high, len(_encode(img, JPEG_QUALITY))
+
+
+def encode_jpeg(img: Image.Image, rendition: str) -> bytes:
+    """`img` encoded as JPEG, at an adaptive or fixed quality (see above)."""
+    if JPEG_ENCODING != "adaptive":
+        return _encode(img, JPEG_QUALITY, final=True)
+    quality, baseline_size = choose_quality(img)
+    data = _encode(img, quality, final=True)
+    JPEG_CHOSEN_QUALITY.labels(rendition).observe(quality)
+    JPEG_BASELINE_BYTES.labels(rendition).inc(baseline_size)
+    JPEG_WRITTEN_BYTES.labels(rendition).inc(len(data))
+    return data
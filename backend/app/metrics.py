@@ -0,0 +1,265 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+# --- Metric definitions ---
+# Buckets are chosen per metric so a single histogram covers the realistic
+# range without adding many series (each bucket is one series per label set).
+
+REQUEST_LATENCY = Histogram(
+    "photopia_request_duration_seconds",
+    "HTTP request latency by route template.",
+    ["method", "route"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+UPLOAD_STAGE_DURATION = Histogram(
+    "photopia_upload_stage_duration_seconds",
+    "Time spent in each stage of the image ingestion pipeline.",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+YAML_DURATION = Histogram(
+    "photopia_yaml_duration_seconds",
+    "Time spent loading or saving a metadata YAML file.",
+    ["kind", "op"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+YAML_SIZE = Histogram(
+    "photopia_yaml_size_bytes",
+    "Size of metadata YAML files as loaded or saved.",
+    ["kind", "op"],
+    buckets=(1e3, 1e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7),
+)
+
+ZIP_BUILD_DURATION = Histogram(
+    "photopia_zip_build_duration_seconds",
+    "Time spent building a gallery zip archive.",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+
+CACHE_ENTRIES = Gauge(
+    "photopia_cache_entries",
+    "Number of entries in an in-memory metadata cache.",
+    ["cache"],
+)
+
+THUMB_CACHE_REQUESTS = Counter(
+    "photopia_thumbnail_cache_requests_total",
+    "Thumbnail requests by whether they were served from memory.",
+    ["result"],
+)
+
+THUMB_CACHE_BYTES = Gauge(
+    "photopia_thumbnail_cache_bytes",
+    "Approximate memory held by the thumbnail cache.",
+)
+
+EVENT_LOOP_LAG = Histogram(
+    "photopia_event_loop_lag_seconds",
+    "Delay between when a periodic event-loop probe was due and when it ran.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+UPLOADED_BYTES = Counter(
+    "photopia_uploaded_bytes_total",
+    "Bytes received by the upload endpoints.",
+    ["kind"],
+)
+
+JPEG_CHOSEN_QUALITY = Histogram(
+    "photopia_jpeg_chosen_quality",
+    "JPEG quality picked by the adaptive encoder, by rendition.",
+    ["rendition"],
+    buckets=(50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100),
+)
+
+JPEG_BASELINE_BYTES = Counter(
+    "photopia_jpeg_baseline_bytes_total",
+    "Size the adaptively encoded renditions would have had at the fixed JPEG_QUALITY.",
+    ["rendition"],
+)
+
+JPEG_WRITTEN_BYTES = Counter(
+    "photopia_jpeg_written_bytes_total",
+    "Size of the adaptively encoded renditions as written.",
+    ["rendition"],
+)
+
+MEDIA_LINKS = Counter(
+    "photopia_media_links_total",
+    "Image files shared into another gallery or moodboard, by how (hardlink, reflink, copy, ...).",
+    ["method"],
+)
+
+STORAGE_USAGE_BYTES = Gauge(
+    "photopia_storage_usage_bytes",
+    "Media bytes stored, by kind (gallery, moodboard).",
+    ["kind"],
+)
+
+STORAGE_USAGE_FILES = Gauge(
+    "photopia_storage_usage_files",
+    "Media files stored, by kind (gallery, moodboard).",
+    ["kind"],
+)
+
+QUOTA_REJECTIONS = Counter(
+    "photopia_quota_rejections_total",
+    "Uploads refused for exceeding a quota, by quota (key, gallery, moodboard).",
+    ["quota"],
+)
+
+AUTHENTICATED_REQUESTS = Counter(
+    "photopia_authenticated_requests_total",
+    "Mutating requests accepted, by API key name.",
+    ["key", "method"],
+)
+
+AUTH_REJECTIONS = Counter(
+    "photopia_auth_rejections_total",
+    "Mutating requests rejected for a missing or unknown API key.",
+)
+
+INGEST_IN_FLIGHT = Gauge(
+    "photopia_ingest_in_flight",
+    "Uploaded images being processed (admitted by admission control).",
+)
+
+INGEST_QUEUED = Gauge(
+    "photopia_ingest_queued",
+    "Uploaded images waiting for admission.",
+)
+
+INGEST_RESERVED_BYTES = Gauge(
+    "photopia_ingest_reserved_bytes",
+    "Estimated memory of the images being processed.",
+)
+
+INGEST_WAIT = Histogram(
+    "photopia_ingest_wait_seconds",
+    "Time uploads waited for admission.",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+INGEST_REJECTIONS = Counter(
+    "photopia_ingest_rejections_total",
+    "Uploads turned away by admission control.",
+    ["reason"],
+)
+
+UPLOAD_STAGES = (
+    "receive",
+    "decode",
+    "resize_small",
+    "resize_thumb",
+    "placeholder",
+    "encode",
+    "store_original",
+    "metadata_write",
+)
+
+# `labels()` takes a lock and builds a key on every call; resolve the
+# children once so hot paths only pay for `observe()`.
+_stage_children = {stage: UPLOAD_STAGE_DURATION.labels(stage) for stage in UPLOAD_STAGES}
+_request_children: Dict[Tuple[str, str], object] = {}
+
+
+@contextmanager
+def upload_stage(stage: str):
+    """Times a block of the ingestion pipeline under `stage`."""
+    child = _stage_children.get(stage) or UPLOAD_STAGE_DURATION.labels(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        child.observe(time.perf_counter() - start)
+
+
+@contextmanager
+def yaml_timer(kind: str, op: str):
+    """Times a metadata YAML load/save of `kind` ("gallery" or "moodboard")."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        YAML_DURATION.labels(kind, op).observe(time.perf_counter() - start)
+
+
+def observe_yaml_size(kind: str, op: str, size: int):
+    YAML_SIZE.labels(kind, op).observe(size)
+
+
+def render_metrics():
+    """Returns (body, content type) of the Prometheus text exposition."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def route_template(scope) -> str:
+    """
+    Returns the template of the route that handled a request (e.g.
+    "/api/v1/gallery", not the raw path). Only meaningful once the app has
+    processed the request. Static mounts are reported under their mount path.
+    """
+    # Routers and mounts extend root_path while matching; the matched
+    # route's own path is relative to that.
+    root_path = scope.get("root_path", "")
+    prefix = root_path[len(scope.get("app_root_path", "")) :]
+    # Recent FastAPI versions keep included routes unprefixed and expose the
+    # effective (prefixed) path separately.
+    effective = scope.get("fastapi", {}).get("effective_route_context")
+    if effective is not None:
+        return prefix + effective.path
+    route = scope.get("route")
+    if route is not None:
+        return prefix + route.path
+    return prefix or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording request latency per route template so
+    label cardinality stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            key = (scope["method"], route_template(scope))
+            child = _request_children.get(key)
+            if child is None:
+                child = _request_children[key] = REQUEST_LATENCY.labels(*key)
+            child.observe(time.perf_counter() - start)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """
+    Periodically sleeps for `interval` and records how late it woke up. Any
+    blocking work on the event loop (sync YAML dumps, Pillow calls in async
+    endpoints) shows up as lag.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - expected))
@@ -0,0 +1,75 @@
+"""
+Moves the image files of every gallery into the flat or the sharded layout
+(see app.storage_layout). Urls and metadata don't change, only where the
+files are on disk.
+
+Files are moved one by one with os.rename, so an interrupted run can simply
+be started again. Run it while the app is stopped, then set STORAGE_LAYOUT
+to the new layout. (A running app still serves files from both layouts, but
+its collision checks for new uploads only look at the configured one.)
+
+Usage (from the backend directory):
+    python -m app.migrate_layout --to sharded [--dry-run]
+    python -m app.migrate_layout --to flat
+"""
+import argparse
+import os
+from pathlib import Path
+
+from app.config import GALLERIES_ROOT_DIR
+from app.storage_layout import LAYOUTS, SIZE_DIR_NAMES, image_path, iter_image_files
+
+
+def migrate_gallery(gallery_id: str, layout: str, dry_run: bool = False) -> int:
+    """Moves the files of one gallery into `layout`. Returns how many were moved."""
+    moved = 0
+    for size_dir in SIZE_DIR_NAMES:
+        size_root = GALLERIES_ROOT_DIR / gallery_id / size_dir
+        # Collect first: the walk must not see the files it just moved
+        for current in list(iter_image_files(gallery_id, size_dir)):
+            target = image_path(gallery_id, size_dir, current.name, layout)
+            if current == target:
+                continue
+            if target.exists():
+                print(f"Skipping {current}: {target} already exists")
+                continue
+            moved += 1
+            if dry_run:
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(current, target)
+        if layout == "flat" and not dry_run:
+            _remove_empty_dirs(size_root)
+    return moved
+
+
+def _remove_empty_dirs(size_root: Path):
+    for dirpath, _, _ in sorted(os.walk(size_root), reverse=True):
+        if Path(dirpath) != size_root:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass  # not empty
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--to", choices=LAYOUTS, required=True, help="target layout")
+    parser.add_argument("--dry-run", action="store_true", help="only count the files to move")
+    args = parser.parse_args()
+
+    total = 0
+    for gallery_dir in sorted(GALLERIES_ROOT_DIR.iterdir()):
+        if not (gallery_dir / "metadata.yaml").is_file():
+            continue
+        moved = migrate_gallery(gallery_dir.name, args.to, args.dry_run)
+        if moved:
+            print(f"{gallery_dir.name}: {moved} file(s) {'to move' if args.dry_run else 'moved'}")
+        total += moved
+    print(f"{total} file(s) {'to move' if args.dry_run else 'moved'} to the {args.to} layout")
+    if not args.dry_run:
+        print(f"Now run the app with STORAGE_LAYOUT={args.to}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Annotated, List, Literal, Optional, Union
 from datetime import datetime
 from pydantic import BaseModel, Field
 
@@ -17,6 +17,8 @@ class ImageModel(BaseModel):
     sizes: ImageSizes
     width: Optional[int] = None
     height: Optional[int] = None
+    placeholder: Optional[str] = None  # tiny base64 data URI
+    dominantColor: Optional[str] = None  # "#rrggbb"
 
 
 class Gallery(BaseModel):
@@ -58,6 +60,8 @@ class MoodboardImage(BaseModel):
     description: Optional[str] = None
     width: Optional[int] = None
     height: Optional[int] = None
+    placeholder: Optional[str] = None  # tiny base64 data URI
+    dominantColor: Optional[str] = None  # "#rrggbb"
 
 
 class MoodboardSection(BaseModel):
@@ -73,6 +77,9 @@ class Moodboard(BaseModel):
     headerColor: str = "#111827"
     lastUpdateDate: datetime = Field(default_factory=datetime.now)
     coverImageUrl: Optional[str] = None
+    coverPlaceholder: Optional[str] = None
+    coverDominantColor: Optional[str] = None
+    version: int = 0  # bumped on every save, used for conflict detection
     sections: List[MoodboardSection] = []
 
 
@@ -81,17 +88,134 @@ class MoodboardThumbnail(BaseModel):
     name: str
     headerColor: str
     coverImageUrl: Optional[str] = None
+    coverPlaceholder: Optional[str] = None
+    coverDominantColor: Optional[str] = None
+    # Pre-rendered collages (see app/moodboard_preview.py), once rendered
+    previewUrl: Optional[str] = None
+    cardUrl: Optional[str] = None
 
     @classmethod
-    def from_moodboard(cls, mb: Moodboard):
+    def from_moodboard(cls, mb: Moodboard, preview: Optional[dict] = None):
         return MoodboardThumbnail(
             id=mb.id,
             name=mb.name,
             headerColor=mb.headerColor,
             coverImageUrl=mb.coverImageUrl,
+            coverPlaceholder=mb.coverPlaceholder,
+            coverDominantColor=mb.coverDominantColor,
+            **(preview or {}),
         )
 
 
 class MoodboardData(BaseModel):
     name: str
     headerColor: Optional[str] = "#111827"
+
+
+# --- Sharing images between galleries and moodboards ---
+# The files are linked, not re-encoded (see app/routers/transfers.py).
+
+
+class CopyImagesRequest(BaseModel):
+    sourceGalleryId: str
+    imageIds: Optional[List[str]] = None  # all images of the source when omitted
+    move: bool = False  # remove them from the source gallery
+
+
+class AttachGalleryImagesRequest(BaseModel):
+    galleryId: str
+    imageIds: List[str]
+    section: Optional[int] = None  # images section to append to; none: only attach the files
+    baseVersion: Optional[int] = None  # checked like PATCH /moodboard when given
+    move: bool = False  # remove them from the gallery
+
+
+class AttachGalleryImagesResult(BaseModel):
+    version: int
+    images: List[MoodboardImage]
+
+
+# --- Section-level moodboard edits (PATCH /moodboard) ---
+# Section and image positions are list indexes; images are addressed by id.
+
+
+class InsertSectionOp(BaseModel):
+    op: Literal["insertSection"]
+    index: int
+    section: MoodboardSection
+
+
+class MoveSectionOp(BaseModel):
+    op: Literal["moveSection"]
+    index: int
+    to: int
+
+
+class DeleteSectionOp(BaseModel):
+    op: Literal["deleteSection"]
+    index: int
+
+
+class UpdateSectionOp(BaseModel):
+    """Sets `text` and/or `view`; only the fields present in the op are changed."""
+
+    op: Literal["updateSection"]
+    index: int
+    text: Optional[str] = None
+    view: Optional[str] = None
+
+
+class AddImageOp(BaseModel):
+    op: Literal["addImage"]
+    section: int
+    image: MoodboardImage
+    index: Optional[int] = None  # append when omitted
+
+
+class RemoveImageOp(BaseModel):
+    op: Literal["removeImage"]
+    section: int
+    imageId: str
+
+
+class MoveImageOp(BaseModel):
+    op: Literal["moveImage"]
+    section: int
+    imageId: str
+    to: int
+    toSection: Optional[int] = None  # same section when omitted
+
+
+class UpdateImageOp(BaseModel):
+    op: Literal["updateImage"]
+    section: int
+    imageId: str
+    description: Optional[str] = None
+
+
+MoodboardOp = Annotated[
+    Union[
+        InsertSectionOp,
+        MoveSectionOp,
+        DeleteSectionOp,
+        UpdateSectionOp,
+        AddImageOp,
+        RemoveImageOp,
+        MoveImageOp,
+        UpdateImageOp,
+    ],
+    Field(discriminator="op"),
+]
+
+
+class MoodboardPatch(BaseModel):
+    baseVersion: int  # version the client's edits are based on
+    ops: List[MoodboardOp]
+
+
+class MoodboardPatchResult(BaseModel):
+    version: int
+    lastUpdateDate: datetime
+    coverImageUrl: Optional[str] = None
+    coverPlaceholder: Optional[str] = None
+    coverDominantColor: Optional[str] = None
@@ -1,15 +1,161 @@
+import json
 import os
 import shutil
 import yaml
-from typing import Dict
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-from app.models import Moodboard
-from app.config import MOODBOARDS_ROOT_DIR
-from app.database import remove_leading_parts
+from pydantic import TypeAdapter
+
+from app.models import (
+    AddImageOp,
+    DeleteSectionOp,
+    InsertSectionOp,
+    Moodboard,
+    MoodboardOp,
+    MoodboardThumbnail,
+    MoveImageOp,
+    MoveSectionOp,
+    RemoveImageOp,
+    UpdateImageOp,
+    UpdateSectionOp,
+)
+from app.config import MOODBOARDS_ROOT_DIR, MOODBOARD_SECTIONS_CACHE_MB
+from app.metrics import CACHE_ENTRIES, observe_yaml_size, yaml_timer
+from app.attachments import forget_moodboard, release_references, replace_references
+from app.database import YAML_LOADER, read_metadata_header
+from app.storage import media_storage
+from app.changes import record_change
+from app.moodboard_preview import forget_preview, preview_urls, schedule_preview
 
 # Cache: moodboard_id -> (Moodboard, last_mtime)
 moodboards_db: Dict[str, Moodboard] = {}
 moodboards_mtime: Dict[str, float] = {}
+CACHE_ENTRIES.labels("moodboards_db").set_function(lambda: len(moodboards_db))
+# Set once every moodboard has been read (see app.warmup); until then
+# `find_moodboard` loads missing boards on demand.
+moodboards_warm = False
+
+# Startup only reads the header of each moodboard, so `moodboards_db` entries
+# have empty sections until `get_full_moodboard` loads them. Boards with loaded
+# sections are kept here in LRU order (moodboard_id -> metadata size in
+# bytes, a rough proxy for memory) and unloaded again past
+# MOODBOARD_SECTIONS_CACHE_MB.
+moodboard_sections_lru: "OrderedDict[str, int]" = OrderedDict()
+CACHE_ENTRIES.labels("moodboard_sections").set_function(lambda: len(moodboard_sections_lru))
+
+# Section-level edits are appended to this journal next to moodboard.yaml
+# instead of rewriting the whole file. Once it grows past
+# MAX_JOURNAL_ENTRIES the board is compacted back into moodboard.yaml.
+JOURNAL_FILENAME = "moodboard.ops.jsonl"
+MAX_JOURNAL_ENTRIES = 200
+journal_entries: Dict[str, int] = {}
+
+_ops_adapter = TypeAdapter(List[MoodboardOp])
+
+
+def _replay_journal(moodboard: Moodboard, journal_path: Path) -> int:
+    """
+    Applies journal entries newer than the version stored in moodboard.yaml.
+    Returns the number of entries in the journal.
+    """
+    count = 0
+    with open(journal_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            count += 1
+            entry = json.loads(line)
+            if entry["version"] <= moodboard.version:
+                # Already part of moodboard.yaml (compaction was interrupted)
+                continue
+            apply_moodboard_ops(moodboard, _ops_adapter.validate_python(entry["ops"]))
+            moodboard.version = entry["version"]
+            moodboard.lastUpdateDate = datetime.fromisoformat(entry["lastUpdateDate"])
+    _recompute_cover_image_url(moodboard)
+    return count
+
+
+def list_moodboard_ids() -> List[str]:
+    return [d.name for d in MOODBOARDS_ROOT_DIR.iterdir() if d.is_dir()]
+
+
+def read_moodboard_header(moodboard_id: str) -> Optional[Tuple[float, Moodboard]]:
+    """
+    Reads the header of a moodboard without touching any cache, so it can be
+    done in a thread: (mtime of moodboard.yaml, header), or None if the board
+    has a pending journal or can't be read.
+    """
+    metadata_path = MOODBOARDS_ROOT_DIR / moodboard_id / "moodboard.yaml"
+    try:
+        if (metadata_path.parent / JOURNAL_FILENAME).exists():
+            return None
+        mtime = metadata_path.stat().st_mtime
+        with yaml_timer("moodboard", "load"):
+            return mtime, Moodboard(**read_metadata_header(metadata_path, "sections"))
+    except (OSError, yaml.YAMLError, ValueError, KeyError):
+        return None  # load_moodboard reads it again and reports the error
+
+
+def load_moodboard(
+    moodboard_id: str, header: Optional[Tuple[float, Moodboard]] = None
+) -> Optional[Moodboard]:
+    """
+    Loads (or refreshes, if its moodboard.yaml changed) one moodboard into
+    the cache: just the header, or the whole board if it has a pending
+    journal. `header` is a `read_moodboard_header` result, used if the file
+    didn't change since. Returns the cached moodboard, or None if it doesn't
+    exist or can't be read.
+    """
+    moodboard_dir = MOODBOARDS_ROOT_DIR / moodboard_id
+    # Only plain directory names, never paths
+    if (
+        not moodboard_id
+        or moodboard_dir.parent != MOODBOARDS_ROOT_DIR
+        or moodboard_dir.name != moodboard_id
+    ):
+        return None
+    metadata_path = moodboard_dir / "moodboard.yaml"
+    if not metadata_path.exists():
+        return None
+    stat = metadata_path.stat()
+    mtime = stat.st_mtime
+    try:
+        # If not in cache or updated
+        if moodboard_id not in moodboards_mtime or moodboards_mtime[moodboard_id] < mtime:
+            moodboard_sections_lru.pop(moodboard_id, None)
+            if (moodboard_dir / JOURNAL_FILENAME).exists():
+                # The header in moodboard.yaml is stale until the journal is
+                # replayed onto the sections.
+                moodboard = _load_full_moodboard(moodboard_id)
+                _track_sections(moodboard)
+            elif header is not None and header[0] == mtime:
+                moodboard = header[1]
+                release_references(moodboard.id)
+            else:
+                with yaml_timer("moodboard", "load"):
+                    moodboard = Moodboard(**read_metadata_header(metadata_path, "sections"))
+                release_references(moodboard.id)
+            moodboards_db[moodboard.id] = moodboard
+            moodboards_mtime[moodboard.id] = mtime
+    except (yaml.YAMLError, ValueError, KeyError) as e:
+        print(f"Error loading moodboard from {metadata_path}: {e}")
+        return None
+    return moodboards_db.get(moodboard_id)
+
+
+def find_moodboard(moodboard_id: str) -> Optional[Moodboard]:
+    """
+    Returns a cached moodboard (sections possibly not loaded). While the
+    startup warm-up hasn't reached it yet, it is loaded on demand instead of
+    reported missing.
+    """
+    mb = moodboards_db.get(moodboard_id)
+    if mb is None and not moodboards_warm:
+        mb = load_moodboard(moodboard_id)
+    return mb
 
 
 def load_moodboards_from_filesystem():
@@ -17,58 +163,269 @@ def load_moodboards_from_filesystem():
     Loads or refreshes moodboard metadata from moodboard.yaml files in each moodboard
     directory, using a cache to avoid re-parsing unchanged files.
     """
+    global moodboards_warm
     seen_ids = set()
 
-    for moodboard_dir in MOODBOARDS_ROOT_DIR.iterdir():
-        if moodboard_dir.is_dir():
-            metadata_path = moodboard_dir / "moodboard.yaml"
-            if metadata_path.exists():
-                mtime = metadata_path.stat().st_mtime
-                try:
-                    # If not in cache or updated
-                    if (
-                        moodboard_dir.name not in moodboards_mtime
-                        or moodboards_mtime[moodboard_dir.name] < mtime
-                    ):
-                        with open(metadata_path, "r") as f:
-                            data = yaml.safe_load(f)
-                            moodboard = Moodboard(**data)
-                            moodboards_db[moodboard.id] = moodboard
-                            moodboards_mtime[moodboard.id] = mtime
-                    seen_ids.add(moodboard_dir.name)
-                except (yaml.YAMLError, ValueError) as e:
-                    print(f"Error loading moodboard from {metadata_path}: {e}")
+    for moodboard_id in list_moodboard_ids():
+        if load_moodboard(moodboard_id):
+            seen_ids.add(moodboard_id)
 
     # Remove moodboards that no longer exist on disk
     removed = set(moodboards_db.keys()) - seen_ids
     for mid in removed:
         moodboards_db.pop(mid, None)
         moodboards_mtime.pop(mid, None)
+        moodboard_sections_lru.pop(mid, None)
+        forget_moodboard(mid)
+    moodboards_warm = True
+
+
+def _load_full_moodboard(moodboard_id: str) -> Moodboard:
+    """Parses a whole moodboard.yaml and replays its journal."""
+    moodboard_dir = MOODBOARDS_ROOT_DIR / moodboard_id
+    metadata_path = moodboard_dir / "moodboard.yaml"
+    with yaml_timer("moodboard", "load_sections"), open(metadata_path, "r") as f:
+        moodboard = Moodboard(**yaml.load(f, Loader=YAML_LOADER))
+    observe_yaml_size("moodboard", "load_sections", metadata_path.stat().st_size)
+    journal_path = moodboard_dir / JOURNAL_FILENAME
+    if journal_path.exists():
+        journal_entries[moodboard.id] = _replay_journal(moodboard, journal_path)
+    replace_references(moodboard.id, moodboard.sections)
+    return moodboard
+
+
+def _track_sections(mb: Moodboard):
+    """Marks the sections of `mb` as most recently used and enforces the budget."""
+    moodboard_dir = MOODBOARDS_ROOT_DIR / mb.id
+    try:
+        size = (moodboard_dir / "moodboard.yaml").stat().st_size
+        if mb.id in journal_entries:
+            size += (moodboard_dir / JOURNAL_FILENAME).stat().st_size
+    except OSError:
+        size = 0
+    moodboard_sections_lru[mb.id] = size
+    moodboard_sections_lru.move_to_end(mb.id)
+
+    budget = MOODBOARD_SECTIONS_CACHE_MB * 1024 * 1024
+    total = sum(moodboard_sections_lru.values())
+    for mid in list(moodboard_sections_lru):
+        if total <= budget:
+            break
+        if mid == mb.id:
+            continue
+        total -= moodboard_sections_lru.pop(mid)
+        evicted = moodboards_db.get(mid)
+        if evicted is not None:
+            evicted.sections = []
+        release_references(mid)
+
+
+def get_full_moodboard(moodboard_id: str) -> Optional[Moodboard]:
+    """
+    Returns a cached moodboard with its sections loaded (from disk if they
+    were not loaded yet or were evicted), or None if it doesn't exist. Use
+    `moodboards_db` directly only where the header is enough.
+    """
+    mb = find_moodboard(moodboard_id)
+    if mb is None:
+        return None
+    if moodboard_id in moodboard_sections_lru:
+        moodboard_sections_lru.move_to_end(moodboard_id)
+        return mb
+    full = _load_full_moodboard(moodboard_id)
+    # Keep the cached object (callers may hold it) and fill in the sections
+    mb.sections = full.sections
+    _track_sections(mb)
+    return mb
 
 
 def _recompute_cover_image_url(mb: Moodboard):
     """
-    Sets coverImageUrl to the url of the first image found in the first images
-    section that has images, else None.
+    Sets coverImageUrl (and the cover placeholder/dominant color) from the
+    first image found in the first images section that has images, else None.
     """
     for section in mb.sections:
         if section.type == "images" and section.images:
-            mb.coverImageUrl = section.images[0].url
+            cover = section.images[0]
+            mb.coverImageUrl = cover.url
+            mb.coverPlaceholder = cover.placeholder
+            mb.coverDominantColor = cover.dominantColor
             return
     mb.coverImageUrl = None
+    mb.coverPlaceholder = None
+    mb.coverDominantColor = None
+
+
+def _check_index(index: int, length: int, what: str):
+    if not 0 <= index < length:
+        raise ValueError(f"{what} index {index} out of range (0..{length - 1})")
+
+
+def _find_image(section, image_id: str) -> int:
+    for i, img in enumerate(section.images):
+        if img.id == image_id:
+            return i
+    raise ValueError(f"Image '{image_id}' not found in section")
+
+
+def apply_moodboard_ops(mb: Moodboard, ops) -> Tuple[List[str], List[str]]:
+    """
+    Applies section-level edits to `mb` in place, all or nothing: a ValueError
+    from any op leaves the moodboard untouched. Only the sections touched by
+    the ops are copied, so the cost is proportional to the edit, not to the
+    board. Returns the urls of images added to and removed from the board.
+    """
+    sections = list(mb.sections)
+    copied = set()  # ids of sections already copied in this batch
+    added: List[str] = []
+    removed: List[str] = []
+
+    def writable(index: int):
+        _check_index(index, len(sections), "Section")
+        section = sections[index]
+        if id(section) not in copied:
+            section = section.model_copy(update={"images": list(section.images)})
+            sections[index] = section
+            copied.add(id(section))
+        return section
+
+    for op in ops:
+        if isinstance(op, InsertSectionOp):
+            _check_index(op.index, len(sections) + 1, "Section")
+            section = op.section.model_copy(update={"images": list(op.section.images)})
+            sections.insert(op.index, section)
+            copied.add(id(section))
+            added.extend(img.url for img in section.images)
+        elif isinstance(op, MoveSectionOp):
+            _check_index(op.index, len(sections), "Section")
+            _check_index(op.to, len(sections), "Target section")
+            sections.insert(op.to, sections.pop(op.index))
+        elif isinstance(op, DeleteSectionOp):
+            _check_index(op.index, len(sections), "Section")
+            removed.extend(img.url for img in sections.pop(op.index).images)
+        elif isinstance(op, UpdateSectionOp):
+            section = writable(op.index)
+            if "text" in op.model_fields_set:
+                section.text = op.text
+            if "view" in op.model_fields_set:
+                section.view = op.view
+        elif isinstance(op, AddImageOp):
+            section = writable(op.section)
+            index = len(section.images) if op.index is None else op.index
+            _check_index(index, len(section.images) + 1, "Image")
+            section.images.insert(index, op.image)
+            added.append(op.image.url)
+        elif isinstance(op, RemoveImageOp):
+            section = writable(op.section)
+            removed.append(section.images.pop(_find_image(section, op.imageId)).url)
+        elif isinstance(op, MoveImageOp):
+            source = writable(op.section)
+            image = source.images.pop(_find_image(source, op.imageId))
+            target = source if op.toSection is None else writable(op.toSection)
+            _check_index(op.to, len(target.images) + 1, "Target image")
+            target.images.insert(op.to, image)
+        elif isinstance(op, UpdateImageOp):
+            section = writable(op.section)
+            index = _find_image(section, op.imageId)
+            section.images[index] = section.images[index].model_copy(
+                update={"description": op.description}
+            )
+
+    mb.sections = sections
+    return added, removed
+
+
+def save_moodboard_ops(mb: Moodboard, ops):
+    """
+    Persists already-applied section-level edits by appending them to the
+    moodboard's journal, bumping the version. Falls back to a full save when
+    the journal is due for compaction.
+    """
+    mb.version += 1
+    mb.lastUpdateDate = datetime.now()
+    _recompute_cover_image_url(mb)
+
+    if journal_entries.get(mb.id, 0) >= MAX_JOURNAL_ENTRIES:
+        _write_moodboard_yaml(mb)
+        _record_upsert(mb)
+        return
+
+    entry = {
+        "version": mb.version,
+        "lastUpdateDate": mb.lastUpdateDate.isoformat(),
+        "ops": [op.model_dump(mode="json", exclude_unset=True) for op in ops],
+    }
+    journal_path = MOODBOARDS_ROOT_DIR / mb.id / JOURNAL_FILENAME
+    with yaml_timer("moodboard", "journal_append"), open(journal_path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    journal_entries[mb.id] = journal_entries.get(mb.id, 0) + 1
+    moodboards_db[mb.id] = mb
+    _record_upsert(mb)
 
 
 def save_moodboard_metadata(mb: Moodboard):
     """
     Saves a moodboard object to its moodboard.yaml file and updates cache.
     """
+    mb.version += 1
+    _write_moodboard_yaml(mb)
+    _record_upsert(mb)
+
+
+def save_moodboard_header(mb: Moodboard):
+    """
+    Saves changed header fields (name, headerColor, ...) without loading the
+    sections: the `sections:` part of moodboard.yaml is kept as it is. With
+    a pending journal that part is stale, so the board is saved in full.
+    """
+    moodboard_dir = MOODBOARDS_ROOT_DIR / mb.id
+    metadata_path = moodboard_dir / "moodboard.yaml"
+    try:
+        with open(metadata_path, "r") as f:
+            text = f.read()
+    except OSError:
+        text = ""
+    # Never at the very start: the writers dump the sections last
+    start = text.find("\nsections:") + 1
+    if not start or (moodboard_dir / JOURNAL_FILENAME).exists():
+        save_moodboard_metadata(mb)
+        return
+
+    mb.version += 1
+    yaml_data = mb.model_dump(exclude_none=True, exclude={"sections"})
+    yaml_data["lastUpdateDate"] = mb.lastUpdateDate.isoformat()
+    with yaml_timer("moodboard", "save"), open(metadata_path, "w") as f:
+        yaml.dump(yaml_data, f, sort_keys=False)
+        f.write(text[start:])
+
+    stat = metadata_path.stat()
+    observe_yaml_size("moodboard", "save", stat.st_size)
+    moodboards_db[mb.id] = mb
+    moodboards_mtime[mb.id] = stat.st_mtime
+    _record_upsert(mb)
+
+
+def _record_upsert(mb: Moodboard):
+    schedule_preview(mb.id)
+    thumbnail = MoodboardThumbnail.from_moodboard(mb, preview_urls(mb.id))
+    record_change("moodboard", mb.id, "upsert", thumbnail.model_dump())
+
+
+def _write_moodboard_yaml(mb: Moodboard):
+    """
+    Writes the full moodboard.yaml and truncates the ops journal, which is
+    fully contained in it from now on.
+    """
     moodboard_dir = MOODBOARDS_ROOT_DIR / mb.id
     moodboard_dir.mkdir(parents=True, exist_ok=True)
     (moodboard_dir / "attached_photos").mkdir(exist_ok=True)
 
-    _recompute_cover_image_url(mb)
-
     metadata_path = moodboard_dir / "moodboard.yaml"
+    if mb.id not in moodboard_sections_lru and metadata_path.exists():
+        # Sections were never loaded (or evicted): writing now would drop them
+        mb.sections = _load_full_moodboard(mb.id).sections
+
+    _recompute_cover_image_url(mb)
     yaml_data = mb.model_dump(exclude_none=True)
     # Convert datetime objects to string for YAML serialization
     if "lastUpdateDate" in yaml_data and hasattr(
@@ -76,24 +433,37 @@ def save_moodboard_metadata(mb: Moodboard):
     ):
         yaml_data["lastUpdateDate"] = yaml_data["lastUpdateDate"].isoformat()
 
-    with open(metadata_path, "w") as f:
+    with yaml_timer("moodboard", "save"), open(metadata_path, "w") as f:
         yaml.dump(yaml_data, f, sort_keys=False)
 
     # Update cache + mtime
+    stat = metadata_path.stat()
+    observe_yaml_size("moodboard", "save", stat.st_size)
     moodboards_db[mb.id] = mb
-    moodboards_mtime[mb.id] = metadata_path.stat().st_mtime
+    moodboards_mtime[mb.id] = stat.st_mtime
+
+    journal_path = moodboard_dir / JOURNAL_FILENAME
+    if journal_path.exists():
+        journal_path.unlink()
+    journal_entries.pop(mb.id, None)
+    _track_sections(mb)
 
 
 def purge_moodboard(mb: Moodboard):
     moodboard_dir = MOODBOARDS_ROOT_DIR / mb.id
-    if os.path.exists(moodboard_dir) and os.path.isdir(moodboard_dir):
-        shutil.rmtree(moodboard_dir)
+    # Checked first: with local storage, delete_prefix removes the directory
+    existed = os.path.isdir(moodboard_dir)
+    media_storage.delete_prefix(f"moodboard-media/{mb.id}")
+    if existed:
+        shutil.rmtree(moodboard_dir, ignore_errors=True)
         print(f"Removed: {moodboard_dir}")
     else:
         print("Directory does not exist")
     moodboards_db.pop(mb.id, None)
     moodboards_mtime.pop(mb.id, None)
+    journal_entries.pop(mb.id, None)
+    moodboard_sections_lru.pop(mb.id, None)
+    forget_moodboard(mb.id)
+    forget_preview(mb.id)
+    record_change("moodboard", mb.id, "delete")
 
-
-# Load any existing moodboards on startup
-load_moodboards_from_filesystem()
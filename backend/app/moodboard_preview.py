@@ -0,0 +1,306 @@
+"""
+Pre-rendered preview images of moodboards.
+
+Every moodboard gets two collages of its first images, laid out by section
+(one row per images section, split like its view: one image per row for
+"list", several for "grid" and scrollers):
+
+* the preview (PREVIEW_SIZE), for the moodboard list,
+* the card (CARD_SIZE), with the name on a band in the header colour, used
+  as Open Graph image of shared links (see `open_graph_tags`).
+
+They are composed from the stored attachments (at most 1920px, decoded at
+a reduced scale), never from originals. Saving a moodboard schedules a
+re-render PREVIEW_DEBOUNCE_SECONDS later, so a burst of edits renders once;
+the background task `render_previews` does the work. A render is skipped if
+nothing it shows changed (e.g. text edits).
+
+The files are named after a hash of their content's inputs, below
+`/moodboard-media/<id>/preview/`, so their urls never change meaning and are
+served as immutable. The urls are announced through MoodboardThumbnail
+(`previewUrl`, `cardUrl`) and the change feed.
+"""
+import asyncio
+import hashlib
+import html
+import io
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont, ImageOps
+
+from app.config import MOODBOARDS_ROOT_DIR, PREVIEW_DEBOUNCE_SECONDS
+from app.storage import is_media_key, media_key, media_storage
+
+PREVIEW_SIZE = (800, 500)
+CARD_SIZE = (1200, 630)  # the Open Graph recommendation
+CARD_HEADER_HEIGHT = 96
+GAP = 6
+MAX_ROWS = 3
+IMAGES_PER_ROW = {"list": 1, "grid": 4}
+DEFAULT_IMAGES_PER_ROW = 5  # horizontal scrollers
+BACKGROUND = (3, 7, 18)
+PREVIEW_QUALITY = 82
+# Bump when the rendering changes, so that all previews are redrawn
+RENDER_VERSION = 1
+# Edits keep postponing the render, but not for longer than this
+MAX_DELAY_SECONDS = 60
+
+PREVIEW_DIR = "preview"
+STATE_FILENAME = "preview.json"
+CHECK_INTERVAL_SECONDS = 1
+
+# moodboard_id -> {"signature": ...} of the current files (None: the board
+# shows no images), None if it wasn't rendered yet
+_previews: Dict[str, Optional[dict]] = {}
+# moodboard_id -> (render at, first scheduled at), in time.monotonic()
+_due: Dict[str, Tuple[float, float]] = {}
+
+
+def _preview_dir(moodboard_id: str) -> Path:
+    return MOODBOARDS_ROOT_DIR / moodboard_id / PREVIEW_DIR
+
+
+def _urls(moodboard_id: str, signature: str) -> dict:
+    base = f"/moodboard-media/{moodboard_id}/{PREVIEW_DIR}"
+    return {"previewUrl": f"{base}/preview_{signature}.jpg", "cardUrl": f"{base}/card_{signature}.jpg"}
+
+
+def schedule_preview(moodboard_id: str):
+    """Renders the moodboard's previews once it wasn't saved for a while."""
+    now = time.monotonic()
+    first = _due.get(moodboard_id, (now, now))[1]
+    _due[moodboard_id] = (min(now + PREVIEW_DEBOUNCE_SECONDS, first + MAX_DELAY_SECONDS), first)
+
+
+def forget_preview(moodboard_id: str):
+    _previews.pop(moodboard_id, None)
+    _due.pop(moodboard_id, None)
+
+
+def _state(moodboard_id: str) -> Optional[dict]:
+    if moodboard_id not in _previews:
+        try:
+            with open(_preview_dir(moodboard_id) / STATE_FILENAME) as f:
+                _previews[moodboard_id] = json.load(f)
+        except (OSError, ValueError):
+            _previews[moodboard_id] = None
+    return _previews[moodboard_id]
+
+
+def preview_urls(moodboard_id: str) -> dict:
+    """`previewUrl` and `cardUrl` of a moodboard; empty while it has none yet."""
+    state = _state(moodboard_id)
+    if state is None:
+        # Boards from before previews existed, restored ones, ...
+        if moodboard_id not in _due:
+            schedule_preview(moodboard_id)
+        return {}
+    if state["signature"] is None:
+        return {}
+    return _urls(moodboard_id, state["signature"])
+
+
+def _layout(mb) -> List[List[Tuple[str, float]]]:
+    """Rows of (attachment key, aspect ratio) shown in the previews."""
+    rows = []
+    for section in mb.sections:
+        if section.type != "images":
+            continue
+        images = [img for img in section.images if is_media_key(media_key(img.url))]
+        per_row = IMAGES_PER_ROW.get(section.view, DEFAULT_IMAGES_PER_ROW)
+        for start in range(0, len(images), per_row):
+            rows.append(
+                [
+                    (media_key(img.url), img.width / img.height if img.width and img.height else 1.5)
+                    for img in images[start : start + per_row]
+                ]
+            )
+            if len(rows) == MAX_ROWS:
+                return rows
+    return rows
+
+
+def _signature(mb, rows) -> Optional[str]:
+    if not rows:
+        return None  # nothing worth a preview: clients show the cover
+    data = [RENDER_VERSION, mb.name, mb.headerColor, rows]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()[:16]
+
+
+def _hex_color(value: str, default=(17, 24, 39)):
+    try:
+        return ImageColor.getrgb(value)[:3]
+    except ValueError:
+        return default
+
+
+class _Sources:
+    """Attachments decoded once per render, at the scale the largest collage needs."""
+
+    def __init__(self, max_height: int):
+        self.max_height = max_height
+        self.images: Dict[str, Optional[Image.Image]] = {}
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        if key not in self.images:
+            try:
+                with media_storage.open_read(key) as f:
+                    img = Image.open(io.BytesIO(f.read()))
+                    # JPEGs decode directly at 1/2, 1/4 or 1/8 scale
+                    img.draft("RGB", (self.max_height * 4, self.max_height))
+                    self.images[key] = img.convert("RGB")
+            except Exception as e:  # deleted meanwhile, unreadable, ...
+                print(f"Preview: skipping {key}: {e}")
+                self.images[key] = None
+        return self.images[key]
+
+
+def _collage(canvas: Image.Image, box: Tuple[int, int, int, int], rows, sources: _Sources):
+    """Lays `rows` out in `box` of `canvas`: equal row heights, widths by aspect ratio."""
+    left, top, right, bottom = box
+    if not rows:
+        return
+    row_height = (bottom - top - GAP * (len(rows) + 1)) // len(rows)
+    y = top + GAP
+    for row in rows:
+        available = right - left - GAP * (len(row) + 1)
+        total = sum(aspect for _, aspect in row)
+        x = left + GAP
+        for i, (key, aspect) in enumerate(row):
+            # The last image takes the rounding remainder
+            width = right - GAP - x if i == len(row) - 1 else round(available * aspect / total)
+            img = sources.get(key)
+            if img is not None and width > 0 and row_height > 0:
+                canvas.paste(ImageOps.fit(img, (width, row_height), Image.LANCZOS), (x, y))
+            x += width + GAP
+        y += row_height + GAP
+
+
+def _font(size: int):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1: fixed-size bitmap font
+        return ImageFont.load_default()
+
+
+def _render(mb, rows) -> Tuple[bytes, bytes]:
+    """(preview, card) JPEGs."""
+    sources = _Sources(CARD_SIZE[1])
+
+    preview = Image.new("RGB", PREVIEW_SIZE, BACKGROUND)
+    _collage(preview, (0, 0, *PREVIEW_SIZE), rows, sources)
+
+    card = Image.new("RGB", CARD_SIZE, BACKGROUND)
+    header = _hex_color(mb.headerColor)
+    draw = ImageDraw.Draw(card)
+    draw.rectangle((0, 0, CARD_SIZE[0], CARD_HEADER_HEIGHT), fill=header)
+    # Light text on dark header colours, dark text on light ones
+    luma = 0.299 * header[0] + 0.587 * header[1] + 0.114 * header[2]
+    name = mb.name if len(mb.name) <= 48 else mb.name[:47] + "…"
+    draw.text(
+        (32, CARD_HEADER_HEIGHT // 2),
+        name,
+        fill=(255, 255, 255) if luma < 150 else (17, 24, 39),
+        font=_font(48),
+        anchor="lm",
+    )
+    _collage(card, (0, CARD_HEADER_HEIGHT, *CARD_SIZE), rows, sources)
+
+    encoded = []
+    for img in (preview, card):
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=PREVIEW_QUALITY, optimize=True, progressive=True)
+        encoded.append(out.getvalue())
+    return encoded[0], encoded[1]
+
+
+def _store(moodboard_id: str, signature: Optional[str], rendered: Optional[Tuple[bytes, bytes]]):
+    """
+    Writes the files and makes them current; older ones but the previous are
+    removed. None if the moodboard was purged meanwhile: its directory isn't
+    created again.
+    """
+    directory = _preview_dir(moodboard_id)
+    try:
+        directory.mkdir(exist_ok=True)
+        if rendered is not None:
+            preview, card = rendered
+            for name, data in ((f"preview_{signature}.jpg", preview), (f"card_{signature}.jpg", card)):
+                temp = directory / f".{name}.tmp"
+                temp.write_bytes(data)
+                os.replace(temp, directory / name)
+        previous = (_previews.get(moodboard_id) or {}).get("signature")
+        state = {"signature": signature, "previous": previous}
+        temp = directory / f".{STATE_FILENAME}.tmp"
+        temp.write_text(json.dumps(state))
+        os.replace(temp, directory / STATE_FILENAME)
+    except FileNotFoundError:
+        return None
+    # Pages loaded just before still show the previous files
+    for path in directory.glob("*.jpg"):
+        if path.stem.split("_", 1)[-1] not in (signature, previous):
+            path.unlink(missing_ok=True)
+    return state
+
+
+async def render_preview(moodboard_id: str) -> bool:
+    """Re-renders the previews of one moodboard if what they show changed."""
+    from app.changes import record_change
+    from app.models import MoodboardThumbnail
+    from app.moodboard_db import get_full_moodboard
+
+    mb = get_full_moodboard(moodboard_id)
+    if mb is None:
+        forget_preview(moodboard_id)
+        return False
+    # Laid out here, on the event loop: the sections may change meanwhile
+    rows = _layout(mb)
+    signature = _signature(mb, rows)
+    state = _state(moodboard_id)
+    if state is not None and state["signature"] == signature:
+        return False
+    rendered = await asyncio.to_thread(_render, mb, rows) if rows else None
+    stored = await asyncio.to_thread(_store, moodboard_id, signature, rendered)
+    if stored is None:
+        forget_preview(moodboard_id)
+        return False
+    _previews[moodboard_id] = stored
+    if moodboard_id in _due:
+        return True  # saved again while rendering: announced after the next render
+    thumbnail = MoodboardThumbnail.from_moodboard(mb, preview_urls(moodboard_id))
+    record_change("moodboard", moodboard_id, "upsert", thumbnail.model_dump())
+    return True
+
+
+async def render_previews():
+    """Background task: renders the previews that are due."""
+    while True:
+        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+        now = time.monotonic()
+        for moodboard_id in [mid for mid, (at, _) in _due.items() if at <= now]:
+            _due.pop(moodboard_id, None)
+            try:
+                await render_preview(moodboard_id)
+            except Exception as e:
+                print(f"Could not render the preview of moodboard {moodboard_id}: {e}")
+
+
+def open_graph_tags(mb, base_url: str) -> str:
+    """<meta> tags describing a shared moodboard link, with its card as image."""
+    tags = [("property", "og:type", "website"), ("property", "og:title", mb.name)]
+    card_url = preview_urls(mb.id).get("cardUrl")
+    if card_url:
+        tags += [
+            ("property", "og:image", base_url.rstrip("/") + card_url),
+            ("property", "og:image:width", str(CARD_SIZE[0])),
+            ("property", "og:image:height", str(CARD_SIZE[1])),
+            ("name", "twitter:card", "summary_large_image"),
+        ]
+    return "".join(
+        f'<meta {attribute}="{name}" content="{html.escape(value, quote=True)}" />\n'
+        for attribute, name, value in tags
+    )
@@ -0,0 +1,43 @@
+import base64
+import io
+from typing import Tuple
+
+from PIL import Image
+
+# Longest side of the inline placeholder. At this size a WebP data URI is
+# ~100-150 bytes, small enough to embed for every image in a gallery response.
+PLACEHOLDER_SIZE = (16, 16)
+PLACEHOLDER_QUALITY = 40
+
+# Number of palette entries considered when picking the dominant color.
+DOMINANT_PALETTE_SIZE = 5
+
+
+def compute_placeholder(img: Image.Image) -> Tuple[str, str]:
+    """
+    Computes a tiny inline placeholder (a base64 WebP data URI) and the
+    dominant color (as "#rrggbb") of an image.
+
+    Expects an already-downscaled image (e.g. the 400px thumbnail) so that
+    no extra work is spent on the full-resolution original.
+    """
+    rgb = img.convert("RGB")
+
+    tiny = rgb.copy()
+    tiny.thumbnail(PLACEHOLDER_SIZE)
+    buffer = io.BytesIO()
+    tiny.save(buffer, "WEBP", quality=PLACEHOLDER_QUALITY)
+    placeholder = "data:image/webp;base64," + base64.b64encode(
+        buffer.getvalue()
+    ).decode("ascii")
+
+    # Quantize a small copy and take the most frequent palette entry.
+    sample = rgb.copy()
+    sample.thumbnail((64, 64))
+    quantized = sample.quantize(colors=DOMINANT_PALETTE_SIZE)
+    palette = quantized.getpalette()
+    _, index = max(quantized.getcolors())
+    r, g, b = palette[index * 3 : index * 3 + 3]
+    dominant_color = f"#{r:02x}{g:02x}{b:02x}"
+
+    return placeholder, dominant_color
@@ -0,0 +1,193 @@
+import asyncio
+import cProfile
+import io
+import json
+import pstats
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from app.apikeys import key_manager
+from app.config import (
+    PROFILER,
+    PROFILING_DIR,
+    PROFILING_SAMPLE_RATE,
+    SLOW_REQUEST_THRESHOLD_MS,
+)
+from app.metrics import route_template
+
+try:
+    from pyinstrument import Profiler as PyinstrumentProfiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:  # optional dependency
+    PyinstrumentProfiler = None
+
+SLOW_LOG_FILENAME = "slow_requests.log"
+TOP_FUNCTIONS = 8
+
+# Only one profiler can be active at a time; concurrent requests that would
+# also be profiled are just timed instead.
+_profiler_busy = threading.Lock()
+
+
+def _wants_profile(scope) -> bool:
+    """A request is profiled when sampled or when it asks for it with a valid key."""
+    headers = dict(scope.get("headers", []))
+    if headers.get(b"x-profile"):
+        api_key = headers.get(b"x-api-key", b"").decode("latin-1")
+        return key_manager.verify(api_key)
+    return PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE
+
+
+def _profile_name(method: str, route: str) -> str:
+    slug = re.sub(r"[^a-zA-Z0-9]+", "_", route).strip("_") or "root"
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    return f"{stamp}_{method}_{slug}"
+
+
+def _top_functions(stats: pstats.Stats) -> List[dict]:
+    """Hottest functions by own time from a cProfile run."""
+    rows = []
+    for (filename, line, func), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append(
+            {
+                "function": f"{filename}:{line}({func})",
+                "calls": ncalls,
+                "tottime_ms": round(tottime * 1000, 3),
+                "cumtime_ms": round(cumtime * 1000, 3),
+            }
+        )
+    rows.sort(key=lambda row: row["tottime_ms"], reverse=True)
+    return rows[:TOP_FUNCTIONS]
+
+
+def _write_cprofile(profiler: cProfile.Profile, name: str) -> List[dict]:
+    """
+    Dumps a .prof file (open with snakeviz, or turn into a flamegraph with
+    flameprof / gprof2dot) and returns the top functions.
+    """
+    PROFILING_DIR.mkdir(parents=True, exist_ok=True)
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    stats.dump_stats(PROFILING_DIR / f"{name}.prof")
+    return _top_functions(stats)
+
+
+def _write_pyinstrument(profiler, name: str) -> List[dict]:
+    """Writes a speedscope JSON flamegraph and returns the top frames."""
+    PROFILING_DIR.mkdir(parents=True, exist_ok=True)
+    session = profiler.last_session
+    with open(PROFILING_DIR / f"{name}.speedscope.json", "w") as f:
+        f.write(SpeedscopeRenderer().render(session))
+
+    own_time = {}
+    root = session.root_frame()
+    stack = [root] if root else []
+    while stack:
+        frame = stack.pop()
+        stack.extend(frame.children)
+        # Synthetic "[self]"/"[await]" frames are already included in their
+        # parent's total_self_time.
+        if frame.is_synthetic:
+            continue
+        key = f"{frame.file_path}:{frame.line_no}({frame.function})"
+        own_time[key] = own_time.get(key, 0.0) + frame.total_self_time
+    top = sorted(own_time.items(), key=lambda item: item[1], reverse=True)
+    return [
+        {"function": function, "tottime_ms": round(seconds * 1000, 3)}
+        for function, seconds in top[:TOP_FUNCTIONS]
+    ]
+
+
+def _log_slow_request(entry: dict):
+    PROFILING_DIR.mkdir(parents=True, exist_ok=True)
+    with open(PROFILING_DIR / SLOW_LOG_FILENAME, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    print(
+        f"Slow request: {entry['method']} {entry['route']} took {entry['duration_ms']} ms"
+    )
+
+
+class ProfilingMiddleware:
+    """
+    Opt-in ASGI middleware that profiles sampled requests (or requests sent
+    with `X-Profile: 1` and a valid `X-Api-Key`) and logs every request slower
+    than SLOW_REQUEST_THRESHOLD_MS, including its hottest functions when it
+    was profiled. Only installed when PROFILING_ENABLED is set, so it costs
+    nothing otherwise.
+
+    Note that cProfile records everything running on the event loop thread
+    while the request is in flight, including other concurrent requests;
+    pyinstrument's async mode attributes time to the profiled task only.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.use_pyinstrument = PROFILER == "pyinstrument"
+        if self.use_pyinstrument and PyinstrumentProfiler is None:
+            print("Warning: PROFILER=pyinstrument but pyinstrument is not installed; using cProfile.")
+            self.use_pyinstrument = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profiler = None
+        profile_name: Optional[str] = None
+        if _wants_profile(scope) and _profiler_busy.acquire(blocking=False):
+            if self.use_pyinstrument:
+                profiler = PyinstrumentProfiler(async_mode="enabled")
+                start_profiler, stop_profiler = profiler.start, profiler.stop
+            else:
+                profiler = cProfile.Profile()
+                start_profiler, stop_profiler = profiler.enable, profiler.disable
+            profile_name = _profile_name(scope["method"], scope["path"])
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile_name.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                try:
+                    start_profiler()
+                except Exception as e:  # e.g. another profiler is already active
+                    print(f"Could not start the profiler: {e}")
+                    _profiler_busy.release()
+                    profiler = profile_name = None
+            if profiler is None:
+                await self.app(scope, receive, send)
+            else:
+                try:
+                    await self.app(scope, receive, send_wrapper)
+                finally:
+                    stop_profiler()
+                    _profiler_busy.release()
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            await self._record(scope, profiler, profile_name, duration_ms)
+
+    async def _record(self, scope, profiler, profile_name, duration_ms: float):
+        top: List[dict] = []
+        if profiler is not None:
+            writer = _write_pyinstrument if self.use_pyinstrument else _write_cprofile
+            top = await asyncio.to_thread(writer, profiler, profile_name)
+
+        if duration_ms >= SLOW_REQUEST_THRESHOLD_MS:
+            entry = {
+                "time": datetime.now().isoformat(),
+                "method": scope["method"],
+                "route": route_template(scope),
+                "path": scope["path"],
+                "duration_ms": round(duration_ms, 1),
+                "profile": profile_name,
+                "top_functions": top,
+            }
+            await asyncio.to_thread(_log_slow_request, entry)
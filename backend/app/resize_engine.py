@@ -0,0 +1,169 @@
+"""
+Engines producing the resized renditions of uploaded images.
+
+* `PillowEngine` (RESIZE_ENGINE=pillow, the default) decodes the whole
+  original and resizes copies of it.
+* `VipsEngine` (RESIZE_ENGINE=vips) uses libvips' thumbnail operation:
+  every rendition is shrunk while loading (JPEGs are decoded at 1/2 - 1/8
+  scale, other formats streamed), so the full-resolution original is
+  never held in memory, and the work runs when the rendition is encoded,
+  in a worker thread. Needs `pip install pyvips` and libvips.
+
+Both fit renditions into the requested box without enlarging and keep the
+orientation as stored (no EXIF rotation), so file names, `ImageSizes` and
+dimensions are the same whichever engine is configured.
+
+    with resize_engine.open(source) as original:   # bytes or a Path
+        original.size                              # from the header
+        original.load()                            # decode, if the engine does
+        small = original.resize(SMALL_SIZE)
+        small.save_jpeg(out_file, "small")         # see app.jpeg_encoder
+        small.to_pil()                             # e.g. for placeholders
+"""
+import io
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple, Union
+
+from PIL import Image
+
+from app.config import RESIZE_ENGINE, SMALL_SIZE
+from app.jpeg_encoder import encode_jpeg
+
+try:
+    import pyvips
+except (ImportError, OSError):  # optional dependency, only needed for RESIZE_ENGINE=vips
+    pyvips = None
+
+Source = Union[bytes, Path]
+
+
+class PillowRendition:
+    def __init__(self, img: Image.Image):
+        self.img = img
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.img.size
+
+    def save_jpeg(self, out_file: BinaryIO, rendition: str):
+        out_file.write(encode_jpeg(self.img, rendition))
+
+    def to_pil(self) -> Image.Image:
+        return self.img
+
+
+class PillowOriginal:
+    def __init__(self, source: Source):
+        self.img = Image.open(source if isinstance(source, Path) else io.BytesIO(source))
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.img.size
+
+    def load(self):
+        self.img.load()
+
+    def resize(self, box: Tuple[int, int], reuse: bool = False) -> PillowRendition:
+        """
+        The image fitted into `box`. With `reuse` the original itself is
+        resized (it can't be used afterwards); if it wasn't loaded yet JPEGs
+        are then decoded in draft mode at a reduced scale.
+        """
+        img = self.img if reuse else self.img.copy()
+        img.thumbnail(box)
+        return PillowRendition(img)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.img.close()
+
+
+class PillowEngine:
+    name = "pillow"
+
+    def open(self, source: Source) -> PillowOriginal:
+        return PillowOriginal(source)
+
+    def memory_estimate(self, width: int, height: int, bands: int, copies: int) -> int:
+        """Decoded bytes processing an image takes at its peak."""
+        return copies * width * height * bands
+
+
+class VipsRendition:
+    def __init__(self, image):
+        self.image = image
+        self._img: Optional[Image.Image] = None
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.image.width, self.image.height
+
+    def to_pil(self) -> Image.Image:
+        if self._img is None:
+            # Runs the whole (lazy) pipeline once: load with shrink, resize
+            mode = "L" if self.image.bands == 1 else "RGB"
+            self._img = Image.frombytes(mode, self.size, self.image.write_to_memory())
+        return self._img
+
+    def save_jpeg(self, out_file: BinaryIO, rendition: str):
+        out_file.write(encode_jpeg(self.to_pil(), rendition))
+
+
+class VipsOriginal:
+    def __init__(self, source: Source):
+        self.source = source
+        if isinstance(source, Path):
+            self.header = pyvips.Image.new_from_file(str(source), access="sequential")
+        else:
+            self.header = pyvips.Image.new_from_buffer(source, "", access="sequential")
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.header.width, self.header.height
+
+    def load(self):
+        pass  # decoded per rendition, shrinking on load
+
+    def resize(self, box: Tuple[int, int], reuse: bool = False) -> VipsRendition:
+        options = dict(height=box[1], size="down", no_rotate=True)
+        if isinstance(self.source, Path):
+            image = pyvips.Image.thumbnail(str(self.source), box[0], **options)
+        else:
+            image = pyvips.Image.thumbnail_buffer(self.source, box[0], **options)
+        if image.hasalpha():
+            image = image.flatten(background=255)
+        if image.interpretation not in ("srgb", "b-w"):
+            image = image.colourspace("srgb")
+        if image.format != "uchar":
+            image = image.cast("uchar")
+        return VipsRendition(image)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class VipsEngine:
+    name = "vips"
+
+    def __init__(self):
+        if pyvips is None:
+            raise RuntimeError("RESIZE_ENGINE=vips needs pyvips and libvips: pip install pyvips")
+        # Keep libvips' operation cache from holding on to decoded uploads
+        pyvips.cache_set_max(0)
+
+    def open(self, source: Source) -> VipsOriginal:
+        return VipsOriginal(source)
+
+    def memory_estimate(self, width: int, height: int, bands: int, copies: int) -> int:
+        # Shrink-on-load decodes at no more than about twice the largest
+        # rendition per side
+        largest = 4 * SMALL_SIZE[0] * SMALL_SIZE[1]
+        return copies * min(width * height, largest) * bands
+
+
+resize_engine = VipsEngine() if RESIZE_ENGINE == "vips" else PillowEngine()
@@ -0,0 +1,121 @@
+"""
+Library export and restore over HTTP (see app.backup).
+
+Both are POST so they need an API key. The export streams the tar while it
+is written by a worker thread, bounded by a small queue: a slow client
+slows the export down instead of it being buffered, and a disconnect stops
+it. The import likewise feeds the request body to the restore as it arrives.
+"""
+import asyncio
+import tarfile
+import threading
+from typing import Optional
+
+from fastapi import APIRouter, Body, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from app.backup import MANIFEST_FORMAT, ChunkQueue, export_library, new_touched, reload_caches, restore_archive
+from app.config import BACKUP_RATE_LIMIT_MB
+
+router = APIRouter()
+
+# Cache reloads after interrupted imports, referenced until they are done
+_reloads = set()
+
+
+async def _reload_after(restore: asyncio.Task, touched: dict):
+    try:
+        await restore
+    except Exception as e:
+        print(f"Import interrupted: {e}")
+    finally:
+        await asyncio.to_thread(reload_caches, touched)
+        _reloads.discard(asyncio.current_task())
+
+
+@router.post("/export", summary="Export the library as a tar stream")
+async def export(
+    derivatives: bool = False,
+    rate_limit_mb: Optional[float] = None,
+    previous: Optional[dict] = Body(default=None),
+):
+    """
+    Streams galleries and moodboards (metadata and originals, with
+    `derivatives` also the small and thumbnail renditions) as a tar. With the
+    manifest.json of a previous export as the body, only what changed since
+    is included. The new manifest is the last member of the tar.
+    `rate_limit_mb` (MB/s) overrides BACKUP_RATE_LIMIT_MB.
+    """
+    if previous is not None and previous.get("format") != MANIFEST_FORMAT:
+        raise HTTPException(status_code=400, detail="Body is not a manifest of this export format")
+    rate = (BACKUP_RATE_LIMIT_MB if rate_limit_mb is None else rate_limit_mb) * 1024 * 1024
+    pipe = ChunkQueue()
+
+    def produce():
+        try:
+            export_library(pipe, previous, derivatives, rate)
+            pipe.finish()
+        except BrokenPipeError:
+            print("Export cancelled: client went away")
+        except Exception as e:
+            print(f"Export failed: {e}")
+            try:
+                pipe.put(e)
+            except BrokenPipeError:
+                pass
+
+    async def chunks():
+        thread = threading.Thread(target=produce, name="export", daemon=True)
+        thread.start()
+        try:
+            while (chunk := await asyncio.to_thread(pipe.get)) is not None:
+                if isinstance(chunk, Exception):
+                    # Aborts the response: the client gets an error, not a truncated tar
+                    raise RuntimeError("Export failed") from chunk
+                yield chunk
+        finally:
+            pipe.closed_by_peer.set()
+
+    return StreamingResponse(
+        chunks(),
+        media_type="application/x-tar",
+        headers={"Content-Disposition": 'attachment; filename="photopia-export.tar"'},
+    )
+
+
+@router.post("/import", summary="Restore an exported tar stream")
+async def import_archive(request: Request):
+    """
+    Restores a full export, or an incremental one on top of the state it was
+    made against, and reloads the caches. Returns what was restored.
+    """
+    pipe = ChunkQueue()
+    touched = new_touched()
+    restore = asyncio.create_task(asyncio.to_thread(restore_archive, pipe, touched))
+    # Once the restore stopped (done or failed) the rest of the body is dropped
+    restore.add_done_callback(lambda _: pipe.closed_by_peer.set())
+    try:
+        try:
+            async for chunk in request.stream():
+                if chunk:
+                    await asyncio.to_thread(pipe.put, chunk)
+            await asyncio.to_thread(pipe.put, None)
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            pipe.abort()  # e.g. the client disconnected mid-upload
+            _reloads.add(asyncio.create_task(_reload_after(restore, touched)))
+            raise
+        await restore
+    except (ValueError, tarfile.TarError, EOFError) as e:
+        # What was restored before the failure stays on disk: the caches follow it
+        await asyncio.to_thread(reload_caches, touched)
+        detail = str(e) if isinstance(e, ValueError) else f"Invalid archive: {e}"
+        raise HTTPException(status_code=400, detail=detail)
+    await asyncio.to_thread(reload_caches, touched)
+    return {
+        "galleries": sorted(touched["galleries"]),
+        "moodboards": sorted(touched["moodboards"]),
+        "files": touched["files"],
+        "deleted": touched["deleted"],
+    }
@@ -0,0 +1,85 @@
+"""
+Delta sync of the gallery and moodboard lists (see app.changes).
+
+A client loads the lists once, remembers `version` and from then on asks
+for the changes since it, either by polling `GET /changes?since=N` or by
+keeping `GET /changes/stream` open. With `resync: true` (the client is
+behind the compacted log) it refetches the lists and continues from the
+returned version.
+"""
+import asyncio
+import json
+import time
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from app.changes import change_log, wait_for_change
+
+# Comment line sent on idle streams so proxies don't close them
+KEEPALIVE_SECONDS = 15
+
+router = APIRouter()
+
+
+@router.get("/changes", summary="Gallery and moodboard changes since a version")
+async def get_changes(since: Optional[int] = None):
+    """
+    Returns `{"version", "changes", "resync"}`. Without `since` only the
+    current version is returned, to start syncing from.
+    """
+    await asyncio.to_thread(change_log.refresh)
+    if since is None:
+        return {"version": change_log.version, "changes": [], "resync": False}
+    version, changes, resync = change_log.since(since)
+    return {"version": version, "changes": changes, "resync": resync}
+
+
+def _event(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    lines = [f"event: {event}", f"data: {json.dumps(data)}"]
+    if event_id is not None:
+        lines.insert(0, f"id: {event_id}")
+    return "\n".join(lines) + "\n\n"
+
+
+@router.get("/changes/stream", summary="Server-sent events of gallery and moodboard changes")
+async def stream_changes(request: Request, since: Optional[int] = None):
+    """
+    Streams `change` events (id = version) from `since` on, or from the
+    current version. Reconnecting browsers resume from `Last-Event-ID`. A
+    `resync` event tells the client to refetch the lists.
+    """
+    last_event_id = request.headers.get("Last-Event-ID")
+    if last_event_id is not None:
+        try:
+            since = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    await asyncio.to_thread(change_log.refresh)
+    version = change_log.version if since is None else since
+
+    async def events():
+        nonlocal version
+        yield "retry: 3000\n\n"
+        last_sent = time.monotonic()
+        while not await request.is_disconnected():
+            current, changes, resync = change_log.since(version)
+            if resync:
+                yield _event("resync", {"version": current}, current)
+                version = current
+                last_sent = time.monotonic()
+            for change in changes:
+                yield _event("change", change, change["v"])
+                version = change["v"]
+                last_sent = time.monotonic()
+            if time.monotonic() - last_sent >= KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            await wait_for_change(KEEPALIVE_SECONDS)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
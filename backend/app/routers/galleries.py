@@ -1,31 +1,51 @@
-import os
+import asyncio
 import uuid
 import shutil
+import threading
 import zipfile
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set, Union
 from datetime import datetime
-from fastapi import APIRouter, HTTPException, status, File, UploadFile, BackgroundTasks
-from fastapi.responses import FileResponse
-from PIL import Image
-from aiofiles import open as aio_open
+from fastapi import APIRouter, HTTPException, Request, status, File, UploadFile, BackgroundTasks
+from fastapi.responses import Response
 
 # Local imports from our new file structure
 from app.models import Gallery, GalleryThumbnail, ImageModel, GalleryData, ImageSizes
+from app.image_table import GalleryRecord
 from app.database import (
     delete_gallery_image,
+    find_gallery,
     galleries_db,
     purge_gallery,
     save_gallery_metadata,
     update_gallery_meta,
 )
 from app.config import GALLERIES_ROOT_DIR, THUMB_SIZE, SMALL_SIZE
+from app.admission import admit_upload
+from app.resize_engine import resize_engine
+from app.storage import media_storage
+from app.usage import usage_ledger
+from app.file_offload import file_response
 from app.utils import generate_readable_id
+from app.placeholders import compute_placeholder
+from app.contact_sheet import get_contact_sheet
+from app.metrics import UPLOADED_BYTES, ZIP_BUILD_DURATION, upload_stage
 
 # Create a new API router
 router = APIRouter()
 
 
+def _gallery_response(gallery: GalleryRecord, status_code: int = 200) -> Response:
+    """
+    Serializes a cached gallery directly from its image table. Returning a
+    Response skips FastAPI's re-validation against `response_model`, which
+    still documents the schema.
+    """
+    return Response(
+        content=gallery.to_json(), status_code=status_code, media_type="application/json"
+    )
+
+
 # --- API Endpoints ---
 @router.get(
     "/galleries",
@@ -48,11 +68,11 @@ async def delete_gallery(gallery_id: str):
     """
     Returns a specific gallery by its ID.
     """
-    gallery = galleries_db.get(gallery_id)
+    gallery = find_gallery(gallery_id)
     if not gallery:
         raise HTTPException(status_code=404, detail="Gallery not found")
     purge_gallery(gallery)
-    return gallery
+    return _gallery_response(gallery)
 
 
 @router.put(
@@ -64,7 +84,7 @@ async def modify_gallery(gallery_id: str, data: Dict[str, Any]):
     """
     Returns a specific gallery by its ID.
     """
-    gallery = galleries_db.get(gallery_id)
+    gallery = find_gallery(gallery_id)
     if not gallery:
         raise HTTPException(status_code=404, detail="Gallery not found")
     if "name" in data:
@@ -75,7 +95,7 @@ async def modify_gallery(gallery_id: str, data: Dict[str, Any]):
         gallery.coverImageUrl = data["coverImageUrl"]
     gallery.lastUpdateDate = datetime.now()
     update_gallery_meta(gallery)
-    return gallery
+    return _gallery_response(gallery)
 
 
 @router.get(
@@ -87,22 +107,38 @@ async def get_gallery(gallery_id: str):
     """
     Returns a specific gallery by its ID.
     """
-    gallery = galleries_db.get(gallery_id)
+    gallery = find_gallery(gallery_id)
     if not gallery:
         raise HTTPException(status_code=404, detail="Gallery not found")
-    return gallery
+    return _gallery_response(gallery)
 
 
-@router.post(
-    "/createGallery",
-    response_model=Gallery,
-    status_code=status.HTTP_201_CREATED,
-    summary="Create a new gallery",
+@router.get(
+    "/gallery/contactSheet",
+    summary="Retrieve the contact sheet (sprite atlas + offset map) of a gallery",
 )
-async def create_gallery(data: GalleryData):
+def get_gallery_contact_sheet(gallery_id: str):
     """
-    Creates a new gallery with a readable unique ID and required directory structure.
+    Returns the offset map of the gallery's contact sheet: a few atlas images
+    of mini-thumbnails plus the position of every image inside them, so an
+    overview can be rendered with one or two requests. Declared as a plain
+    `def` so the incremental rebuild runs in the threadpool.
     """
+    gallery = find_gallery(gallery_id)
+    if not gallery:
+        raise HTTPException(status_code=404, detail="Gallery not found")
+    sheet_map = get_contact_sheet(gallery)
+    return {
+        "galleryId": sheet_map["galleryId"],
+        "version": sheet_map["version"],
+        "tileSize": sheet_map["tileSize"],
+        "sheets": sheet_map["sheets"],
+        "tiles": sheet_map["tiles"],
+    }
+
+
+def create_gallery_record(data: GalleryData) -> GalleryRecord:
+    """Creates an empty gallery with a readable unique ID and its directory structure."""
     # use current keys to detect collisions
     existing_ids = set(galleries_db.keys())
     gallery_id = generate_readable_id(
@@ -140,12 +176,11 @@ async def create_gallery(data: GalleryData):
             status_code=500, detail=f"Failed to create gallery directories: {e}"
         )
 
-    new_gallery = Gallery(
+    new_gallery = GalleryRecord(
         id=gallery_id,
         name=data.name,
         author=data.author,
         lastUpdateDate=datetime.now(),
-        images=[],
     )
     galleries_db[gallery_id] = new_gallery
 
@@ -155,6 +190,21 @@ async def create_gallery(data: GalleryData):
     return new_gallery
 
 
+@router.post(
+    "/createGallery",
+    response_model=Gallery,
+    status_code=status.HTTP_201_CREATED,
+    summary="Create a new gallery",
+)
+async def create_gallery(data: GalleryData, request: Request):
+    """
+    Creates a new gallery with a readable unique ID and required directory structure.
+    """
+    new_gallery = create_gallery_record(data)
+    usage_ledger.set_owner("gallery", new_gallery.id, getattr(request.state, "api_key_name", None))
+    return _gallery_response(new_gallery, status.HTTP_201_CREATED)
+
+
 @router.post(
     "/updateGallery", response_model=Gallery, summary="Update an existing gallery"
 )
@@ -162,7 +212,7 @@ async def update_gallery(gallery_id: str, data: GalleryData):
     """
     Updates the name or description of an existing gallery.
     """
-    gallery = galleries_db.get(gallery_id)
+    gallery = find_gallery(gallery_id)
     if not gallery:
         raise HTTPException(status_code=404, detail="Gallery not found")
 
@@ -173,7 +223,7 @@ async def update_gallery(gallery_id: str, data: GalleryData):
     # Update gallery metadata in file
     save_gallery_metadata(gallery)
 
-    return gallery
+    return _gallery_response(gallery)
 
 
 @router.delete("/image", response_model=Gallery, summary="Update an existing gallery")
@@ -181,7 +231,7 @@ async def delete_image(gallery_id: str, image_id: str):
     """
     Updates the name or description of an existing gallery.
     """
-    gallery = galleries_db.get(gallery_id)
+    gallery = find_gallery(gallery_id)
     if not gallery:
         raise HTTPException(status_code=404, detail="Gallery not found")
 
@@ -193,7 +243,7 @@ async def delete_image(gallery_id: str, image_id: str):
     # Update gallery metadata in file
     save_gallery_metadata(gallery)
 
-    return gallery
+    return _gallery_response(gallery)
 
 
 @router.post(
@@ -201,76 +251,156 @@ async def delete_image(gallery_id: str, image_id: str):
     status_code=status.HTTP_201_CREATED,
     summary="Upload an image to a gallery",
 )
-async def upload_image_to_gallery(gallery_id: str, image_file: UploadFile = File(...)):
+async def upload_image_to_gallery(
+    gallery_id: str, request: Request, image_file: UploadFile = File(...)
+):
     """
     Uploads an image file to a specified gallery, resizing it for different sizes.
+    For very large originals see the resumable upload endpoints (/uploads).
+    Answers 503/429 with Retry-After while too many uploads are processed.
     """
-    gallery = galleries_db.get(gallery_id)
+    gallery = find_gallery(gallery_id)
     if not gallery:
         raise HTTPException(status_code=404, detail="Gallery not found")
-
+    # Held until the image and its renditions are stored, so concurrent uploads
+    # count each other
+    with usage_ledger.reserve_quota("gallery", gallery.id, image_file.size or 0):
+        # The multipart body is spooled to disk; it's only read into memory once
+        # the upload is admitted
+        async with admit_upload(request, image_file.file):
+            with upload_stage("receive"):
+                content = await image_file.read()
+            UPLOADED_BYTES.labels("gallery").inc(len(content))
+
+            return await add_gallery_image(gallery, Path(image_file.filename).stem, content)
+
+
+# Keys picked by uploads still being processed. The original is stored last,
+# so its name has to be held until then.
+_reserved_keys: Set[str] = set()
+_reserved_lock = threading.Lock()  # names are generated in worker threads
+
+
+def reserve_key(key: str) -> bool:
+    """Holds a free media key for a file about to be stored; False if it is taken."""
+    with _reserved_lock:
+        if key in _reserved_keys:
+            return False
+        _reserved_keys.add(key)
+    if media_storage.exists(key):
+        with _reserved_lock:
+            _reserved_keys.discard(key)
+        return False
+    return True
+
+
+def release_filenames(keys: List[str]):
+    with _reserved_lock:
+        _reserved_keys.difference_update(keys)
+
+
+def reserve_filename(
+    gallery_id: str, size_name: str, size: Optional[tuple], filename_base: str, suffix: str, reserved: List[str]
+) -> str:
+    """
+    Generates a filename with size suffix, handling collisions. Its key is
+    added to `reserved` until `release_filenames` (once the file is stored).
+    """
+    size_str = f"__{size[0]}x{size[1]}" if size else ""
+    collision_counter = 0
+    final_filename = f"{filename_base}{size_str}.{suffix}"
+
+    # Check for filename collisions (in the sharded layout each probe
+    # only looks into a small shard directory), including names picked
+    # by concurrent uploads that haven't stored their file yet
+    while not reserve_key(f"galleries/{gallery_id}/{size_name}/{final_filename}"):
+        collision_counter += 1
+        final_filename = f"{filename_base}_{collision_counter:03d}{size_str}.{suffix}"
+    reserved.append(f"galleries/{gallery_id}/{size_name}/{final_filename}")
+    return final_filename
+
+
+async def add_gallery_image(
+    gallery: GalleryRecord, original_filename: str, source: Union[bytes, Path]
+) -> dict:
+    """
+    Resizes an uploaded original, stores all sizes and registers the image in
+    the gallery. `source` is the original's content or, for resumable
+    uploads, the staging file holding it (moved into storage, not read into
+    memory).
+    """
+    gallery_id = gallery.id
     image_id = str(uuid.uuid4())
-    original_filename = Path(image_file.filename).stem
+
+    def key(size_name: str, filename: str) -> str:
+        return f"galleries/{gallery_id}/{size_name}/{filename}"
 
     def generate_filename(size_name: str, size: tuple, filename_base: str, suffix: str):
-        """Generates a filename with size suffix, handling collisions."""
-        size_str = f"__{size[0]}x{size[1]}" if size else ""
-        collision_counter = 0
-        final_filename = f"{filename_base}{size_str}.{suffix}"
-
-        # Check for filename collisions
-        # Note: In a real app, this should check the database or gallery's file list
-        while (GALLERIES_ROOT_DIR / gallery_id / size_name / final_filename).exists():
-            collision_counter += 1
-            final_filename = (
-                f"{filename_base}_{collision_counter:03d}{size_str}.{suffix}"
-            )
-        return final_filename
+        return reserve_filename(gallery_id, size_name, size, filename_base, suffix, reserved)
 
-    # Save the original image to the full-size directory
-    full_path_dir = GALLERIES_ROOT_DIR / gallery_id / "images_full"
-    full_filename = generate_filename("images_full", None, original_filename, "jpg")
-    full_path = full_path_dir / full_filename
+    def save_resized(rendition, size_name: str, filename: str):
+        with media_storage.open_write(key(size_name, filename)) as out_file:
+            rendition.save_jpeg(out_file, size_name.removeprefix("images_"))
 
-    async with aio_open(full_path, "wb") as out_file:
-        content = await image_file.read()
-        await out_file.write(content)
+    reserved = []
+    written = []
+    full_filename = await asyncio.to_thread(
+        generate_filename, "images_full", None, original_filename, "jpg"
+    )
+    full_key = key("images_full", full_filename)
 
-    # Use Pillow to process and resize the image
+    # Process and resize the image with the configured engine
     try:
-        with Image.open(full_path) as img:
+        with resize_engine.open(source) as original:
             # Get dimensions of the original image
-            width, height = img.size
+            width, height = original.size
+            with upload_stage("decode"):
+                original.load()
 
             # --- Resize and save small image ---
-            small_filename = generate_filename(
-                "images_small", SMALL_SIZE, original_filename, "jpg"
+            small_filename = await asyncio.to_thread(
+                generate_filename, "images_small", SMALL_SIZE, original_filename, "jpg"
             )
-            small_path = (
-                GALLERIES_ROOT_DIR / gallery_id / "images_small" / small_filename
-            )
-            small_img = img.copy()
-            small_img.thumbnail(SMALL_SIZE)
-            small_img.save(small_path, "JPEG", quality=85)
+            with upload_stage("resize_small"):
+                small_img = original.resize(SMALL_SIZE)
+            with upload_stage("encode"):
+                await asyncio.to_thread(save_resized, small_img, "images_small", small_filename)
+            written.append(key("images_small", small_filename))
 
             # --- Resize and save thumbnail image ---
-            thumb_filename = generate_filename(
-                "images_thumb", THUMB_SIZE, original_filename, "jpg"
-            )
-            thumb_path = (
-                GALLERIES_ROOT_DIR / gallery_id / "images_thumb" / thumb_filename
+            thumb_filename = await asyncio.to_thread(
+                generate_filename, "images_thumb", THUMB_SIZE, original_filename, "jpg"
             )
-            thumb_img = img.copy()
-            thumb_img.thumbnail(THUMB_SIZE)
-            thumb_img.save(thumb_path, "JPEG", quality=85)
+            with upload_stage("resize_thumb"):
+                thumb_img = original.resize(THUMB_SIZE)
+            with upload_stage("encode"):
+                await asyncio.to_thread(save_resized, thumb_img, "images_thumb", thumb_filename)
+            written.append(key("images_thumb", thumb_filename))
+
+            # --- Inline placeholder + dominant color from the thumbnail ---
+            with upload_stage("placeholder"):
+                placeholder, dominant_color = compute_placeholder(thumb_img.to_pil())
 
     except Exception as e:
-        # In case the uploaded file is not a valid image, remove it and raise an error
-        os.remove(full_path)
+        # In case the uploaded file is not a valid image, remove what was
+        # already stored and raise an error
+        for written_key in written:
+            await asyncio.to_thread(media_storage.delete, written_key)
+        release_filenames(reserved)
         raise HTTPException(
             status_code=400, detail=f"Invalid image file or processing error: {e}"
         )
 
+    # Keep the original only once it's known to be a valid image
+    try:
+        with upload_stage("store_original"):
+            if isinstance(source, Path):
+                await asyncio.to_thread(media_storage.put_file, full_key, source)
+            else:
+                await asyncio.to_thread(media_storage.put_bytes, full_key, source)
+    finally:
+        release_filenames(reserved)
+
     # Add the new image metadata to the gallery
     image_data = ImageModel(
         id=image_id,
@@ -282,6 +412,8 @@ async def upload_image_to_gallery(gallery_id: str, image_file: UploadFile = File
         ),
         width=width,
         height=height,
+        placeholder=placeholder,
+        dominantColor=dominant_color,
     )
     gallery.images.append(image_data)
 
@@ -292,7 +424,8 @@ async def upload_image_to_gallery(gallery_id: str, image_file: UploadFile = File
     gallery.lastUpdateDate = datetime.now()
 
     # Update the gallery metadata file
-    save_gallery_metadata(gallery)
+    with upload_stage("metadata_write"):
+        save_gallery_metadata(gallery)
 
     return {
         "message": f"Image '{original_filename}' uploaded to gallery '{gallery.name}'",
@@ -306,12 +439,13 @@ zip_creation_locks = {}
 def create_gallery_zip(gallery_id: str, gallery_path: Path, zip_path: Path):
     """Create zip file with all original images from gallery."""
     try:
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for img_path in gallery_path.glob(
-                "images_full/*"
-            ):  # original images assumed in images/
-                if img_path.is_file():
-                    zipf.write(img_path, arcname=img_path.name)
+        with ZIP_BUILD_DURATION.time(), zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+            # original images, from whichever storage backend
+            for key in media_storage.list(f"galleries/{gallery_id}/images_full"):
+                with media_storage.open_read(key) as src, zipf.open(
+                    key.rsplit("/", 1)[1], "w"
+                ) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
     finally:
         # Mark creation as done
         zip_creation_locks.pop(gallery_id, None)
@@ -327,8 +461,12 @@ async def download_zip(gallery_id: str, background_tasks: BackgroundTasks):
 
     # If zip already exists → return it
     if zip_path.exists():
-        return FileResponse(
-            zip_path, media_type="application/zip", filename=f"{gallery_id}.zip"
+        return file_response(
+            zip_path,
+            GALLERIES_ROOT_DIR,
+            "/galleries",
+            media_type="application/zip",
+            filename=f"{gallery_id}.zip",
         )
 
     # If zip creation is in progress → return message
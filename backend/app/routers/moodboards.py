@@ -1,22 +1,45 @@
-import os
+import asyncio
 import uuid
+from contextlib import nullcontext
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 from datetime import datetime
-from fastapi import APIRouter, HTTPException, status, File, UploadFile
-from PIL import Image
-from aiofiles import open as aio_open
+from fastapi import APIRouter, HTTPException, Request, status, File, UploadFile
 
 # Local imports from our new file structure
-from app.models import Moodboard, MoodboardThumbnail, MoodboardData
+from app.models import (
+    Moodboard,
+    MoodboardThumbnail,
+    MoodboardData,
+    MoodboardPatch,
+    MoodboardPatchResult,
+)
 from app.moodboard_db import (
+    apply_moodboard_ops,
+    find_moodboard,
+    get_full_moodboard,
     moodboards_db,
     purge_moodboard,
+    save_moodboard_header,
     save_moodboard_metadata,
+    save_moodboard_ops,
+)
+from app.attachments import (
+    attachment_url,
+    replace_references,
+    schedule_if_unreferenced,
+    update_references,
 )
-from app.database import remove_leading_parts
+from app.admission import admit_upload
+from app.routers.galleries import release_filenames, reserve_key
+from app.moodboard_preview import preview_urls
 from app.config import MOODBOARDS_ROOT_DIR
+from app.resize_engine import resize_engine
+from app.storage import media_key, media_storage
+from app.usage import usage_ledger
 from app.utils import generate_readable_id
+from app.placeholders import compute_placeholder
+from app.metrics import UPLOADED_BYTES, upload_stage
 
 # Create a new API router
 router = APIRouter()
@@ -34,7 +57,7 @@ async def get_all_moodboards():
     """
     Returns a list of all available moodboards.
     """
-    return [MoodboardThumbnail.from_moodboard(x) for x in list(moodboards_db.values())]
+    return [MoodboardThumbnail.from_moodboard(x, preview_urls(x.id)) for x in list(moodboards_db.values())]
 
 
 @router.get(
@@ -46,7 +69,7 @@ async def get_moodboard(moodboard_id: str):
     """
     Returns a specific moodboard by its ID.
     """
-    moodboard = moodboards_db.get(moodboard_id)
+    moodboard = get_full_moodboard(moodboard_id)
     if not moodboard:
         raise HTTPException(status_code=404, detail="Moodboard not found")
     return moodboard
@@ -58,7 +81,7 @@ async def get_moodboard(moodboard_id: str):
     status_code=status.HTTP_201_CREATED,
     summary="Create a new moodboard",
 )
-async def create_moodboard(data: MoodboardData):
+async def create_moodboard(data: MoodboardData, request: Request):
     """
     Creates a new moodboard with a readable unique ID and required directory structure.
     """
@@ -106,40 +129,11 @@ async def create_moodboard(data: MoodboardData):
 
     # Save moodboard metadata to a YAML file
     save_moodboard_metadata(new_moodboard)
+    usage_ledger.set_owner("moodboard", moodboard_id, getattr(request.state, "api_key_name", None))
 
     return new_moodboard
 
 
-def _prune_unused_moodboard_images(moodboard_id: str, sections) -> None:
-    """
-    Deletes physical files in the moodboard's `attached_photos` directory that
-    are no longer referenced by any image in `sections`. Called after a full
-    save so that images removed from lists (or lists removed entirely) don't
-    leave orphaned files behind.
-    """
-    attached_dir = MOODBOARDS_ROOT_DIR / moodboard_id / "attached_photos"
-    if not attached_dir.is_dir():
-        return
-
-    # Resolve every still-referenced image URL to an absolute file path.
-    referenced_paths = set()
-    for section in sections:
-        if getattr(section, "type", None) == "images" and section.images:
-            for img in section.images:
-                if img.url:
-                    referenced_paths.add(
-                        (MOODBOARDS_ROOT_DIR / remove_leading_parts(img.url)).resolve()
-                    )
-
-    for file_path in attached_dir.iterdir():
-        if file_path.is_file() and file_path.resolve() not in referenced_paths:
-            try:
-                os.remove(file_path)
-            except OSError:
-                # Best-effort cleanup; don't fail the save on a stray file.
-                pass
-
-
 @router.post(
     "/updateMoodboard",
     response_model=Moodboard,
@@ -150,9 +144,16 @@ async def update_moodboard(moodboard_id: str, data: Moodboard):
     Overwrites name, headerColor and sections of an existing moodboard. This is
     how the editor persists the whole board (including all its sections).
     """
-    moodboard = moodboards_db.get(moodboard_id)
+    moodboard = get_full_moodboard(moodboard_id)
     if not moodboard:
         raise HTTPException(status_code=404, detail="Moodboard not found")
+    # Clients that know the version (they got it from GET /moodboard) are
+    # protected against overwriting concurrent edits.
+    if data.version and data.version != moodboard.version:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Moodboard was modified (version {moodboard.version}), reload it",
+        )
 
     moodboard.name = data.name
     moodboard.headerColor = data.headerColor
@@ -162,12 +163,52 @@ async def update_moodboard(moodboard_id: str, data: Moodboard):
     # Update moodboard metadata in file
     save_moodboard_metadata(moodboard)
 
-    # Garbage-collect image files no longer referenced by any section.
-    _prune_unused_moodboard_images(moodboard_id, moodboard.sections)
+    # Image files no longer referenced by any section are deleted by the
+    # attachment sweeper after a grace period.
+    replace_references(moodboard_id, moodboard.sections)
 
     return moodboard
 
 
+@router.patch(
+    "/moodboard",
+    response_model=MoodboardPatchResult,
+    summary="Apply section-level edits to a moodboard",
+)
+async def patch_moodboard(moodboard_id: str, patch: MoodboardPatch):
+    """
+    Applies a batch of fine-grained edits (insert/move/delete/update section,
+    add/remove/move/update image) atomically. `baseVersion` must match the
+    moodboard's current version, otherwise 409 is returned and the client
+    should reload. The edits are appended to the moodboard's journal, so the
+    cost is proportional to the edit rather than to the board size.
+    """
+    moodboard = get_full_moodboard(moodboard_id)
+    if not moodboard:
+        raise HTTPException(status_code=404, detail="Moodboard not found")
+    if patch.baseVersion != moodboard.version:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Moodboard was modified (version {moodboard.version}), reload it",
+        )
+
+    try:
+        added_urls, removed_urls = apply_moodboard_ops(moodboard, patch.ops)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    save_moodboard_ops(moodboard, patch.ops)
+    update_references(moodboard_id, added_urls, removed_urls)
+
+    return MoodboardPatchResult(
+        version=moodboard.version,
+        lastUpdateDate=moodboard.lastUpdateDate,
+        coverImageUrl=moodboard.coverImageUrl,
+        coverPlaceholder=moodboard.coverPlaceholder,
+        coverDominantColor=moodboard.coverDominantColor,
+    )
+
+
 @router.put(
     "/moodboard",
     response_model=Optional[Moodboard],
@@ -175,9 +216,11 @@ async def update_moodboard(moodboard_id: str, data: Moodboard):
 )
 async def modify_moodboard(moodboard_id: str, data: Dict[str, Any]):
     """
-    Patches name/headerColor on a specific moodboard by its ID.
+    Patches name/headerColor on a specific moodboard by its ID. Only the
+    header is loaded and rewritten; the sections in the response are only
+    filled in if they happen to be cached.
     """
-    moodboard = moodboards_db.get(moodboard_id)
+    moodboard = find_moodboard(moodboard_id)
     if not moodboard:
         raise HTTPException(status_code=404, detail="Moodboard not found")
     if "name" in data:
@@ -185,7 +228,7 @@ async def modify_moodboard(moodboard_id: str, data: Dict[str, Any]):
     if "headerColor" in data:
         moodboard.headerColor = data["headerColor"]
     moodboard.lastUpdateDate = datetime.now()
-    save_moodboard_metadata(moodboard)
+    save_moodboard_header(moodboard)
     return moodboard
 
 
@@ -196,73 +239,99 @@ async def modify_moodboard(moodboard_id: str, data: Dict[str, Any]):
 )
 async def delete_moodboard(moodboard_id: str):
     """
-    Deletes a specific moodboard by its ID.
+    Deletes a specific moodboard by its ID. Its sections aren't loaded for
+    this, so the response has them only if they happen to be cached.
     """
-    moodboard = moodboards_db.get(moodboard_id)
+    moodboard = find_moodboard(moodboard_id)
     if not moodboard:
         raise HTTPException(status_code=404, detail="Moodboard not found")
     purge_moodboard(moodboard)
     return moodboard
 
 
+def attachment_filename(moodboard_id: str, filename_base: str, suffix: str, reserved: List[str]) -> str:
+    """
+    Generates a free filename in the moodboard's attachments, handling
+    collisions. Its key is added to `reserved` until `release_filenames`
+    (once the file is stored), so concurrent uploads never pick the same one.
+    """
+    collision_counter = 0
+    final_filename = f"{filename_base}.{suffix}"
+
+    while not reserve_key(media_key(attachment_url(moodboard_id, final_filename))):
+        collision_counter += 1
+        final_filename = f"{filename_base}_{collision_counter:03d}.{suffix}"
+    reserved.append(media_key(attachment_url(moodboard_id, final_filename)))
+    return final_filename
+
+
 @router.post(
     "/uploadMoodboardImage",
     status_code=status.HTTP_201_CREATED,
     summary="Upload an image to attach to a moodboard",
 )
 async def upload_moodboard_image(
-    moodboard_id: str, image_file: UploadFile = File(...)
+    moodboard_id: str, request: Request, image_file: UploadFile = File(...)
 ):
     """
     Uploads an image file for a moodboard, downscaling it if needed. The
     moodboard's sections are NOT modified here - the frontend editor adds the
-    returned image to a section and calls updateMoodboard.
+    returned image to a section and calls updateMoodboard. Until then the
+    file is unreferenced and would be deleted once its grace period passes.
     """
-    moodboard = moodboards_db.get(moodboard_id)
+    moodboard = find_moodboard(moodboard_id)
     if not moodboard:
         raise HTTPException(status_code=404, detail="Moodboard not found")
+    # Held until the attachment is stored, so concurrent uploads count each other
+    with usage_ledger.reserve_quota("moodboard", moodboard_id, image_file.size or 0):
+        image_id = str(uuid.uuid4())
+        original_filename = Path(image_file.filename).stem
+
+        def save_attachment(rendition, key: str):
+            with media_storage.open_write(key) as out_file:
+                rendition.save_jpeg(out_file, "moodboard")
+
+        reserved: List[str] = []
+        filename = await asyncio.to_thread(attachment_filename, moodboard_id, original_filename, "jpg", reserved)
+        url = attachment_url(moodboard_id, filename)
+        try:
+            # Decoded in one buffer (resized in place, in draft mode for JPEGs), so
+            # a single full-size copy is accounted
+            async with admit_upload(request, image_file.file, copies=1):
+                with upload_stage("receive"):
+                    content = await image_file.read()
+                UPLOADED_BYTES.labels("moodboard").inc(len(content))
+
+                # Process and resize the image with the configured engine. Only the
+                # re-encoded image is stored, so an invalid upload leaves nothing behind.
+                try:
+                    with resize_engine.open(content) as original:
+                        # Not loaded up front: JPEGs can then be decoded at a reduced
+                        # scale, so decoding is accounted to the resize stage here.
+                        large = max(original.size) > 1920
+                        with upload_stage("resize_small") if large else nullcontext():
+                            img = original.resize(MAX_IMAGE_SIZE, reuse=True)
+                        width, height = img.size
+                        with upload_stage("encode"):
+                            await asyncio.to_thread(save_attachment, img, media_key(url))
+                        with upload_stage("placeholder"):
+                            placeholder, dominant_color = compute_placeholder(img.to_pil())
+                except Exception as e:
+                    raise HTTPException(
+                        status_code=400, detail=f"Invalid image file or processing error: {e}"
+                    )
+        finally:
+            release_filenames(reserved)
 
-    image_id = str(uuid.uuid4())
-    original_filename = Path(image_file.filename).stem
-    attached_dir = MOODBOARDS_ROOT_DIR / moodboard_id / "attached_photos"
-    attached_dir.mkdir(parents=True, exist_ok=True)
-
-    def generate_filename(filename_base: str, suffix: str):
-        """Generates a filename, handling collisions."""
-        collision_counter = 0
-        final_filename = f"{filename_base}.{suffix}"
-
-        while (attached_dir / final_filename).exists():
-            collision_counter += 1
-            final_filename = f"{filename_base}_{collision_counter:03d}.{suffix}"
-        return final_filename
-
-    filename = generate_filename(original_filename, "jpg")
-    file_path = attached_dir / filename
-
-    async with aio_open(file_path, "wb") as out_file:
-        content = await image_file.read()
-        await out_file.write(content)
-
-    # Use Pillow to process and resize the image
-    try:
-        with Image.open(file_path) as img:
-            if max(img.size) > 1920:
-                img.thumbnail(MAX_IMAGE_SIZE)
-            width, height = img.size
-            img.save(file_path, "JPEG", quality=85)
-    except Exception as e:
-        # In case the uploaded file is not a valid image, remove it and raise an error
-        os.remove(file_path)
-        raise HTTPException(
-            status_code=400, detail=f"Invalid image file or processing error: {e}"
-        )
+    schedule_if_unreferenced(moodboard_id, url)
 
     return {
         "id": image_id,
-        "url": f"/moodboard-media/{moodboard_id}/attached_photos/{filename}",
+        "url": url,
         "width": width,
         "height": height,
+        "placeholder": placeholder,
+        "dominantColor": dominant_color,
     }
 
 
@@ -273,22 +342,24 @@ async def upload_moodboard_image(
 )
 async def delete_moodboard_image(moodboard_id: str, url: str):
     """
-    Deletes the physical file referenced by `url` and removes any matching
-    MoodboardImage entries from all sections.
+    Removes any MoodboardImage entries matching `url` from all sections. The
+    file itself is deleted by the attachment sweeper once its grace period
+    passes without the url being referenced again.
     """
-    moodboard = moodboards_db.get(moodboard_id)
+    moodboard = get_full_moodboard(moodboard_id)
     if not moodboard:
         raise HTTPException(status_code=404, detail="Moodboard not found")
 
-    file_path = MOODBOARDS_ROOT_DIR / remove_leading_parts(url)
-    if file_path.exists():
-        os.remove(file_path)
-
+    removed: List[str] = []
     for section in moodboard.sections:
         if section.type == "images" and section.images:
-            section.images = [img for img in section.images if img.url != url]
+            kept = [img for img in section.images if img.url != url]
+            removed.extend([url] * (len(section.images) - len(kept)))
+            section.images = kept
 
     moodboard.lastUpdateDate = datetime.now()
     save_moodboard_metadata(moodboard)
+    update_references(moodboard_id, [], removed)
+    schedule_if_unreferenced(moodboard_id, url)
 
     return moodboard
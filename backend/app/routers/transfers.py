@@ -0,0 +1,288 @@
+"""
+Copying and moving images between galleries and into moodboards on the
+server, e.g. to build a "client selects" gallery from existing ones.
+
+The stored renditions are reused as they are, never decoded or re-encoded:
+`media_storage.link` hard-links them (or reflinks, or copies across volumes;
+S3 copies server-side) under the target's own urls. Every gallery or
+moodboard thus only ever deletes its own files, and a file shared with
+another one stays as long as any link to it does.
+
+The target document is saved before the images are removed from the
+source: if the process dies in between, the images are in both rather than
+in neither.
+"""
+import asyncio
+import io
+import uuid
+from datetime import datetime
+from pathlib import PurePosixPath
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Request, status
+from PIL import Image
+
+from app.attachments import attachment_url, schedule_if_unreferenced, update_references
+from app.config import SMALL_SIZE, THUMB_SIZE
+from app.database import delete_gallery_image, find_gallery, purge_gallery, save_gallery_metadata
+from app.image_table import GalleryRecord
+from app.metrics import MEDIA_LINKS
+from app.models import (
+    AddImageOp,
+    AttachGalleryImagesRequest,
+    AttachGalleryImagesResult,
+    CopyImagesRequest,
+    Gallery,
+    GalleryData,
+    ImageModel,
+    ImageSizes,
+    MoodboardImage,
+)
+from app.moodboard_db import apply_moodboard_ops, find_moodboard, get_full_moodboard, save_moodboard_ops
+from app.routers.galleries import (
+    _gallery_response,
+    create_gallery_record,
+    release_filenames,
+    reserve_filename,
+)
+from app.routers.moodboards import attachment_filename
+from app.storage import media_key, media_storage
+from app.usage import usage_ledger
+
+router = APIRouter()
+
+# (ImageSizes field, size directory, size suffix of the file name)
+RENDITIONS = (
+    ("full", "images_full", None),
+    ("small", "images_small", SMALL_SIZE),
+    ("thumb", "images_thumb", THUMB_SIZE),
+)
+
+
+def _link(source_url: str, key: str):
+    MEDIA_LINKS.labels(media_storage.link(media_key(source_url), key)).inc()
+
+
+def _delete_keys(keys: List[str]):
+    for key in keys:
+        try:
+            media_storage.delete(key)
+        except Exception as e:  # OSError, S3 errors
+            print(f"Could not delete {key}: {e}")
+
+
+def _select_images(gallery: GalleryRecord, image_ids: Optional[List[str]]) -> List[ImageModel]:
+    if image_ids is None:
+        return list(gallery.images)
+    images = []
+    for image_id in image_ids:
+        row = gallery.images.index_of(image_id)
+        if row < 0:
+            raise HTTPException(status_code=404, detail=f"Image '{image_id}' not found in gallery")
+        images.append(gallery.images[row])
+    return images
+
+
+def _link_gallery_images(images: List[ImageModel], target_id: str, keep_ids: bool, written: List[str]) -> List[ImageModel]:
+    """Links all renditions of `images` into the target gallery (in a worker thread)."""
+    reserved: List[str] = []
+    linked = []
+    try:
+        for image in images:
+            urls = {}
+            for field, size_name, size in RENDITIONS:
+                source_url = getattr(image.sizes, field)
+                suffix = PurePosixPath(source_url).suffix.lstrip(".") or "jpg"
+                filename = reserve_filename(target_id, size_name, size, image.filename, suffix, reserved)
+                key = f"galleries/{target_id}/{size_name}/{filename}"
+                _link(source_url, key)
+                written.append(key)
+                urls[field] = f"/{key}"
+            linked.append(
+                image.model_copy(
+                    update={"id": image.id if keep_ids else str(uuid.uuid4()), "sizes": ImageSizes(**urls)}
+                )
+            )
+    finally:
+        release_filenames(reserved)
+    return linked
+
+
+def _remove_from_gallery(gallery: GalleryRecord, image_ids: List[str]):
+    """Deletes moved images from their source gallery (files and metadata)."""
+    removed_thumbs = set()
+    for image_id in image_ids:
+        row = gallery.images.index_of(image_id)
+        if row >= 0:
+            removed_thumbs.add(gallery.images[row].sizes.thumb)
+            delete_gallery_image(gallery, image_id)
+    if gallery.coverImageUrl in removed_thumbs:
+        gallery.coverImageUrl = gallery.images[0].sizes.thumb if len(gallery.images) else None
+    gallery.lastUpdateDate = datetime.now()
+    save_gallery_metadata(gallery)
+
+
+async def copy_gallery_images(
+    source: GalleryRecord, target: GalleryRecord, image_ids: Optional[List[str]], move: bool
+):
+    if source.id == target.id:
+        raise HTTPException(status_code=400, detail="Source and target gallery are the same")
+    images = _select_images(source, image_ids)
+    written: List[str] = []
+    try:
+        linked = await asyncio.to_thread(_link_gallery_images, images, target.id, move, written)
+    except Exception as e:
+        await asyncio.to_thread(_delete_keys, written)
+        if isinstance(e, FileNotFoundError):
+            raise HTTPException(status_code=409, detail=f"Image file missing, was it deleted meanwhile? {e}")
+        raise
+
+    for image in linked:
+        target.images.append(image)
+    if not target.coverImageUrl and linked:
+        target.coverImageUrl = linked[0].sizes.thumb
+    target.lastUpdateDate = datetime.now()
+    save_gallery_metadata(target)
+
+    if move:
+        _remove_from_gallery(source, [image.id for image in images])
+
+
+def _find(gallery_id: str) -> GalleryRecord:
+    gallery = find_gallery(gallery_id)
+    if not gallery:
+        raise HTTPException(status_code=404, detail=f"Gallery '{gallery_id}' not found")
+    return gallery
+
+
+@router.post(
+    "/gallery/copyImages",
+    response_model=Gallery,
+    summary="Copy or move images from another gallery",
+)
+async def copy_images(gallery_id: str, data: CopyImagesRequest):
+    """
+    Adds images of `sourceGalleryId` (all of them when `imageIds` is omitted)
+    to this gallery, reusing their stored files. With `move` they are removed
+    from the source. Returns the updated target gallery.
+    """
+    target = _find(gallery_id)
+    source = _find(data.sourceGalleryId)
+    await copy_gallery_images(source, target, data.imageIds, data.move)
+    return _gallery_response(target)
+
+
+@router.post(
+    "/gallery/clone",
+    response_model=Gallery,
+    status_code=status.HTTP_201_CREATED,
+    summary="Create a new gallery with all images of an existing one",
+)
+async def clone_gallery(gallery_id: str, data: GalleryData, request: Request):
+    source = _find(gallery_id)
+    clone = create_gallery_record(data)
+    usage_ledger.set_owner("gallery", clone.id, getattr(request.state, "api_key_name", None))
+    try:
+        await copy_gallery_images(source, clone, None, move=False)
+    except Exception:
+        purge_gallery(clone)
+        raise
+    return _gallery_response(clone, status.HTTP_201_CREATED)
+
+
+@router.post(
+    "/gallery/merge",
+    response_model=Gallery,
+    summary="Move all images of another gallery into this one and delete it",
+)
+async def merge_galleries(gallery_id: str, source_gallery_id: str):
+    target = _find(gallery_id)
+    source = _find(source_gallery_id)
+    await copy_gallery_images(source, target, None, move=True)
+    purge_gallery(source)
+    return _gallery_response(target)
+
+
+def _link_attachments(
+    images: List[ImageModel], moodboard_id: str, written: List[str]
+) -> List[MoodboardImage]:
+    """Links the small renditions of gallery images into a moodboard's attachments."""
+    attached = []
+    for image in images:
+        source_url = image.sizes.small
+        suffix = PurePosixPath(source_url).suffix.lstrip(".") or "jpg"
+        reserved: List[str] = []
+        url = attachment_url(moodboard_id, attachment_filename(moodboard_id, image.filename, suffix, reserved))
+        try:
+            _link(source_url, media_key(url))
+        finally:
+            release_filenames(reserved)
+        written.append(media_key(url))
+        # Header only: the rendition's size isn't in the gallery metadata
+        with media_storage.open_read(media_key(url)) as f, Image.open(io.BytesIO(f.read(256 * 1024))) as img:
+            width, height = img.size
+        attached.append(
+            MoodboardImage(
+                id=str(uuid.uuid4()),
+                url=url,
+                width=width,
+                height=height,
+                placeholder=image.placeholder,
+                dominantColor=image.dominantColor,
+            )
+        )
+    return attached
+
+
+@router.post(
+    "/moodboard/attachGalleryImages",
+    response_model=AttachGalleryImagesResult,
+    status_code=status.HTTP_201_CREATED,
+    summary="Attach images of a gallery to a moodboard",
+)
+async def attach_gallery_images(moodboard_id: str, data: AttachGalleryImagesRequest):
+    """
+    Attaches the small renditions (at most 1920x1080, like uploaded
+    moodboard images) of gallery images to the moodboard without
+    re-encoding them. With `section` they are appended to that images section
+    in the same operation (the moodboard's version is bumped, as by PATCH
+    /moodboard); otherwise the returned images are to be added by the editor,
+    like uploads. With `move` they are removed from the gallery.
+    """
+    if data.section is None:
+        moodboard = find_moodboard(moodboard_id)
+    else:
+        moodboard = get_full_moodboard(moodboard_id)
+    if not moodboard:
+        raise HTTPException(status_code=404, detail="Moodboard not found")
+    if data.baseVersion is not None and data.baseVersion != moodboard.version:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Moodboard was modified (version {moodboard.version}), reload it",
+        )
+    gallery = _find(data.galleryId)
+    images = _select_images(gallery, data.imageIds)
+
+    written: List[str] = []
+    try:
+        attached = await asyncio.to_thread(_link_attachments, images, moodboard_id, written)
+        if data.section is not None:
+            ops = [AddImageOp(op="addImage", section=data.section, image=image) for image in attached]
+            try:
+                added_urls, removed_urls = apply_moodboard_ops(moodboard, ops)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            save_moodboard_ops(moodboard, ops)
+            update_references(moodboard_id, added_urls, removed_urls)
+    except Exception as e:
+        await asyncio.to_thread(_delete_keys, written)
+        if isinstance(e, FileNotFoundError):
+            raise HTTPException(status_code=409, detail=f"Image file missing, was it deleted meanwhile? {e}")
+        raise
+    if data.section is None:
+        for image in attached:
+            schedule_if_unreferenced(moodboard_id, image.url)
+
+    if data.move:
+        _remove_from_gallery(gallery, [image.id for image in images])
+    return AttachGalleryImagesResult(version=moodboard.version, images=attached)
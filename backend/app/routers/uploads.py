@@ -0,0 +1,195 @@
+"""
+Resumable uploads of large originals, following the tus 1.0 protocol
+(creation, HEAD, PATCH, termination, expiration) plus an explicit finalize
+step:
+
+1. `POST /uploads?gallery_id=...` with `Upload-Length` (and the filename in
+   `Upload-Metadata: filename <base64>`) creates the upload; `Location`
+   points at it.
+2. `PATCH /uploads/{id}` with `Upload-Offset` and an
+   `application/offset+octet-stream` body appends a chunk. After a broken
+   connection, `HEAD /uploads/{id}` tells the offset to resume from.
+3. `POST /uploads/{id}/finalize` once all bytes arrived resizes and
+   registers the image like `/uploadImageToGallery`.
+
+Chunks are streamed into the upload's file as they arrive, so memory use per
+upload is bounded by WRITE_BUFFER_BYTES whatever the file size.
+"""
+import asyncio
+import base64
+import binascii
+from email.utils import formatdate
+from pathlib import Path
+from typing import Dict
+
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from starlette.requests import ClientDisconnect
+
+from app.admission import admit_upload
+from app.config import UPLOAD_MAX_SIZE_MB
+from app.database import find_gallery
+from app.metrics import UPLOADED_BYTES
+from app.routers.galleries import add_gallery_image
+from app.uploads import create_upload, delete_upload, get_upload, part_path, upload_locks
+from app.usage import usage_ledger
+
+TUS_VERSION = "1.0.0"
+MAX_SIZE = int(UPLOAD_MAX_SIZE_MB * 1024 * 1024)
+# Bytes of a PATCH body collected before they are written out
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+router = APIRouter()
+
+
+def _headers(upload: dict) -> Dict[str, str]:
+    return {
+        "Tus-Resumable": TUS_VERSION,
+        "Upload-Offset": str(upload["offset"]),
+        "Upload-Length": str(upload["length"]),
+        "Upload-Expires": formatdate(upload["expires"], usegmt=True),
+        "Cache-Control": "no-store",
+    }
+
+
+def _parse_metadata(header: str) -> Dict[str, str]:
+    """`Upload-Metadata: key base64value,key2 base64value2`"""
+    metadata = {}
+    for pair in filter(None, (p.strip() for p in header.split(","))):
+        key, _, value = pair.partition(" ")
+        try:
+            metadata[key] = base64.b64decode(value).decode("utf-8") if value else ""
+        except (binascii.Error, UnicodeDecodeError):
+            raise HTTPException(status_code=400, detail=f"Invalid Upload-Metadata value for {key!r}")
+    return metadata
+
+
+def _header_int(request: Request, name: str) -> int:
+    try:
+        value = int(request.headers[name])
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail=f"Missing or invalid {name} header")
+    if value < 0:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} header")
+    return value
+
+
+def _find_upload(upload_id: str) -> dict:
+    upload = get_upload(upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload not found or expired")
+    return upload
+
+
+@router.post("/uploads", status_code=status.HTTP_201_CREATED, summary="Start a resumable upload")
+async def create_resumable_upload(gallery_id: str, request: Request):
+    gallery = find_gallery(gallery_id)
+    if not gallery:
+        raise HTTPException(status_code=404, detail="Gallery not found")
+    length = _header_int(request, "Upload-Length")
+    if length > MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {MAX_SIZE} bytes")
+    usage_ledger.check_quota("gallery", gallery.id, length)
+    metadata = _parse_metadata(request.headers.get("Upload-Metadata", ""))
+    filename = Path(metadata.get("filename") or "upload").stem
+
+    upload = await asyncio.to_thread(create_upload, gallery.id, filename, length)
+    headers = _headers(upload)
+    headers["Location"] = request.app.url_path_for("patch_resumable_upload", upload_id=upload["id"])
+    return Response(status_code=status.HTTP_201_CREATED, headers=headers)
+
+
+@router.head("/uploads/{upload_id}", summary="Offset of a resumable upload")
+async def resumable_upload_status(upload_id: str):
+    upload = _find_upload(upload_id)
+    return Response(status_code=status.HTTP_200_OK, headers=_headers(upload))
+
+
+@router.patch("/uploads/{upload_id}", summary="Append a chunk to a resumable upload")
+async def patch_resumable_upload(upload_id: str, request: Request):
+    if request.headers.get("Content-Type") != "application/offset+octet-stream":
+        raise HTTPException(status_code=415, detail="Expected application/offset+octet-stream")
+    offset = _header_int(request, "Upload-Offset")
+    upload = _find_upload(upload_id)
+    lock = upload_locks.setdefault(upload_id, asyncio.Lock())
+    if lock.locked():
+        raise HTTPException(status_code=409, detail="Upload is being written by another request")
+
+    async with lock:
+        upload = _find_upload(upload_id)
+        if offset != upload["offset"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload-Offset {offset} doesn't match the upload's offset {upload['offset']}",
+            )
+        remaining = upload["length"] - offset
+        with open(part_path(upload_id), "ab") as f:
+            buffer = bytearray()
+            try:
+                async for chunk in request.stream():
+                    if len(chunk) > remaining:
+                        raise HTTPException(status_code=413, detail="Chunk exceeds Upload-Length")
+                    remaining -= len(chunk)
+                    buffer += chunk
+                    if len(buffer) >= WRITE_BUFFER_BYTES:
+                        await asyncio.to_thread(f.write, buffer)
+                        UPLOADED_BYTES.labels("gallery").inc(len(buffer))
+                        buffer = bytearray()
+            except ClientDisconnect:
+                pass  # keep what arrived; the client resumes from HEAD's offset
+            finally:
+                if buffer:
+                    await asyncio.to_thread(f.write, buffer)
+                    UPLOADED_BYTES.labels("gallery").inc(len(buffer))
+
+    upload = _find_upload(upload_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=_headers(upload))
+
+
+@router.post(
+    "/uploads/{upload_id}/finalize",
+    status_code=status.HTTP_201_CREATED,
+    summary="Resize and register a completed upload",
+)
+async def finalize_resumable_upload(upload_id: str, request: Request):
+    upload = _find_upload(upload_id)
+    lock = upload_locks.setdefault(upload_id, asyncio.Lock())
+    if lock.locked():
+        raise HTTPException(status_code=409, detail="Upload is being written by another request")
+
+    async with lock:
+        upload = _find_upload(upload_id)
+        if upload["offset"] != upload["length"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload incomplete: {upload['offset']} of {upload['length']} bytes",
+            )
+        gallery = find_gallery(upload["galleryId"])
+        if not gallery:
+            raise HTTPException(status_code=404, detail="Gallery not found")
+        # Again: the gallery may have filled up while the bytes arrived
+        with usage_ledger.reserve_quota("gallery", gallery.id, upload["length"]):
+            # Rejected while busy (503/429): the upload is kept for a retry
+            async with admit_upload(request, part_path(upload_id)):
+                try:
+                    # Moves the part file into storage on success
+                    result = await add_gallery_image(gallery, upload["filename"], part_path(upload_id))
+                except HTTPException:
+                    # Not a valid image: resuming can't fix that
+                    await asyncio.to_thread(delete_upload, upload_id)
+                    raise
+    await asyncio.to_thread(delete_upload, upload_id)
+    return result
+
+
+@router.delete(
+    "/uploads/{upload_id}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    summary="Cancel a resumable upload",
+)
+async def delete_resumable_upload(upload_id: str):
+    _find_upload(upload_id)
+    lock = upload_locks.get(upload_id)
+    if lock is not None and lock.locked():
+        raise HTTPException(status_code=409, detail="Upload is being written by another request")
+    await asyncio.to_thread(delete_upload, upload_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={"Tus-Resumable": TUS_VERSION})
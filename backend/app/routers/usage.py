@@ -0,0 +1,31 @@
+"""
+Storage usage statistics (see app.usage). Answered from the in-memory
+counters, so they cost nothing however large the library is; they need an
+API key since they list the key names.
+"""
+import asyncio
+from typing import Optional
+
+from fastapi import APIRouter, Depends
+
+from app.dependencies import require_api_key
+from app.usage import scan_usage, usage_ledger
+
+router = APIRouter()
+
+
+@router.get("/admin/usage", summary="Storage used per gallery, moodboard and API key")
+async def get_usage(top: Optional[int] = None, _key: str = Depends(require_api_key)):
+    """
+    Bytes and files of media per API key, gallery and moodboard (the `top`
+    largest galleries and moodboards only, if given) with their quotas, and
+    when the counts were last recounted from storage (`scannedAt`).
+    """
+    return usage_ledger.stats(top)
+
+
+@router.post("/admin/usage/scan", summary="Recount the storage usage now")
+async def rescan_usage(top: Optional[int] = None):
+    """Recounts the usage from storage right away instead of at the next scheduled scan."""
+    await asyncio.to_thread(scan_usage)
+    return usage_ledger.stats(top)
@@ -0,0 +1,481 @@
+"""
+Storage of media files: gallery images and moodboard attachments.
+
+Files are addressed by their url without the leading slash, e.g.
+"galleries/<gallery_id>/images_full/IMG_0001.jpg" or
+"moodboard-media/<moodboard_id>/attached_photos/a.jpg", so an image's url is
+also its key. Metadata files, contact sheets and zip archives stay on the
+local volume.
+
+* `LocalStorage` (STORAGE_BACKEND=local, the default) keeps the files below
+  GALLERIES_ROOT_DIR / MOODBOARDS_ROOT_DIR, in the configured layout (see
+  app.storage_layout), served by the static mounts. Sizes in PACKED_SIZES
+  are kept in per-gallery pack files instead (see app.thumb_pack).
+* `S3Storage` (STORAGE_BACKEND=s3) keeps them in an S3-compatible bucket (AWS,
+  MinIO, ...), so several replicas can share the media. Writes are streamed
+  as multipart uploads over one pooled client; requests for media urls are
+  redirected to presigned urls. Needs `pip install boto3`.
+
+Both report what they store and delete to the usage ledger (app.usage).
+"""
+import fcntl
+import io
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from fastapi.responses import RedirectResponse
+
+from app.config import (
+    GALLERIES_ROOT_DIR,
+    MOODBOARDS_ROOT_DIR,
+    PACKED_SIZES,
+    S3_ADDRESSING_STYLE,
+    S3_BUCKET,
+    S3_ENDPOINT_URL,
+    S3_MAX_POOL_CONNECTIONS,
+    S3_MULTIPART_CHUNK_MB,
+    S3_PREFIX,
+    S3_PRESIGN_EXPIRES_SECONDS,
+    S3_REGION,
+    STORAGE_BACKEND,
+)
+from app.storage_layout import SIZE_DIR_NAMES, image_path, resolve_image_path
+from app.thumb_pack import (
+    forget_packs,
+    get_pack,
+    packed_length,
+    packed_location,
+    packed_names,
+    packed_usage,
+)
+from app.usage import usage_ledger
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # optional dependency, only needed for STORAGE_BACKEND=s3
+    boto3 = None
+
+MOUNTS = {"galleries": GALLERIES_ROOT_DIR, "moodboard-media": MOODBOARDS_ROOT_DIR}
+# ioctl sharing a file's extents with another (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+
+def media_key(url: str) -> str:
+    """The storage key of a media url."""
+    return url.lstrip("/")
+
+
+def is_media_key(key: str) -> bool:
+    """Whether a key names a media file (as opposed to e.g. a contact sheet)."""
+    parts = key.split("/")
+    if len(parts) != 4:
+        return False
+    if parts[0] == "galleries":
+        return parts[2] in SIZE_DIR_NAMES
+    return parts[0] == "moodboard-media" and parts[2] == "attached_photos"
+
+
+def _file_size(path: Path) -> Optional[int]:
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+
+def _content_type(key: str) -> str:
+    return "image/jpeg" if key.lower().endswith((".jpg", ".jpeg")) else "application/octet-stream"
+
+
+class LocalStorage:
+    presigns = False
+
+    def path(self, key: str, for_write: bool = False) -> Path:
+        parts = key.strip("/").split("/")
+        if parts[0] not in MOUNTS or any(p in ("", ".", "..") for p in parts[1:]):
+            raise ValueError(f"Invalid media key: {key}")
+        if parts[0] == "galleries" and len(parts) == 4 and parts[2] in SIZE_DIR_NAMES:
+            return (image_path if for_write else resolve_image_path)(*parts[1:])
+        return MOUNTS[parts[0]].joinpath(*parts[1:])
+
+    @staticmethod
+    def _in_pack(key: str) -> bool:
+        packed = packed_location(key)
+        return packed is not None and packed[2] in get_pack(*packed[:2])
+
+    def exists(self, key: str) -> bool:
+        if self._in_pack(key):
+            return True
+        # The write location: new files go there, so that is what collides
+        return self.path(key, for_write=True).exists()
+
+    @contextmanager
+    def open_write(self, key: str) -> Iterator[BinaryIO]:
+        packed = packed_location(key)
+        if packed is not None:
+            buffer = io.BytesIO()
+            yield buffer
+            data = buffer.getvalue()
+            replaced = packed_length(key)
+            get_pack(*packed[:2]).append(packed[2], data)
+            usage_ledger.written(key, len(data), replaced)
+            return
+        path = self.path(key, for_write=True)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written next to the final path and renamed over it once complete:
+        # a failed write leaves no truncated file, and an old file that is
+        # hard-linked from another gallery (see `link`) isn't overwritten
+        temp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            with open(temp, "xb") as f:
+                yield f
+                size = f.tell()
+            replaced = _file_size(path)
+            os.replace(temp, path)
+        except BaseException:
+            temp.unlink(missing_ok=True)
+            raise
+        usage_ledger.written(key, size, replaced)
+
+    def put_bytes(self, key: str, data: bytes):
+        with self.open_write(key) as f:
+            f.write(data)
+
+    def put_file(self, key: str, source: Path):
+        """Moves a local file into storage."""
+        path = self.path(key, for_write=True)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        replaced = _file_size(path)
+        size = os.stat(source).st_size
+        try:
+            os.replace(source, path)
+        except OSError:
+            shutil.move(source, path)  # other filesystem
+        usage_ledger.written(key, size, replaced)
+
+    def link(self, source_key: str, key: str) -> str:
+        """
+        Makes `key` a copy of `source_key` without re-encoding: a hard link
+        (no data written), else a reflink (copy-on-write), else a plain copy,
+        e.g. across volumes. Packed files are copied into the target pack.
+        Returns which of "hardlink", "reflink", "copy" or "pack" was used.
+        """
+        if packed_location(key) is not None or self._in_pack(source_key):
+            with self.open_read(source_key) as src:
+                self.put_bytes(key, src.read())
+            return "pack"
+        source = self.path(source_key)
+        path = self.path(key, for_write=True)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(source, path)
+            method = "hardlink"
+        except (FileNotFoundError, FileExistsError):
+            raise
+        except OSError:
+            method = None  # other volume, or no hard links on this filesystem
+        if method is None:
+            with open(source, "rb") as src, open(path, "xb") as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    method = "reflink"
+                except OSError:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                    method = "copy"
+        usage_ledger.written(key, os.stat(path).st_size)
+        return method
+
+    def open_read(self, key: str) -> BinaryIO:
+        packed = packed_location(key)
+        if packed is not None:
+            found = get_pack(*packed[:2]).read(packed[2])
+            if found is not None:
+                return io.BytesIO(found[0])
+        return open(self.path(key), "rb")
+
+    def delete(self, key: str):
+        packed = packed_location(key)
+        if packed is not None:
+            size = packed_length(key)
+            if get_pack(*packed[:2]).delete(packed[2]):
+                usage_ledger.removed(key, size)
+                return
+        path = self.path(key)
+        size = _file_size(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        usage_ledger.removed(key, size)
+
+    def delete_prefix(self, prefix: str):
+        parts = prefix.strip("/").split("/")
+        if parts[0] == "galleries" and len(parts) == 2:
+            forget_packs(parts[1])
+        path = self.path(prefix)
+        if path.is_dir():
+            shutil.rmtree(path)
+        usage_ledger.removed_prefix(prefix)
+
+    def list(self, prefix: str) -> Iterator[str]:
+        """Keys of the files in a "directory" key (shard directories and packs included)."""
+        prefix = prefix.strip("/")
+        parts = prefix.split("/")
+        for dirpath, dirnames, filenames in os.walk(self.path(prefix)):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                yield f"{prefix}/{filename}"
+        if parts[0] == "galleries" and len(parts) == 3 and parts[2] in PACKED_SIZES:
+            for filename in packed_names(parts[1], parts[2]):
+                yield f"{prefix}/{filename}"
+
+    def measure(self, prefix: str) -> Tuple[int, int]:
+        """(bytes, files) in a "directory" key, like `list` lists them."""
+        prefix = prefix.strip("/")
+        parts = prefix.split("/")
+        total = files = 0
+        for dirpath, dirnames, filenames in os.walk(self.path(prefix)):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                size = _file_size(Path(dirpath, filename))
+                if size is not None:
+                    total += size
+                    files += 1
+        if parts[0] == "galleries" and len(parts) == 3 and parts[2] in PACKED_SIZES:
+            packed_bytes, packed_files = packed_usage(parts[1], parts[2])
+            total += packed_bytes
+            files += packed_files
+        return total, files
+
+    def presigned_url(self, key: str) -> Optional[str]:
+        return None
+
+
+class _MultipartWriter(io.RawIOBase):
+    """
+    File-like object streaming what is written to S3. Small files end up as a
+    single PUT; once a part's worth of data is buffered a multipart upload is
+    started and every full part is sent right away.
+    """
+
+    def __init__(self, client, bucket: str, key: str, part_size: int):
+        super().__init__()
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._part_size = part_size
+        self._buffer = bytearray()
+        self._parts = []
+        self._upload_id = None
+        self._written = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._written
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self._written += len(data)
+        while len(self._buffer) >= self._part_size:
+            self._upload_part(bytes(self._buffer[: self._part_size]))
+            del self._buffer[: self._part_size]
+        return len(data)
+
+    def _upload_part(self, body: bytes):
+        if self._upload_id is None:
+            self._upload_id = self._client.create_multipart_upload(
+                Bucket=self._bucket, Key=self._key, ContentType=_content_type(self._key)
+            )["UploadId"]
+        number = len(self._parts) + 1
+        response = self._client.upload_part(
+            Bucket=self._bucket,
+            Key=self._key,
+            UploadId=self._upload_id,
+            PartNumber=number,
+            Body=body,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": number})
+
+    def commit(self):
+        if self._upload_id is None:
+            self._client.put_object(
+                Bucket=self._bucket,
+                Key=self._key,
+                Body=bytes(self._buffer),
+                ContentType=_content_type(self._key),
+            )
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self._client.complete_multipart_upload(
+                Bucket=self._bucket,
+                Key=self._key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        self._buffer.clear()
+
+    def abort(self):
+        if self._upload_id is not None:
+            self._client.abort_multipart_upload(
+                Bucket=self._bucket, Key=self._key, UploadId=self._upload_id
+            )
+
+
+class S3Storage:
+    presigns = True
+
+    def __init__(self):
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs boto3: pip install boto3")
+        if not S3_BUCKET:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+        # boto3 clients are thread-safe: one client and its connection pool
+        # are shared by all requests and worker threads.
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL or None,
+            region_name=S3_REGION or None,
+            config=BotoConfig(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                retries={"max_attempts": 5, "mode": "standard"},
+                s3={"addressing_style": S3_ADDRESSING_STYLE},
+            ),
+        )
+        self.bucket = S3_BUCKET
+        self.part_size = int(S3_MULTIPART_CHUNK_MB * 1024 * 1024)
+
+    def _object_key(self, key: str) -> str:
+        return S3_PREFIX + key.strip("/")
+
+    def _size(self, key: str) -> Optional[int]:
+        """Size of an object, None if there is none."""
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))["ContentLength"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def exists(self, key: str) -> bool:
+        return self._size(key) is not None
+
+    @contextmanager
+    def open_write(self, key: str) -> Iterator[BinaryIO]:
+        writer = _MultipartWriter(self.client, self.bucket, self._object_key(key), self.part_size)
+        try:
+            yield writer
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        # Overwrites aren't detected (that would take a HEAD per write, and
+        # media names are unique); the usage scan corrects them
+        usage_ledger.written(key, writer.tell())
+
+    def put_bytes(self, key: str, data: bytes):
+        with self.open_write(key) as f:
+            f.write(data)
+
+    def put_file(self, key: str, source: Path):
+        """Moves a local file into storage, streaming it part by part."""
+        with open(source, "rb") as src, self.open_write(key) as dst:
+            shutil.copyfileobj(src, dst, self.part_size)
+        os.remove(source)
+
+    def link(self, source_key: str, key: str) -> str:
+        """Server-side copy of `source_key` to `key` (multipart for large objects)."""
+        self.client.copy(
+            {"Bucket": self.bucket, "Key": self._object_key(source_key)},
+            self.bucket,
+            self._object_key(key),
+        )
+        usage_ledger.written(key, self._size(key))
+        return "server_copy"
+
+    def open_read(self, key: str) -> BinaryIO:
+        return self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))["Body"]
+
+    def delete(self, key: str):
+        size = self._size(key)  # for the usage ledger
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+        usage_ledger.removed(key, size)
+
+    def _list_items(self, prefix: str) -> Iterator[dict]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._object_key(prefix) + "/"):
+            yield from page.get("Contents", [])
+
+    def _list_objects(self, prefix: str) -> Iterator[str]:
+        for item in self._list_items(prefix):
+            yield item["Key"]
+
+    def delete_prefix(self, prefix: str):
+        batch = []
+        for object_key in self._list_objects(prefix):
+            batch.append({"Key": object_key})
+            if len(batch) == 1000:  # the DeleteObjects limit
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": batch})
+                batch = []
+        if batch:
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": batch})
+        usage_ledger.removed_prefix(prefix)
+
+    def list(self, prefix: str) -> Iterator[str]:
+        for object_key in self._list_objects(prefix):
+            yield object_key[len(S3_PREFIX) :]
+
+    def measure(self, prefix: str) -> Tuple[int, int]:
+        """(bytes, objects) under a "directory" key, from the listing alone."""
+        total = files = 0
+        for item in self._list_items(prefix):
+            total += item["Size"]
+            files += 1
+        return total, files
+
+    def presigned_url(self, key: str) -> Optional[str]:
+        # Signed locally, no request to the bucket
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._object_key(key)},
+            ExpiresIn=S3_PRESIGN_EXPIRES_SECONDS,
+        )
+
+
+media_storage = S3Storage() if STORAGE_BACKEND == "s3" else LocalStorage()
+
+
+class PresignedMediaFiles:
+    """
+    Mount used instead of the plain static files with a backend that hands
+    out presigned urls: media files are redirected to the bucket, everything
+    else (contact sheets, zips) is served from the local volume.
+    """
+
+    def __init__(self, mount_name: str, local_files):
+        self.mount_name = mount_name
+        self.local_files = local_files
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            path = self.local_files.get_path(scope).replace(os.sep, "/")
+            key = f"{self.mount_name}/{path}"
+            if is_media_key(key):
+                response = RedirectResponse(media_storage.presigned_url(key), status_code=307)
+                await response(scope, receive, send)
+                return
+        await self.local_files(scope, receive, send)
+
+
+def media_files(mount_name: str, local_files):
+    """The ASGI app to mount for `/{mount_name}` with the configured backend."""
+    if media_storage.presigns:
+        return PresignedMediaFiles(mount_name, local_files)
+    return local_files
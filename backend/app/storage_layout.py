@@ -0,0 +1,92 @@
+"""
+Where gallery image files live on disk.
+
+Image urls are always `/galleries/{gallery_id}/images_*/{filename}`. In the
+default "flat" layout that is also the file's path below GALLERIES_ROOT_DIR,
+so every original of a gallery sits in one `images_full` directory. On
+network-backed volumes listing or probing directories with tens of thousands
+of entries gets very slow, so with `STORAGE_LAYOUT=sharded` files go two
+hash-prefix levels deeper instead:
+
+    images_full/IMG_0001.jpg  ->  images_full/5d/e2/IMG_0001.jpg
+
+The prefix is derived from the filename alone, so the url maps to the path
+without any lookup and urls in the metadata stay the same in both layouts.
+`LayoutStaticFiles` serves `/galleries` through this mapping. Existing
+libraries are converted with `python -m app.migrate_layout`.
+"""
+import hashlib
+import os
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from app.config import GALLERIES_ROOT_DIR, STORAGE_LAYOUT
+from app.file_offload import OffloadStaticFiles
+
+LAYOUTS = ("flat", "sharded")
+SIZE_DIR_NAMES = ("images_full", "images_small", "images_thumb")
+
+
+def shard_of(filename: str) -> str:
+    """The two-level prefix of a file in the sharded layout, e.g. "5d/e2"."""
+    digest = hashlib.md5(filename.encode("utf-8")).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}"
+
+
+def _relative_path(gallery_id: str, size_dir: str, filename: str, layout: str) -> str:
+    if layout == "sharded":
+        return f"{gallery_id}/{size_dir}/{shard_of(filename)}/{filename}"
+    return f"{gallery_id}/{size_dir}/{filename}"
+
+
+def _candidates(gallery_id: str, size_dir: str, filename: str) -> List[str]:
+    # The configured layout first; the other one only matters for files a
+    # migration hasn't moved (yet).
+    other = "flat" if STORAGE_LAYOUT == "sharded" else "sharded"
+    return [
+        _relative_path(gallery_id, size_dir, filename, STORAGE_LAYOUT),
+        _relative_path(gallery_id, size_dir, filename, other),
+    ]
+
+
+def image_path(gallery_id: str, size_dir: str, filename: str, layout: Optional[str] = None) -> Path:
+    """Where a gallery image file is written in the configured (or given) layout."""
+    return GALLERIES_ROOT_DIR / _relative_path(
+        gallery_id, size_dir, filename, layout or STORAGE_LAYOUT
+    )
+
+
+def resolve_image_path(gallery_id: str, size_dir: str, filename: str) -> Path:
+    """The path of an existing image file, whichever layout it is stored in."""
+    candidates = _candidates(gallery_id, size_dir, filename)
+    for relative in candidates:
+        path = GALLERIES_ROOT_DIR / relative
+        if path.exists():
+            return path
+    return GALLERIES_ROOT_DIR / candidates[0]
+
+
+def iter_image_files(gallery_id: str, size_dir: str) -> Iterator[Path]:
+    """All files of one size of a gallery, in either layout."""
+    for dirpath, _, filenames in os.walk(GALLERIES_ROOT_DIR / gallery_id / size_dir):
+        for filename in filenames:
+            yield Path(dirpath) / filename
+
+
+class LayoutStaticFiles(OffloadStaticFiles):
+    """
+    StaticFiles for GALLERIES_ROOT_DIR that maps image urls to the storage
+    layout. Other paths (zips, contact sheets, ...) are served as they are.
+    """
+
+    def lookup_path(self, path: str):
+        parts = path.split("/")
+        if any(part.startswith(".") for part in parts):
+            return "", None  # hidden dirs, e.g. partial uploads, are never served
+        if len(parts) == 3 and parts[1] in SIZE_DIR_NAMES:
+            for relative in _candidates(*parts):
+                full_path, stat_result = super().lookup_path(relative)
+                if stat_result is not None:
+                    return full_path, stat_result
+            return "", None
+        return super().lookup_path(path)
@@ -0,0 +1,159 @@
+"""
+In-memory cache of thumbnail files.
+
+Gallery grids and listings request the same `images_thumb` files (also used
+as cover images) over and over; every request is an open, stat and read on
+the storage volume. `ThumbnailCacheFiles` wraps the `/galleries` mount and
+keeps the bytes of recently served thumbnails together with their response
+headers (ETag and Last-Modified computed once, identical to the uncached
+response). Packed thumbnails (see app.thumb_pack) are read from their pack.
+Hot thumbnails are thus served with no disk I/O at all.
+
+The cache is per worker process, least recently used entries are dropped
+above THUMB_CACHE_MB. Thumbnail files are never rewritten in place (a new
+upload gets a new name), so entries only go stale when an image or gallery
+is deleted: app.database invalidates them then.
+"""
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from fastapi.responses import FileResponse, Response
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
+
+from app.config import THUMB_CACHE_MAX_FILE_KB, THUMB_CACHE_MB
+from app.metrics import CACHE_ENTRIES, THUMB_CACHE_BYTES, THUMB_CACHE_REQUESTS
+from app.thumb_pack import packed_response_parts
+
+# Rough per-entry cost of the key, tuple and headers besides the body
+ENTRY_OVERHEAD_BYTES = 512
+
+CacheEntry = Tuple[bytes, Dict[str, str]]
+
+
+class ThumbnailCache:
+    def __init__(self, budget: int, max_file_size: int):
+        self.budget = budget
+        self.max_file_size = max_file_size
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.nbytes = 0
+        # Bumped by every invalidation: a load that raced with one doesn't
+        # insert what it read
+        self.generation = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, body: bytes, headers: Dict[str, str]):
+        self._drop(key)
+        self.entries[key] = (body, headers)
+        self.nbytes += len(body) + ENTRY_OVERHEAD_BYTES
+        while self.nbytes > self.budget and self.entries:
+            self._drop(next(iter(self.entries)))
+        THUMB_CACHE_BYTES.set(self.nbytes)
+
+    def _drop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= len(entry[0]) + ENTRY_OVERHEAD_BYTES
+
+    def invalidate(self, key: str):
+        self.generation += 1
+        self._drop(key)
+        THUMB_CACHE_BYTES.set(self.nbytes)
+
+    def invalidate_prefix(self, prefix: str):
+        self.generation += 1
+        for key in [k for k in self.entries if k.startswith(prefix)]:
+            self._drop(key)
+        THUMB_CACHE_BYTES.set(self.nbytes)
+
+
+thumbnail_cache = ThumbnailCache(
+    budget=int(THUMB_CACHE_MB * 1024 * 1024),
+    max_file_size=int(THUMB_CACHE_MAX_FILE_KB * 1024),
+)
+CACHE_ENTRIES.labels("thumbnails").set_function(lambda: len(thumbnail_cache.entries))
+
+_hits = THUMB_CACHE_REQUESTS.labels("hit")
+_misses = THUMB_CACHE_REQUESTS.labels("miss")
+
+
+def _read_thumbnail(files, key: str, relative: str) -> Optional[CacheEntry]:
+    packed = packed_response_parts(key)
+    if packed is not None:
+        return packed
+    full_path, stat_result = files.lookup_path(relative)
+    if stat_result is None or stat_result.st_size > thumbnail_cache.max_file_size:
+        return None
+    # Same headers as the file response would have (no file I/O for these)
+    headers = dict(FileResponse(full_path, stat_result=stat_result).headers)
+    with open(full_path, "rb") as f:
+        body = f.read()
+    if len(body) != stat_result.st_size:
+        return None  # changed while being read
+    return body, headers
+
+
+class ThumbnailCacheFiles:
+    """
+    Wraps the StaticFiles app of `/galleries`: GET/HEAD requests for
+    thumbnails are answered from the cache, everything else (other sizes,
+    zips, range requests) goes to the wrapped app.
+    """
+
+    def __init__(self, files, mount_name: str = "galleries"):
+        self.files = files
+        self.mount_name = mount_name
+
+    def get_path(self, scope) -> str:
+        return self.files.get_path(scope)
+
+    def _thumbnail_path(self, scope) -> Optional[str]:
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            return None
+        path = self.files.get_path(scope).replace(os.sep, "/")
+        parts = path.split("/")
+        if len(parts) != 3 or parts[1] != "images_thumb" or parts[0].startswith("."):
+            return None
+        return path
+
+    async def __call__(self, scope, receive, send):
+        path = self._thumbnail_path(scope) if thumbnail_cache.enabled else None
+        if path is None:
+            await self.files(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        if "range" in request_headers:
+            await self.files(scope, receive, send)
+            return
+
+        key = f"{self.mount_name}/{path}"
+        entry = thumbnail_cache.get(key)
+        if entry is not None:
+            _hits.inc()
+        else:
+            _misses.inc()
+            generation = thumbnail_cache.generation
+            entry = await asyncio.to_thread(_read_thumbnail, self.files, key, path)
+            if entry is None:  # missing or too large: the files app answers
+                await self.files(scope, receive, send)
+                return
+            if generation == thumbnail_cache.generation:
+                thumbnail_cache.put(key, *entry)
+
+        body, headers = entry
+        if self.files.is_not_modified(Headers(headers), request_headers):
+            response = NotModifiedResponse(Headers(headers))
+        else:
+            response = Response(body if scope["method"] == "GET" else b"", headers=headers)
+        await response(scope, receive, send)
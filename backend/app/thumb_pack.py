@@ -0,0 +1,450 @@
+"""
+Packed renditions: with PACKED_SIZES set (e.g. "thumb" or "thumb,small"),
+those sizes of a gallery are not written as one file per image but appended
+to a single pack file, `<gallery>/.pack/images_thumb.pack`, so a gallery
+costs a handful of inodes instead of one per image and size. Urls don't
+change: `/galleries/<id>/images_thumb/<file>` is served from the pack.
+
+A pack is a header followed by records, each `name length, data length,
+mtime, deleted flag, name, data`; deleting appends a tombstone record. The
+offset index (name -> offset, length) is rebuilt by reading the record
+headers when a pack is first used, and data is served as slices of a
+read-only mmap of the file: no open() per request. Records cut off by a
+crash are ignored and overwritten by the next append.
+
+Several processes may use a pack (uvicorn workers, replicas on a shared
+volume, the CLI below). Appends and compactions hold an exclusive flock on
+`<pack>.lock`, and each process re-reads its index when the file's inode or
+size isn't what it last saw: before writing, when a name is missing, and
+at most a second after another process deleted one.
+
+Deleted and replaced records stay in the file until a background task
+compacts packs with more than PACK_COMPACT_RATIO dead bytes: live records
+are copied into a new file which atomically replaces the pack. Image files
+written before packing was enabled are still read from their own files;
+`python -m app.thumb_pack pack` moves them into packs.
+
+Only for STORAGE_BACKEND=local (see app.storage).
+"""
+import argparse
+import asyncio
+import fcntl
+import hashlib
+import mimetypes
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from email.utils import formatdate
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from fastapi.responses import Response
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
+
+from app.config import GALLERIES_ROOT_DIR, PACK_COMPACT_RATIO, PACKED_SIZES
+from app.metrics import CACHE_ENTRIES
+
+PACK_DIR = ".pack"
+MAGIC = b"PHOTOPIA-PACK\x01\n"
+# name length, data length, mtime, deleted
+_RECORD = struct.Struct("<HIdB")
+COMPACT_INTERVAL_SECONDS = 300
+# Packs smaller than this are not worth compacting
+COMPACT_MIN_BYTES = 1024 * 1024
+# Mapped packs kept open (each mapping holds a file descriptor)
+MAX_OPEN_MAPS = 64
+# How often reads look for changes by other processes (e.g. deletions)
+REFRESH_INTERVAL_SECONDS = 1
+
+# One lock for all packs: appends and index lookups are short, compaction
+# only takes it to snapshot the index and to swap the file.
+_lock = threading.RLock()
+
+
+class PackEntry(NamedTuple):
+    offset: int
+    length: int
+    mtime: float
+
+
+def _record(name: str, data: bytes, mtime: float, deleted: bool = False) -> bytes:
+    encoded = name.encode("utf-8")
+    return _RECORD.pack(len(encoded), len(data), mtime, deleted) + encoded + data
+
+
+def _scan(path: Path) -> Tuple[Dict[str, PackEntry], int, int]:
+    """(index, end of the last complete record, live data bytes) of a pack file."""
+    index: Dict[str, PackEntry] = {}
+    live = 0
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return index, 0, 0
+    with f:
+        file_size = os.fstat(f.fileno()).st_size
+        if f.read(len(MAGIC)) != MAGIC:
+            if file_size < len(MAGIC):
+                return index, 0, 0  # the header itself was cut off
+            raise ValueError(f"Not a pack file: {path}")
+        offset = len(MAGIC)
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                break
+            name_length, data_length, mtime, deleted = _RECORD.unpack(header)
+            data_offset = offset + _RECORD.size + name_length
+            end = data_offset + data_length
+            if end > file_size:
+                break
+            name = f.read(name_length).decode("utf-8")
+            f.seek(end)
+            previous = index.pop(name, None)
+            if previous is not None:
+                live -= previous.length
+            if not deleted:
+                index[name] = PackEntry(data_offset, data_length, mtime)
+                live += data_length
+            offset = end
+    return index, offset, live
+
+
+def _identity(path: Path) -> Optional[Tuple[int, int]]:
+    """(inode, size) of a pack file: changes when another process writes it."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size
+
+
+class Pack:
+    def __init__(self, path: Path):
+        self.path = path
+        self._map: Optional[mmap.mmap] = None
+        self._load()
+
+    def _load(self):
+        self._close_map()
+        # Taken before scanning: a write meanwhile shows up as a change
+        self._identity = _identity(self.path)
+        self._checked = time.monotonic()
+        self.index, self.size, self.live_bytes = _scan(self.path)
+
+    def _refresh(self):
+        """Re-reads the index if another process appended to or compacted the pack."""
+        self._checked = time.monotonic()
+        if _identity(self.path) != self._identity:
+            self._load()
+
+    def _refresh_if_due(self, name: str):
+        if name not in self.index or time.monotonic() - self._checked > REFRESH_INTERVAL_SECONDS:
+            self._refresh()
+
+    @contextmanager
+    def _locked(self):
+        """Excludes the writers of other processes (and threads) from the pack."""
+        with open(self.path.with_name(self.path.name + ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield  # released when the file is closed
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            _open_maps.pop(self.path, None)
+
+    def _mapped(self, end: int) -> mmap.mmap:
+        """The mapping, remapped if the file grew past it."""
+        if self._map is None or len(self._map) < end:
+            self._close_map()
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _open_maps[self.path] = self
+            while len(_open_maps) > MAX_OPEN_MAPS:
+                _, oldest = _open_maps.popitem(last=False)
+                oldest._close_map()
+        _open_maps.move_to_end(self.path)
+        return self._map
+
+    def __contains__(self, name: str) -> bool:
+        with _lock:
+            self._refresh_if_due(name)
+            return name in self.index
+
+    def read(self, name: str) -> Optional[Tuple[bytes, PackEntry]]:
+        with _lock:
+            self._refresh_if_due(name)
+            entry = self.index.get(name)
+            if entry is None:
+                return None
+            mapped = self._mapped(entry.offset + entry.length)
+            return mapped[entry.offset : entry.offset + entry.length], entry
+
+    def _append(self, record: bytes):
+        """Appends a record, holding the file lock and an up to date index."""
+        self._refresh()
+        with open(self.path, "ab") as f:
+            if f.tell() != self.size:
+                # Past the last complete record: with the lock held no other
+                # writer is busy, so this was cut off by a crash
+                f.truncate(self.size)
+            if self.size == 0:
+                f.write(MAGIC)
+                self.size = len(MAGIC)
+            f.write(record)
+            f.flush()
+            stat = os.fstat(f.fileno())
+            self._identity = (stat.st_ino, stat.st_size)
+        return self.size
+
+    def append(self, name: str, data: bytes, mtime: Optional[float] = None):
+        mtime = mtime if mtime is not None else time.time()
+        record = _record(name, data, mtime)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._locked(), _lock:
+            start = self._append(record)
+            previous = self.index.get(name)
+            if previous is not None:
+                self.live_bytes -= previous.length
+            data_offset = start + len(record) - len(data)
+            self.index[name] = PackEntry(data_offset, len(data), mtime)
+            self.live_bytes += len(data)
+            self.size = start + len(record)
+
+    def delete(self, name: str) -> bool:
+        with self._locked(), _lock:
+            self._refresh()
+            entry = self.index.get(name)
+            if entry is None:
+                return False
+            record = _record(name, b"", time.time(), deleted=True)
+            self.size = self._append(record) + len(record)
+            del self.index[name]
+            self.live_bytes -= entry.length
+            return True
+
+    def needs_compaction(self) -> bool:
+        with _lock:
+            dead = self.size - len(MAGIC) - self.live_bytes
+            return self.size >= COMPACT_MIN_BYTES and dead > self.size * PACK_COMPACT_RATIO
+
+    def compact(self):
+        """Rewrites the pack with only its live records."""
+        # Writers wait until the new file is in place; readers of this
+        # process go on (records are never changed in place), other
+        # processes keep reading their mapping of the old file until they
+        # miss a name and re-read the index
+        with self._locked():
+            with _lock:
+                self._refresh()
+                snapshot = dict(self.index)
+            temp = self.path.with_name(self.path.name + ".tmp")
+            with open(self.path, "rb") as src, open(temp, "wb") as dst:
+                dst.write(MAGIC)
+                for name, entry in snapshot.items():
+                    src.seek(entry.offset)
+                    dst.write(_record(name, src.read(entry.length), entry.mtime))
+            with _lock:
+                os.replace(temp, self.path)
+                self._load()
+
+
+_packs: Dict[Path, Pack] = {}
+_open_maps: "OrderedDict[Path, Pack]" = OrderedDict()
+CACHE_ENTRIES.labels("packs").set_function(lambda: len(_packs))
+
+
+def pack_path(gallery_id: str, size_dir: str) -> Path:
+    return GALLERIES_ROOT_DIR / gallery_id / PACK_DIR / f"{size_dir}.pack"
+
+
+def get_pack(gallery_id: str, size_dir: str) -> Pack:
+    path = pack_path(gallery_id, size_dir)
+    with _lock:
+        pack = _packs.get(path)
+        if pack is None:
+            pack = _packs[path] = Pack(path)
+        return pack
+
+
+def packed_location(key: str) -> Optional[Tuple[str, str, str]]:
+    """(gallery id, size dir, filename) of a media key stored in a pack."""
+    if not PACKED_SIZES:
+        return None
+    parts = key.strip("/").split("/")
+    if len(parts) != 4 or parts[0] != "galleries" or parts[2] not in PACKED_SIZES:
+        return None
+    if any(p in ("", ".", "..") or p.startswith(".") for p in parts[1:]):
+        return None
+    return parts[1], parts[2], parts[3]
+
+
+def read_packed(key: str) -> Optional[Tuple[bytes, PackEntry]]:
+    location = packed_location(key)
+    if location is None:
+        return None
+    gallery_id, size_dir, filename = location
+    return get_pack(gallery_id, size_dir).read(filename)
+
+
+def packed_names(gallery_id: str, size_dir: str) -> List[str]:
+    with _lock:
+        return list(get_pack(gallery_id, size_dir).index)
+
+
+def packed_usage(gallery_id: str, size_dir: str) -> Tuple[int, int]:
+    """(bytes, files) live in a pack."""
+    with _lock:
+        pack = get_pack(gallery_id, size_dir)
+        pack._refresh()
+        return pack.live_bytes, len(pack.index)
+
+
+def packed_length(key: str) -> Optional[int]:
+    """Size of a packed file, None if it isn't in its pack."""
+    location = packed_location(key)
+    if location is None:
+        return None
+    with _lock:
+        entry = get_pack(*location[:2]).index.get(location[2])
+        return entry.length if entry is not None else None
+
+
+def forget_packs(gallery_id: str):
+    """Drops the packs of a gallery whose directory is being deleted."""
+    with _lock:
+        for size_dir in PACKED_SIZES:
+            pack = _packs.pop(pack_path(gallery_id, size_dir), None)
+            if pack is not None:
+                pack._close_map()
+
+
+def packed_response_parts(key: str) -> Optional[Tuple[bytes, Dict[str, str]]]:
+    """(body, headers) of a packed file, like a file response would have."""
+    found = read_packed(key)
+    if found is None:
+        return None
+    body, entry = found
+    # Independent of the offset, so compaction doesn't change it
+    etag_base = f"{key}-{entry.mtime}-{entry.length}"
+    headers = {
+        "content-type": mimetypes.guess_type(key)[0] or "application/octet-stream",
+        "content-length": str(entry.length),
+        "last-modified": formatdate(entry.mtime, usegmt=True),
+        "etag": f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"',
+    }
+    return body, headers
+
+
+class PackedFiles:
+    """
+    Wraps the StaticFiles app of `/galleries`: GET/HEAD requests for packed
+    renditions are answered from their pack, everything else (including
+    files stored before packing was enabled) goes to the wrapped app.
+    """
+
+    def __init__(self, files, mount_name: str = "galleries"):
+        self.files = files
+        self.mount_name = mount_name
+
+    def get_path(self, scope) -> str:
+        return self.files.get_path(scope)
+
+    def lookup_path(self, path: str):
+        return self.files.lookup_path(path)
+
+    def is_not_modified(self, response_headers, request_headers) -> bool:
+        return self.files.is_not_modified(response_headers, request_headers)
+
+    async def __call__(self, scope, receive, send):
+        parts = None
+        if PACKED_SIZES and scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            key = f"{self.mount_name}/{self.files.get_path(scope).replace(os.sep, '/')}"
+            if packed_location(key) is not None:
+                # Off the event loop: the first lookup in a gallery scans its
+                # pack, and reads from the map can fault pages in from disk
+                parts = await asyncio.to_thread(packed_response_parts, key)
+        if parts is None:
+            await self.files(scope, receive, send)
+            return
+        body, headers = parts
+        if self.files.is_not_modified(Headers(headers), Headers(scope=scope)):
+            response = NotModifiedResponse(Headers(headers))
+        else:
+            response = Response(body if scope["method"] == "GET" else b"", headers=headers)
+        await response(scope, receive, send)
+
+
+def compact_gallery_packs() -> int:
+    """Compacts the loaded packs with too many dead bytes. Returns how many."""
+    with _lock:
+        packs = list(_packs.values())
+    compacted = 0
+    for pack in packs:
+        if pack.needs_compaction():
+            try:
+                pack.compact()
+                compacted += 1
+            except FileNotFoundError:
+                pass  # gallery deleted meanwhile
+    return compacted
+
+
+async def compact_packs():
+    """Background task: compacts packs after deletions."""
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL_SECONDS)
+        compacted = await asyncio.to_thread(compact_gallery_packs)
+        if compacted:
+            print(f"Compacted {compacted} pack file(s)")
+
+
+def pack_gallery(gallery_id: str, dry_run: bool = False) -> int:
+    """Moves a gallery's files of the packed sizes into its packs."""
+    from app.storage_layout import iter_image_files
+
+    moved = 0
+    for size_dir in sorted(PACKED_SIZES):
+        pack = get_pack(gallery_id, size_dir)
+        for path in list(iter_image_files(gallery_id, size_dir)):
+            if path.name in pack:
+                continue
+            moved += 1
+            if dry_run:
+                continue
+            pack.append(path.name, path.read_bytes(), path.stat().st_mtime)
+            os.remove(path)
+    return moved
+
+
+def main():
+    from app.database import list_gallery_ids
+
+    parser = argparse.ArgumentParser(description="Move rendition files into packs (PACKED_SIZES)")
+    parser.add_argument("command", choices=["pack", "compact"])
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    if not PACKED_SIZES:
+        raise SystemExit("PACKED_SIZES is not set")
+
+    for gallery_id in list_gallery_ids():
+        if args.command == "pack":
+            moved = pack_gallery(gallery_id, args.dry_run)
+            if moved:
+                print(f"{gallery_id}: {'would pack' if args.dry_run else 'packed'} {moved} file(s)")
+        else:
+            for size_dir in sorted(PACKED_SIZES):
+                pack = get_pack(gallery_id, size_dir)
+                if pack.size and not args.dry_run:
+                    before = pack.size
+                    pack.compact()
+                    print(f"{gallery_id}/{size_dir}: {before} -> {pack.size} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+State of resumable uploads (see app.routers.uploads).
+
+Every upload is a `<id>.part` file in UPLOAD_STAGING_DIR that PATCH requests
+append to, plus an `<id>.json` with what the upload is for. The offset is the
+size of the part file, so uploads survive restarts and a PATCH that broke off
+halfway keeps what arrived. Uploads without progress for
+UPLOAD_EXPIRY_SECONDS are deleted by a background task.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from app.config import UPLOAD_EXPIRY_SECONDS, UPLOAD_STAGING_DIR
+
+SWEEP_INTERVAL_SECONDS = 600
+_UPLOAD_ID = re.compile(r"[0-9a-f]{32}")
+
+# One request at a time may write to or finalize an upload
+upload_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _paths(upload_id: str) -> Optional[Tuple[Path, Path]]:
+    if not _UPLOAD_ID.fullmatch(upload_id):
+        return None
+    return UPLOAD_STAGING_DIR / f"{upload_id}.part", UPLOAD_STAGING_DIR / f"{upload_id}.json"
+
+
+def part_path(upload_id: str) -> Path:
+    return UPLOAD_STAGING_DIR / f"{upload_id}.part"
+
+
+def create_upload(gallery_id: str, filename: str, length: int) -> dict:
+    upload_id = uuid.uuid4().hex
+    UPLOAD_STAGING_DIR.mkdir(parents=True, exist_ok=True)
+    info = {
+        "id": upload_id,
+        "galleryId": gallery_id,
+        "filename": filename,
+        "length": length,
+        "created": time.time(),
+    }
+    part, info_path = _paths(upload_id)
+    part.touch()
+    with open(info_path, "w") as f:
+        json.dump(info, f)
+    return dict(info, offset=0, expires=time.time() + UPLOAD_EXPIRY_SECONDS)
+
+
+def get_upload(upload_id: str) -> Optional[dict]:
+    """The upload with its current `offset` and `expires` time, None if unknown or expired."""
+    paths = _paths(upload_id)
+    if paths is None:
+        return None
+    part, info_path = paths
+    try:
+        with open(info_path, "r") as f:
+            info = json.load(f)
+        stat = part.stat()
+    except (OSError, ValueError):
+        return None
+    expires = stat.st_mtime + UPLOAD_EXPIRY_SECONDS
+    if expires < time.time():
+        delete_upload(upload_id)
+        return None
+    return dict(info, offset=stat.st_size, expires=expires)
+
+
+def delete_upload(upload_id: str):
+    paths = _paths(upload_id)
+    if paths is None:
+        return
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    upload_locks.pop(upload_id, None)
+
+
+def sweep_expired_uploads(now: Optional[float] = None) -> int:
+    """Deletes uploads without progress for UPLOAD_EXPIRY_SECONDS. Returns how many."""
+    now = time.time() if now is None else now
+    if not UPLOAD_STAGING_DIR.is_dir():
+        return 0
+    expired = 0
+    for entry in os.scandir(UPLOAD_STAGING_DIR):
+        upload_id, _, suffix = entry.name.partition(".")
+        if suffix != "json":
+            continue
+        try:
+            last_activity = os.stat(part_path(upload_id)).st_mtime
+        except FileNotFoundError:
+            last_activity = entry.stat().st_mtime  # finalize was interrupted
+        if now - last_activity > UPLOAD_EXPIRY_SECONDS:
+            lock = upload_locks.get(upload_id)
+            if lock is None or not lock.locked():
+                delete_upload(upload_id)
+                expired += 1
+    return expired
+
+
+async def expire_abandoned_uploads():
+    """Background task: deletes expired uploads periodically."""
+    while True:
+        expired = await asyncio.to_thread(sweep_expired_uploads)
+        if expired:
+            print(f"Deleted {expired} expired upload(s)")
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
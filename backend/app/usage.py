@@ -0,0 +1,347 @@
+"""
+Storage usage per gallery, moodboard and API key, and quotas.
+
+Bytes and files of media are counted in memory per gallery and moodboard.
+`media_storage` updates the counts as files are written, linked and deleted,
+so uploads, deletions, purges, pruned attachments, transfers and restores
+are all accounted and reading the usage costs nothing. A background scan
+(at startup, then every USAGE_SCAN_SECONDS) recounts everything from
+storage and corrects drift: writes by other replicas or processes (e.g.
+`python -m app.thumb_pack`), overwritten S3 objects, a crash between a write
+and its accounting. Files shared through links (see app.routers.transfers)
+count for every gallery or moodboard having them.
+
+Galleries and moodboards created through the API are owned by the API key
+that created them (kept in USAGE_OWNERS_FILE), and a key's usage is the sum
+of its objects'. Older ones have no owner and only count towards their own
+quota.
+
+Quotas (QUOTA_KEY_MB, QUOTA_GALLERY_MB, QUOTA_MOODBOARD_MB; 0 is off) are
+checked before an upload is processed, with its size plus an estimate of
+the renditions stored besides it: one that would exceed the gallery's or
+moodboard's quota, or its owner's, gets a 507. The estimate is reserved
+until the upload is stored or failed, so concurrent uploads can't all pass
+the check and exceed a quota together.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app.config import (
+    GALLERIES_ROOT_DIR,
+    QUOTA_GALLERY_MB,
+    QUOTA_KEY_MB,
+    QUOTA_MOODBOARD_MB,
+    USAGE_OWNERS_FILE,
+    USAGE_SCAN_SECONDS,
+)
+from app.metrics import QUOTA_REJECTIONS, STORAGE_USAGE_BYTES, STORAGE_USAGE_FILES
+
+KINDS = ("gallery", "moodboard")
+PLURALS = {"gallery": "galleries", "moodboard": "moodboards"}
+# Media key prefix -> kind of object its second part names
+KEY_KINDS = {"galleries": "gallery", "moodboard-media": "moodboard"}
+QUOTAS = {
+    "key": int(QUOTA_KEY_MB * 1024 * 1024),
+    "gallery": int(QUOTA_GALLERY_MB * 1024 * 1024),
+    "moodboard": int(QUOTA_MOODBOARD_MB * 1024 * 1024),
+}
+
+# Renditions a gallery upload adds besides its original, before they exist:
+# the small one (at most 1920x1080) is rarely larger than the original, the
+# thumbnail is a few dozen KB
+SMALL_RENDITION_MAX_BYTES = 2 * 1024 * 1024
+THUMB_RENDITION_MAX_BYTES = 128 * 1024
+
+Object = Tuple[str, str]  # (kind, id)
+
+
+def estimated_bytes(kind: str, incoming: int) -> int:
+    """Bytes an upload of `incoming` bytes will occupy once stored."""
+    if kind != "gallery":
+        return incoming  # moodboards keep one downscaled copy
+    return incoming + min(incoming, SMALL_RENDITION_MAX_BYTES) + min(incoming, THUMB_RENDITION_MAX_BYTES)
+
+
+def object_of(key: str) -> Optional[Object]:
+    """The gallery or moodboard a media key belongs to."""
+    parts = key.strip("/").split("/")
+    if len(parts) != 4 or parts[0] not in KEY_KINDS:
+        return None
+    return KEY_KINDS[parts[0]], parts[1]
+
+
+class UsageLedger:
+    def __init__(self, owners_file: str):
+        self.owners_file = owners_file
+        # (kind, id) -> [bytes, files]
+        self.objects: Dict[Object, List[int]] = {}
+        # Sums of the above per kind and per owning key
+        self.totals: Dict[str, List[int]] = {kind: [0, 0] for kind in KINDS}
+        self.keys: Dict[str, List[int]] = {}
+        self.owners: Dict[Object, str] = {}
+        # Estimated bytes of uploads being processed, per object and owner
+        self.pending: Dict[Object, int] = {}
+        self.pending_keys: Dict[str, int] = {}
+        # time.monotonic() of each object's last counted change: a scan
+        # keeps the live counts of objects that changed while it ran
+        self._changed: Dict[Object, float] = {}
+        self._lock = threading.Lock()  # counted from worker threads
+        self._file_lock = threading.Lock()
+        self.scanned_at: Optional[float] = None
+        self.scan_seconds: Optional[float] = None
+        self._load_owners()
+
+    def _read_owners(self) -> Dict[str, str]:
+        try:
+            with open(self.owners_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _update_owners(self, name: str, owner: Optional[str]):
+        """Sets or (with None) removes one entry of the owners file."""
+        with self._file_lock:
+            owners = self._read_owners()
+            if owner is None:
+                if owners.pop(name, None) is None:
+                    return
+            else:
+                owners[name] = owner
+            temp = f"{self.owners_file}.tmp"
+            with open(temp, "w") as f:
+                json.dump(owners, f)
+            os.replace(temp, self.owners_file)
+
+    def _load_owners(self):
+        owners = {}
+        for name, owner in self._read_owners().items():
+            kind, _, object_id = name.partition("/")
+            owners[(kind, object_id)] = owner
+        with self._lock:
+            self.owners = owners
+            self._recount()
+
+    def _recount(self):
+        """Rebuilds the sums from the per-object counts."""
+        totals = {kind: [0, 0] for kind in KINDS}
+        keys: Dict[str, List[int]] = {}
+        for obj, (nbytes, files) in self.objects.items():
+            for counts in (totals[obj[0]], keys.setdefault(self.owners.get(obj), [0, 0])):
+                counts[0] += nbytes
+                counts[1] += files
+        keys.pop(None, None)
+        self.totals = totals
+        self.keys = keys
+
+    def _add(self, obj: Object, nbytes: int, files: int):
+        counts = self.objects.setdefault(obj, [0, 0])
+        sums = [self.totals[obj[0]]]
+        owner = self.owners.get(obj)
+        if owner is not None:
+            sums.append(self.keys.setdefault(owner, [0, 0]))
+        for c in [counts] + sums:
+            c[0] += nbytes
+            c[1] += files
+        self._changed[obj] = time.monotonic()
+
+    def written(self, key: str, size: int, replaced_size: Optional[int] = None):
+        """A media file of `size` bytes was stored (over one of `replaced_size`)."""
+        obj = object_of(key)
+        if obj is None:
+            return
+        with self._lock:
+            if replaced_size is None:
+                self._add(obj, size, 1)
+            else:
+                self._add(obj, size - replaced_size, 0)
+
+    def removed(self, key: str, size: Optional[int]):
+        """A media file was deleted (`size` None: there was none)."""
+        obj = object_of(key)
+        if obj is None or size is None:
+            return
+        with self._lock:
+            self._add(obj, -size, -1)
+
+    def removed_prefix(self, prefix: str):
+        """All media of a gallery or moodboard were deleted with it."""
+        parts = prefix.strip("/").split("/")
+        if len(parts) != 2 or parts[0] not in KEY_KINDS:
+            return
+        obj = (KEY_KINDS[parts[0]], parts[1])
+        with self._lock:
+            counts = self.objects.get(obj)
+            if counts is not None:
+                self._add(obj, -counts[0], -counts[1])
+                del self.objects[obj]
+            had_owner = self.owners.pop(obj, None) is not None
+        if had_owner:
+            self._update_owners(f"{obj[0]}/{obj[1]}", None)
+
+    def set_owner(self, kind: str, object_id: str, key_name: Optional[str]):
+        """Records the API key owning a new gallery or moodboard."""
+        if not key_name:
+            return
+        self._update_owners(f"{kind}/{object_id}", key_name)
+        obj = (kind, object_id)
+        with self._lock:
+            counts = self.objects.get(obj, [0, 0])
+            previous = self.owners.get(obj)
+            if previous is not None:
+                self.keys[previous][0] -= counts[0]
+                self.keys[previous][1] -= counts[1]
+            self.owners[obj] = key_name
+            key_counts = self.keys.setdefault(key_name, [0, 0])
+            key_counts[0] += counts[0]
+            key_counts[1] += counts[1]
+
+    def usage(self, kind: str, object_id: str) -> Tuple[int, int]:
+        counts = self.objects.get((kind, object_id), (0, 0))
+        return counts[0], counts[1]
+
+    def reconcile(self, measured: Dict[Object, List[int]], started: float):
+        """Replaces the counts with a scan's, started at time.monotonic() `started`."""
+        self._load_owners()  # also picks up objects created by other replicas
+        with self._lock:
+            recent = {obj for obj, t in self._changed.items() if t > started}
+            objects = {}
+            for obj in measured.keys() | recent:
+                if obj in recent:
+                    # Changed while scanning: the live counts are more recent
+                    if obj in self.objects:
+                        objects[obj] = self.objects[obj]
+                else:
+                    objects[obj] = measured[obj]
+            self.objects = objects
+            self._changed = {obj: self._changed[obj] for obj in recent}
+            self._recount()
+            self.scanned_at = time.time()
+            self.scan_seconds = time.monotonic() - started
+
+    def _exceeded(self, kind: str, object_id: str, nbytes: int) -> Optional[Tuple[str, int, int]]:
+        """(quota, limit, used) of the first quota `nbytes` more would exceed. Holds the lock."""
+        obj = (kind, object_id)
+        checks = [(kind, QUOTAS[kind], self.usage(kind, object_id)[0] + self.pending.get(obj, 0))]
+        owner = self.owners.get(obj)
+        if owner is not None:
+            used = self.keys.get(owner, [0, 0])[0] + self.pending_keys.get(owner, 0)
+            checks.append(("key", QUOTAS["key"], used))
+        for quota, limit, used in checks:
+            if limit and used + nbytes > limit:
+                return quota, limit, used
+        return None
+
+    def _reject(self, kind: str, object_id: str, nbytes: int, exceeded: Tuple[str, int, int]):
+        quota, limit, used = exceeded
+        QUOTA_REJECTIONS.labels(quota).inc()
+        owner = self.owners.get((kind, object_id))
+        whose = f"API key '{owner}'" if quota == "key" else f"{kind} '{object_id}'"
+        raise HTTPException(
+            status_code=507,
+            detail=f"Storage quota of {whose} exceeded: {used} of {limit} bytes used, upload needs about {nbytes}",
+        )
+
+    def check_quota(self, kind: str, object_id: str, incoming: int):
+        """Raises 507 if an upload of `incoming` bytes would exceed a quota of the object or its owner."""
+        nbytes = estimated_bytes(kind, incoming)
+        with self._lock:
+            exceeded = self._exceeded(kind, object_id, nbytes)
+        if exceeded is not None:
+            self._reject(kind, object_id, nbytes, exceeded)
+
+    @contextmanager
+    def reserve_quota(self, kind: str, object_id: str, incoming: int) -> Iterator[None]:
+        """`check_quota`, with the bytes counted as used until the upload is stored or failed."""
+        nbytes = estimated_bytes(kind, incoming)
+        obj = (kind, object_id)
+        with self._lock:
+            exceeded = self._exceeded(kind, object_id, nbytes)
+            owner = self.owners.get(obj)
+            if exceeded is None:
+                self.pending[obj] = self.pending.get(obj, 0) + nbytes
+                if owner is not None:
+                    self.pending_keys[owner] = self.pending_keys.get(owner, 0) + nbytes
+        if exceeded is not None:
+            self._reject(kind, object_id, nbytes, exceeded)
+        try:
+            yield
+        finally:
+            # Once stored, the files are counted themselves
+            with self._lock:
+                for pending, name in ((self.pending, obj), (self.pending_keys, owner)):
+                    if name is None:
+                        continue
+                    pending[name] -= nbytes
+                    if not pending[name]:
+                        del pending[name]
+
+    def stats(self, top: Optional[int] = None) -> dict:
+        """Usage of everything, the largest `top` galleries and moodboards only if given."""
+
+        def entry(counts, limit: int, **extra) -> dict:
+            return {"bytes": counts[0], "files": counts[1], "quotaBytes": limit or None, **extra}
+
+        with self._lock:
+            objects = {kind: [] for kind in KINDS}
+            for obj, counts in self.objects.items():
+                objects[obj[0]].append((obj[1], list(counts)))
+            result = {
+                "scannedAt": self.scanned_at,
+                "scanSeconds": self.scan_seconds,
+                "totals": {kind: {"bytes": c[0], "files": c[1]} for kind, c in self.totals.items()},
+                "keys": {name: entry(c, QUOTAS["key"]) for name, c in sorted(self.keys.items())},
+            }
+            owners = dict(self.owners)
+        for kind, items in objects.items():
+            items.sort(key=lambda item: item[1][0], reverse=True)
+            result[PLURALS[kind]] = {
+                object_id: entry(counts, QUOTAS[kind], owner=owners.get((kind, object_id)))
+                for object_id, counts in items[:top]
+            }
+        return result
+
+
+usage_ledger = UsageLedger(USAGE_OWNERS_FILE)
+for _kind in KINDS:
+    STORAGE_USAGE_BYTES.labels(_kind).set_function(lambda kind=_kind: usage_ledger.totals[kind][0])
+    STORAGE_USAGE_FILES.labels(_kind).set_function(lambda kind=_kind: usage_ledger.totals[kind][1])
+
+
+def scan_usage():
+    """Recounts the media of all galleries and moodboards from storage."""
+    from app.database import list_gallery_ids
+    from app.moodboard_db import list_moodboard_ids
+    from app.storage import media_storage
+    from app.storage_layout import SIZE_DIR_NAMES
+
+    started = time.monotonic()
+    measured: Dict[Object, List[int]] = {}
+    for gallery_id in list_gallery_ids():
+        if not (GALLERIES_ROOT_DIR / gallery_id / "metadata.yaml").exists():
+            continue
+        counts = measured[("gallery", gallery_id)] = [0, 0]
+        for size_dir in SIZE_DIR_NAMES:
+            nbytes, files = media_storage.measure(f"galleries/{gallery_id}/{size_dir}")
+            counts[0] += nbytes
+            counts[1] += files
+    for moodboard_id in list_moodboard_ids():
+        nbytes, files = media_storage.measure(f"moodboard-media/{moodboard_id}/attached_photos")
+        measured[("moodboard", moodboard_id)] = [nbytes, files]
+    usage_ledger.reconcile(measured, started)
+
+
+async def reconcile_usage():
+    """Background task: recounts the usage at startup and every USAGE_SCAN_SECONDS."""
+    while True:
+        try:
+            await asyncio.to_thread(scan_usage)
+        except Exception as e:  # keep the incremental counts
+            print(f"Storage usage scan failed: {e}")
+        await asyncio.sleep(USAGE_SCAN_SECONDS)
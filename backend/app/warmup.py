@@ -0,0 +1,82 @@
+"""
+Startup warm-up of the metadata caches.
+
+The caches used to be filled at import time, so the server couldn't even
+bind its port before every metadata file was read. Now the app starts
+serving right away and this task reads the gallery and moodboard headers in
+the background. The files are read in worker threads, so requests are
+served meanwhile; moodboards are then cached on the event loop, which owns
+their section and attachment bookkeeping. Requests for a gallery or moodboard the warm-up hasn't
+reached yet load it on demand (`find_gallery` / `find_moodboard`).
+
+`/readyz` reports the progress below and only succeeds once the caches are
+warm; `/healthz` only tells that the process is alive (and that the warm-up
+didn't fail).
+"""
+import asyncio
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, List
+
+from app import database, moodboard_db
+
+warmup_status = {
+    "state": "starting",  # starting | loading | ready | failed
+    "startedAt": None,
+    "durationSeconds": None,
+    "galleries": {"loaded": 0, "total": None},
+    "moodboards": {"loaded": 0, "total": None},
+    "error": None,
+}
+
+
+def is_ready() -> bool:
+    return warmup_status["state"] == "ready"
+
+
+async def _warm(
+    kind: str,
+    list_ids: Callable[[], List[str]],
+    load: Callable[[str], Awaitable[object]],
+):
+    progress = warmup_status[kind]
+    ids = await asyncio.to_thread(list_ids)
+    progress["total"] = len(ids)
+    next_report = 0.1
+    for i, item_id in enumerate(ids, start=1):
+        await load(item_id)
+        progress["loaded"] = i
+        if i / len(ids) >= next_report:
+            print(f"Warm-up: {i}/{len(ids)} {kind} loaded")
+            next_report += 0.1
+
+
+async def _load_gallery(gallery_id: str):
+    await asyncio.to_thread(database.load_gallery, gallery_id)
+
+
+async def _load_moodboard(moodboard_id: str):
+    header = await asyncio.to_thread(moodboard_db.read_moodboard_header, moodboard_id)
+    moodboard_db.load_moodboard(moodboard_id, header)
+
+
+async def warm_up_caches():
+    """Background task started by the app lifespan."""
+    start = time.perf_counter()
+    warmup_status["state"] = "loading"
+    warmup_status["startedAt"] = datetime.now().isoformat()
+    try:
+        await _warm("galleries", database.list_gallery_ids, _load_gallery)
+        database.galleries_warm = True
+        await _warm("moodboards", moodboard_db.list_moodboard_ids, _load_moodboard)
+        moodboard_db.moodboards_warm = True
+    except Exception as e:
+        # Requests still load what they need on demand, but /healthz now
+        # fails so the orchestrator restarts the pod.
+        warmup_status["state"] = "failed"
+        warmup_status["error"] = str(e)
+        print(f"Warm-up failed: {e}")
+        return
+    warmup_status["state"] = "ready"
+    warmup_status["durationSeconds"] = round(time.perf_counter() - start, 3)
+    print(f"Warm-up finished in {warmup_status['durationSeconds']} s")
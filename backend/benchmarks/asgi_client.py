@@ -0,0 +1,89 @@
+"""
+Minimal in-process ASGI client used by the benchmarks.
+
+Calls the application directly (no sockets, no HTTP client library), so the
+numbers reflect the server-side cost only and the suite runs without network.
+"""
+import asyncio
+import uuid
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+class Response:
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+def encode_multipart(
+    field: str, filename: str, content: bytes, content_type: str = "image/jpeg"
+) -> Tuple[bytes, str]:
+    """Returns (body, content-type header) for a single-file multipart form."""
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+async def request(
+    app,
+    method: str,
+    url: str,
+    body: bytes = b"",
+    headers: Optional[Dict[str, str]] = None,
+) -> Response:
+    parts = urlsplit(url)
+    raw_headers: List[Tuple[bytes, bytes]] = [
+        (k.lower().encode(), v.encode()) for k, v in (headers or {}).items()
+    ]
+    if body:
+        raw_headers.append((b"content-length", str(len(body)).encode()))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": parts.path,
+        "raw_path": parts.path.encode(),
+        "query_string": parts.query.encode(),
+        "root_path": "",
+        "headers": raw_headers,
+        "server": ("bench", 80),
+        "client": ("bench", 1234),
+    }
+
+    sent = False
+    never = asyncio.Event()
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            # Keep the client "connected": streaming responses watch for a
+            # disconnect and would stop early otherwise.
+            await never.wait()
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    status = 0
+    response_headers: Dict[str, str] = {}
+    chunks: List[bytes] = []
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            for k, v in message.get("headers", []):
+                response_headers[k.decode().lower()] = v.decode()
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return Response(status, response_headers, b"".join(chunks))
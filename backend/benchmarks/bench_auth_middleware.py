@@ -0,0 +1,134 @@
+"""
+Compares the throughput of static thumbnail requests behind the API key
+middleware: none at all, the previous BaseHTTPMiddleware implementation and
+the pure ASGI APIKeyAuthMiddleware, plus the cost of authenticating a POST.
+
+Drives a Starlette app with the `/galleries` mount through the in-process
+ASGI client (no sockets) with some concurrency. Prints a JSON report.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_auth_middleware [--images 50] [--requests 5000] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.synthetic import generate_galleries
+
+
+def _legacy_middleware():
+    """The BaseHTTPMiddleware implementation the pure ASGI one replaced."""
+    from fastapi import Request, status
+    from fastapi.responses import JSONResponse
+    from starlette.middleware.base import BaseHTTPMiddleware
+
+    from app.config import API_KEY
+
+    class LegacyAPIKeyAuthMiddleware(BaseHTTPMiddleware):
+        async def dispatch(self, request: Request, call_next):
+            if request.method in ["POST", "PUT", "PATCH", "DELETE"]:
+                api_key = request.headers.get("X-Api-Key")
+                if not api_key or api_key != API_KEY:
+                    return JSONResponse(
+                        status_code=status.HTTP_401_UNAUTHORIZED,
+                        content={"detail": "Invalid or missing API key"},
+                    )
+            return await call_next(request)
+
+    return LegacyAPIKeyAuthMiddleware
+
+
+def _make_app(root: Path, middleware):
+    from starlette.applications import Starlette
+    from starlette.middleware import Middleware
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Mount, Route
+
+    from app.storage_layout import LayoutStaticFiles
+
+    async def accept(request):
+        return PlainTextResponse("ok")
+
+    return Starlette(
+        routes=[
+            Route("/api/v1/echo", accept, methods=["POST"]),
+            Mount("/galleries", LayoutStaticFiles(directory=root, mount_path="/galleries")),
+        ],
+        middleware=[Middleware(middleware)] if middleware else [],
+    )
+
+
+async def _run(app, method: str, urls, requests: int, concurrency: int, headers=None) -> float:
+    from benchmarks.asgi_client import request
+
+    queue = iter(range(requests))
+
+    async def worker():
+        for i in queue:
+            response = await request(app, method, urls[i % len(urls)], headers=headers)
+            assert response.status == 200, response.status
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    root = Path(tempfile.mkdtemp(prefix="photopia-bench-"))
+    try:
+        os.environ["GALLERIES_ROOT_DIR"] = str(root)
+        os.environ.setdefault("apikey", "bench-key")
+        generate_galleries(root, 1, args.images, image_size=(400, 300))
+        thumbs = sorted((root / "bench-gallery-0" / "images_thumb").iterdir())
+        urls = [f"/galleries/bench-gallery-0/images_thumb/{path.name}" for path in thumbs]
+
+        from app.config import API_KEY
+        from app.dependencies import APIKeyAuthMiddleware
+
+        variants = {
+            "no_auth": None,
+            "base_http_middleware": _legacy_middleware(),
+            "pure_asgi": APIKeyAuthMiddleware,
+        }
+        results = {}
+        for name, middleware in variants.items():
+            app = _make_app(root, middleware)
+            asyncio.run(_run(app, "GET", urls, len(urls), 1))  # warm the page cache
+            get_seconds = asyncio.run(_run(app, "GET", urls, args.requests, args.concurrency))
+            post_seconds = asyncio.run(
+                _run(app, "POST", ["/api/v1/echo"], args.requests, args.concurrency, {"X-Api-Key": API_KEY})
+            )
+            results[name] = {
+                "thumbnail_req_per_s": round(args.requests / get_seconds, 1),
+                "authenticated_post_req_per_s": round(args.requests / post_seconds, 1),
+            }
+        results["thumbnail_speedup"] = round(
+            results["pure_asgi"]["thumbnail_req_per_s"]
+            / results["base_http_middleware"]["thumbnail_req_per_s"],
+            2,
+        )
+        report = {
+            "benchmark": "auth_middleware",
+            "images": args.images,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "results": results,
+        }
+        print(json.dumps(report, indent=2))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Compares serving gallery images from Python (StaticFiles reading and sending
+the bytes) with FILE_OFFLOAD=x-accel, where the app only resolves the file
+and answers with an X-Accel-Redirect header for nginx to stream.
+
+Each mode runs in a fresh subprocess (FILE_OFFLOAD is read at import) and
+fetches full-size images through the in-process ASGI client with some
+concurrency. The numbers are the app's side only: in offload mode nginx
+sends the bytes with sendfile(), which is not measured here. Prints a JSON
+report.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_file_offload [--images 20] [--requests 400] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.synthetic import generate_galleries
+
+
+async def _fetch_all(app, urls, requests: int, concurrency: int) -> int:
+    from benchmarks.asgi_client import request
+
+    sent = 0
+    queue = iter(range(requests))
+
+    async def worker():
+        nonlocal sent
+        for i in queue:
+            response = await request(app, "GET", urls[i % len(urls)])
+            assert response.status == 200, response.status
+            sent += len(response.body)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return sent
+
+
+def measure(root: Path, requests: int, concurrency: int) -> dict:
+    os.environ["GALLERIES_ROOT_DIR"] = str(root)
+    os.environ["REACT_BUILD_DIR"] = str(root / "no-frontend")
+    import main as app_main
+
+    paths = sorted((root / "bench-gallery-0" / "images_full").iterdir())
+    urls = [f"/galleries/bench-gallery-0/images_full/{path.name}" for path in paths]
+    file_bytes = sum(path.stat().st_size for path in paths) / len(paths)
+    asyncio.run(_fetch_all(app_main.app, urls, len(urls), 1))  # warm the page cache
+    start = time.perf_counter()
+    body_bytes = asyncio.run(_fetch_all(app_main.app, urls, requests, concurrency))
+    elapsed = time.perf_counter() - start
+    return {
+        "rps": round(requests / elapsed, 1),
+        # file bytes per second the app serves or hands off to the proxy
+        "dispatched_mb_s": round(requests * file_bytes / elapsed / 1e6, 1),
+        "app_body_mb_s": round(body_bytes / elapsed / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--image-size", type=int, nargs=2, default=(3000, 2000))
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--root", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.root:
+        print(json.dumps(measure(args.root, args.requests, args.concurrency)))
+        return
+
+    root = Path(tempfile.mkdtemp(prefix="photopia-bench-"))
+    try:
+        generate_galleries(root, 1, args.images, image_size=tuple(args.image_size))
+
+        results = {}
+        for mode in ("python", "x-accel"):
+            env = dict(os.environ, FILE_OFFLOAD="" if mode == "python" else mode)
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.bench_file_offload",
+                    "--root",
+                    str(root),
+                    "--requests",
+                    str(args.requests),
+                    "--concurrency",
+                    str(args.concurrency),
+                ],
+                env=env,
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            results[mode] = json.loads(output.strip().splitlines()[-1])
+        results["rps_ratio"] = round(results["x-accel"]["rps"] / results["python"]["rps"], 2)
+        report = {
+            "benchmark": "file_offload",
+            "images": args.images,
+            "image_size": list(args.image_size),
+            "concurrency": args.concurrency,
+            "results": results,
+        }
+        print(json.dumps(report, indent=2))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
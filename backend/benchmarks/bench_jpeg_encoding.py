@@ -0,0 +1,125 @@
+"""
+Bytes saved vs. CPU cost of the adaptive JPEG encoder (app.jpeg_encoder).
+
+Every source image is resized to the small and thumbnail renditions, which
+are then encoded three ways:
+
+* `previous`: fixed quality 85, no optimization (what was written before)
+* `fixed`: JPEG_ENCODING=fixed, quality 85, optimized and progressive
+* `adaptive`: JPEG_ENCODING=adaptive, SSIM-targeted quality search
+
+and the total bytes and CPU time of each are reported, per kind of image and
+overall, with the qualities chosen. Sources are synthetic (flat gradients,
+smooth photo-like noise, fine grain) unless a directory of JPEGs is given
+with --images. Prints a JSON report.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_jpeg_encoding [--count 5] [--images DIR]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+
+def _sources(count: int, images_dir: str):
+    from PIL import Image, ImageFilter
+
+    if images_dir:
+        for path in sorted(Path(images_dir).glob("*.jp*g"))[:count]:
+            with Image.open(path) as img:
+                yield "photos", img.convert("RGB")
+        return
+    rng = random.Random(0)
+    size = (3000, 2000)
+    for i in range(count):
+        # Flat colours and soft gradients: screenshots, illustrations, skies
+        base = Image.linear_gradient("L").rotate(rng.randint(0, 359)).resize(size)
+        yield "simple", Image.merge("RGB", (base, base.point(lambda v: 255 - v), Image.new("L", size, 60 + i)))
+        # Smooth noise scaled up: compresses roughly like a photo
+        small = Image.frombytes("RGB", (size[0] // 24, size[1] // 24), rng.randbytes(size[0] * size[1] * 3 // 576))
+        yield "photo_like", small.resize(size, Image.BICUBIC).filter(ImageFilter.DETAIL)
+        # Fine grain on top (high ISO, foliage, textures)
+        grain = Image.merge("RGB", [Image.effect_noise(size, 25 + 5 * i)] * 3)
+        yield "noisy", Image.blend(small.resize(size, Image.BICUBIC), grain, 0.35)
+
+
+def _timed(encode, img):
+    start = time.process_time()
+    data = encode(img)
+    return data, time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=5, help="images per kind (or from --images)")
+    parser.add_argument("--images", default="", help="directory of JPEGs to use instead")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="photopia-bench-")
+    try:
+        os.environ.setdefault("GALLERIES_ROOT_DIR", root)
+        from app.config import SMALL_SIZE, THUMB_SIZE
+        from app import jpeg_encoder
+
+        def previous(img):
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=85)
+            return out.getvalue()
+
+        def fixed(img):
+            return jpeg_encoder._encode(img, jpeg_encoder.JPEG_QUALITY, final=True)
+
+        def adaptive(img):
+            quality, _ = jpeg_encoder.choose_quality(img)
+            qualities.append(quality)
+            return jpeg_encoder._encode(img, quality, final=True)
+
+        variants = {"previous": previous, "fixed": fixed, "adaptive": adaptive}
+        totals = {}
+        qualities = []
+        chosen = {}
+        for kind, img in _sources(args.count, args.images):
+            for box in (SMALL_SIZE, THUMB_SIZE):
+                rendition = img.copy()
+                rendition.thumbnail(box)
+                for name, encode in variants.items():
+                    data, seconds = _timed(encode, rendition)
+                    for key in (kind, "all"):
+                        entry = totals.setdefault(key, {}).setdefault(name, {"bytes": 0, "cpu_s": 0.0, "renditions": 0})
+                        entry["bytes"] += len(data)
+                        entry["cpu_s"] += seconds
+                        entry["renditions"] += 1
+                chosen.setdefault(kind, []).append(qualities[-1])
+
+        results = {}
+        for key, by_variant in totals.items():
+            previous_entry = by_variant["previous"]
+            results[key] = {
+                name: {
+                    "kb": round(entry["bytes"] / 1024),
+                    "bytes_saved_pct": round(100 * (1 - entry["bytes"] / previous_entry["bytes"]), 1),
+                    "cpu_ms_per_rendition": round(1000 * entry["cpu_s"] / entry["renditions"], 1),
+                }
+                for name, entry in by_variant.items()
+            }
+            if key != "all":
+                results[key]["adaptive"]["qualities"] = chosen[key]
+        report = {
+            "benchmark": "jpeg_encoding",
+            "target_ssim": jpeg_encoder.JPEG_TARGET_SSIM,
+            "quality_range": [jpeg_encoder.JPEG_MIN_QUALITY, jpeg_encoder.JPEG_MAX_QUALITY],
+            "results": results,
+        }
+        print(json.dumps(report, indent=2))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Compares the resident memory of the gallery metadata cache holding Pydantic
+`Gallery` models (the previous representation) with `GalleryRecord` /
+`ImageTable` (the current one).
+
+Each representation is measured in a fresh subprocess: it builds the cache
+gallery by gallery from synthetic metadata (same shape as metadata.yaml,
+including placeholders and dominant colors) and reports the RSS growth, the
+build time and the cost of serializing one gallery for the API. Prints a
+JSON report.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_memory [--images 1000000] [--images-per-gallery 1000]
+"""
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+_B64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Not Linux: fall back to the peak RSS (KiB on Linux, bytes on macOS)
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _sample_placeholder() -> str:
+    from PIL import Image
+
+    from app.placeholders import compute_placeholder
+
+    placeholder, _ = compute_placeholder(Image.linear_gradient("L").convert("RGB"))
+    return placeholder
+
+
+def _gallery_data(gallery_id: str, images: int, placeholder: str) -> dict:
+    # Placeholders differ per image in reality; vary a few base64 characters
+    # in the middle so every string is a distinct object, like after parsing.
+    middle = len(placeholder) // 2
+    head, tail = placeholder[:middle], placeholder[middle + 4 :]
+    items = []
+    for i in range(images):
+        stem = f"IMG_{i:05d}"
+        items.append(
+            {
+                "id": str(uuid.uuid4()),
+                "filename": stem,
+                "sizes": {
+                    "full": f"/galleries/{gallery_id}/images_full/{stem}.jpg",
+                    "small": f"/galleries/{gallery_id}/images_small/{stem}__1920x1080.jpg",
+                    "thumb": f"/galleries/{gallery_id}/images_thumb/{stem}__400x400.jpg",
+                },
+                "width": 6000,
+                "height": 4000,
+                "placeholder": head
+                + "".join(_B64[(i >> shift) & 63] for shift in (0, 6, 12, 18))
+                + tail,
+                "dominantColor": f"#{i & 0xFFFFFF:06x}",
+            }
+        )
+    return {
+        "id": gallery_id,
+        "name": f"Bench gallery {gallery_id}",
+        "author": "bench",
+        "lastUpdateDate": "2024-01-01T12:00:00",
+        "coverImageUrl": items[0]["sizes"]["thumb"] if items else None,
+        "images": items,
+    }
+
+
+def measure(variant: str, images: int, per_gallery: int) -> dict:
+    from app.image_table import GalleryRecord
+    from app.models import Gallery
+
+    build = (lambda data: Gallery(**data)) if variant == "models" else GalleryRecord.from_dict
+    serialize = Gallery.model_dump_json if variant == "models" else GalleryRecord.to_json
+
+    placeholder = _sample_placeholder()
+    gc.collect()
+    before = _rss_bytes()
+
+    cache = {}
+    build_time = 0.0
+    for g in range(max(1, images // per_gallery)):
+        data = _gallery_data(f"bench-gallery-{g}", per_gallery, placeholder)
+        start = time.perf_counter()
+        cache[data["id"]] = build(data)
+        build_time += time.perf_counter() - start
+        del data
+    gc.collect()
+    after = _rss_bytes()
+
+    gallery = next(iter(cache.values()))
+    start = time.perf_counter()
+    response = serialize(gallery)
+    response_time = time.perf_counter() - start
+
+    total = len(cache) * per_gallery
+    return {
+        "variant": variant,
+        "images": total,
+        "rss_mb": round((after - before) / 1e6, 1),
+        "bytes_per_image": round((after - before) / total),
+        "build_s": round(build_time, 2),
+        "get_gallery_ms": round(response_time * 1000, 2),
+        "get_gallery_response_bytes": len(response),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=1_000_000)
+    parser.add_argument("--images-per-gallery", type=int, default=1000)
+    parser.add_argument("--variant", choices=("models", "table"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        print(json.dumps(measure(args.variant, args.images, args.images_per_gallery)))
+        return
+
+    results = {}
+    for variant in ("models", "table"):
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.bench_memory",
+                "--images",
+                str(args.images),
+                "--images-per-gallery",
+                str(args.images_per_gallery),
+                "--variant",
+                variant,
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results[variant] = json.loads(output.strip().splitlines()[-1])
+    results["rss_ratio"] = round(results["models"]["rss_mb"] / max(results["table"]["rss_mb"], 0.1), 2)
+    print(json.dumps({"benchmark": "gallery_cache_memory", "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
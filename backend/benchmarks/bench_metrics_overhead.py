@@ -0,0 +1,87 @@
+"""
+Measures the overhead of the Prometheus instrumentation in app.metrics.
+
+Drives a minimal Starlette app directly through the ASGI interface (no
+sockets, no HTTP client) with and without MetricsMiddleware, and times the
+raw cost of an upload stage observation. Prints a JSON report.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_metrics_overhead [--requests N]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from app.metrics import MetricsMiddleware, upload_stage
+
+
+async def _ok(request):
+    return PlainTextResponse("ok")
+
+
+def _make_app(instrumented: bool):
+    app = Starlette(routes=[Route("/api/v1/gallery", _ok)])
+    return MetricsMiddleware(app) if instrumented else app
+
+
+async def _drive(app, requests: int) -> float:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/api/v1/gallery",
+        "raw_path": b"/api/v1/gallery",
+        "query_string": b"gallery_id=x",
+        "root_path": "",
+        "headers": [],
+        "server": ("bench", 80),
+        "client": ("bench", 1234),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receive, send)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--observations", type=int, default=200000)
+    args = parser.parse_args()
+
+    baseline = asyncio.run(_drive(_make_app(False), args.requests))
+    instrumented = asyncio.run(_drive(_make_app(True), args.requests))
+
+    start = time.perf_counter()
+    for _ in range(args.observations):
+        with upload_stage("encode"):
+            pass
+    stage_cost = (time.perf_counter() - start) / args.observations
+
+    report = {
+        "benchmark": "metrics_overhead",
+        "requests": args.requests,
+        "baseline_req_per_s": args.requests / baseline,
+        "instrumented_req_per_s": args.requests / instrumented,
+        "per_request_overhead_us": (instrumented - baseline) / args.requests * 1e6,
+        "stage_timer_cost_us": stage_cost * 1e6,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Compares a full-board save (POST /updateMoodboard) with section-level edits
+(PATCH /moodboard) on a large moodboard. Prints a JSON report.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_moodboard_patch [--images 500] [--iterations 50]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.synthetic import generate_moodboards
+
+API_KEY = "bench-api-key"
+
+
+async def run(app, moodboard_id: str, iterations: int) -> dict:
+    from benchmarks.asgi_client import request
+
+    headers = {"X-Api-Key": API_KEY, "Content-Type": "application/json"}
+
+    async def get_board():
+        response = await request(app, "GET", f"/api/v1/moodboard?moodboard_id={moodboard_id}")
+        return json.loads(response.body)
+
+    version = 0
+
+    async def patch(ops):
+        nonlocal version
+        response = await request(
+            app,
+            "PATCH",
+            f"/api/v1/moodboard?moodboard_id={moodboard_id}",
+            json.dumps({"baseVersion": version, "ops": ops}).encode(),
+            headers,
+        )
+        assert response.status == 200, response.body
+        version = json.loads(response.body)["version"]
+
+    results = {}
+
+    # Full save of the whole board after editing one text section, which is
+    # what the editor does today.
+    board = await get_board()
+    elapsed = 0.0
+    for i in range(iterations):
+        board["sections"][1]["text"] = f"edited {i}"
+        start = time.perf_counter()
+        response = await request(
+            app,
+            "POST",
+            f"/api/v1/updateMoodboard?moodboard_id={moodboard_id}",
+            json.dumps(board).encode(),
+            headers,
+        )
+        elapsed += time.perf_counter() - start
+        assert response.status == 200, response.body
+        board = json.loads(response.body)
+    results["full_save_text_edit_ms"] = elapsed / iterations * 1000
+    results["full_save_request_bytes"] = len(json.dumps(board))
+    version = board["version"]
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        await patch([{"op": "updateSection", "index": 1, "text": f"patched {i}"}])
+    results["patch_text_edit_ms"] = (time.perf_counter() - start) / iterations * 1000
+
+    image = board["sections"][0]["images"][0]
+    start = time.perf_counter()
+    for i in range(iterations):
+        await patch([{"op": "moveImage", "section": 0, "imageId": image["id"], "to": i % 10}])
+    results["patch_move_image_ms"] = (time.perf_counter() - start) / iterations * 1000
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        new_image = dict(image, id=f"bench-{i}")
+        await patch([{"op": "addImage", "section": 0, "image": new_image}])
+        await patch([{"op": "removeImage", "section": 0, "imageId": new_image["id"]}])
+    results["patch_add_remove_image_ms"] = (time.perf_counter() - start) / (2 * iterations) * 1000
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=500)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    root = Path(tempfile.mkdtemp(prefix="photopia-bench-"))
+    try:
+        sections = 10
+        per_section = max(1, args.images // (sections // 2))
+        moodboard_id = generate_moodboards(root / "moodboards", 1, sections, per_section)[0]
+
+        os.environ["GALLERIES_ROOT_DIR"] = str(root)
+        os.environ["MOODBOARDS_ROOT_DIR"] = str(root / "moodboards")
+        os.environ["REACT_BUILD_DIR"] = str(root / "no-frontend")
+        os.environ["apikey"] = API_KEY
+        import main as app_main
+
+        results = asyncio.run(run(app_main.app, moodboard_id, args.iterations))
+        report = {
+            "benchmark": "moodboard_patch",
+            "images": per_section * (sections // 2),
+            "iterations": args.iterations,
+            "results": results,
+        }
+        print(json.dumps(report, indent=2))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Compares the resize engines (RESIZE_ENGINE=pillow / vips) on large
+uploads: throughput and peak resident memory of producing the small and
+thumbnail renditions plus the placeholder, as add_gallery_image does.
+
+Synthetic photo-like JPEGs of 24 MP (6000x4000) and 100 MP (12240x8160) are
+generated once; every engine/size pair then runs in a fresh subprocess, so
+its peak RSS (ru_maxrss) only covers that pair (the generation runs in its
+own subprocess too: Linux passes the peak on to forked children). The upload is held in memory
+as bytes, like a multipart upload. Prints a JSON report.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_resize_engines [--repeat 3] [--engines pillow,vips]
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SIZES = {"24mp": (6000, 4000), "100mp": (12240, 8160)}
+
+
+def _peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _generate(path: Path, size):
+    """Smooth noise scaled up: compresses (and decodes) roughly like a photo."""
+    from PIL import Image
+
+    small = Image.frombytes("RGB", (size[0] // 16, size[1] // 16), os.urandom(size[0] * size[1] * 3 // 256))
+    small.resize(size, Image.BILINEAR).save(path, "JPEG", quality=90)
+
+
+def measure(engine_name: str, path: Path, repeat: int) -> dict:
+    from app.config import SMALL_SIZE, THUMB_SIZE
+    from app.placeholders import compute_placeholder
+    from app.resize_engine import resize_engine
+
+    assert resize_engine.name == engine_name
+    content = path.read_bytes()
+    baseline = _peak_rss_bytes()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with resize_engine.open(content) as original:
+            width, height = original.size
+            original.load()
+            small = original.resize(SMALL_SIZE)
+            small.save_jpeg(io.BytesIO(), "small")
+            thumb = original.resize(THUMB_SIZE)
+            thumb.save_jpeg(io.BytesIO(), "thumb")
+            compute_placeholder(thumb.to_pil())
+        timings.append(time.perf_counter() - start)
+        del original, small, thumb
+
+    best = min(timings)
+    return {
+        "engine": engine_name,
+        "file_mb": round(len(content) / 1e6, 1),
+        "best_s": round(best, 3),
+        "images_per_s": round(1 / best, 2),
+        "megapixels_per_s": round(width * height / 1e6 / best, 1),
+        "peak_rss_mb": round(_peak_rss_bytes() / 1e6, 1),
+        "peak_rss_over_baseline_mb": round((_peak_rss_bytes() - baseline) / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--engines", default="pillow,vips")
+    parser.add_argument("--sizes", default=",".join(SIZES))
+    parser.add_argument("--measure", nargs=2, metavar=("ENGINE", "FILE"), help=argparse.SUPPRESS)
+    parser.add_argument("--generate", nargs=2, metavar=("SIZE", "FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure[0], Path(args.measure[1]), args.repeat)))
+        return
+    if args.generate:
+        _generate(Path(args.generate[1]), SIZES[args.generate[0]])
+        return
+
+    root = Path(tempfile.mkdtemp(prefix="photopia-bench-"))
+    try:
+        results = {}
+        for size_name in args.sizes.split(","):
+            path = root / f"{size_name}.jpg"
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_resize_engines", "--generate", size_name, str(path)],
+                check=True,
+            )
+            results[size_name] = {}
+            for engine_name in args.engines.split(","):
+                env = dict(os.environ, RESIZE_ENGINE=engine_name, GALLERIES_ROOT_DIR=str(root / "galleries"))
+                output = subprocess.run(
+                    [
+                        sys.executable,
+                        "-m",
+                        "benchmarks.bench_resize_engines",
+                        "--repeat",
+                        str(args.repeat),
+                        "--measure",
+                        engine_name,
+                        str(path),
+                    ],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                    env=env,
+                ).stdout
+                results[size_name][engine_name] = json.loads(output.strip().splitlines()[-1])
+            engines = results[size_name]
+            if "pillow" in engines and "vips" in engines:
+                engines["speedup"] = round(engines["vips"]["images_per_s"] / engines["pillow"]["images_per_s"], 2)
+                engines["peak_rss_ratio"] = round(
+                    engines["pillow"]["peak_rss_mb"] / max(engines["vips"]["peak_rss_mb"], 0.1), 2
+                )
+        print(json.dumps({"benchmark": "resize_engines", "repeat": args.repeat, "results": results}, indent=2))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Backend benchmark suite.
+
+Generates a synthetic library in a temporary directory, points the app at it
+and measures startup loading, upload throughput, listing/detail req/s, zip
+download throughput and the id helpers. Everything runs in-process, without
+network access. Results are written as JSON so runs can be compared:
+
+    python -m benchmarks.run --output baseline.json
+    # ... change something ...
+    python -m benchmarks.run --output new.json --compare baseline.json
+
+Run from the backend directory.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks.synthetic import generate_galleries, generate_moodboards, make_jpeg
+
+API_KEY = "bench-api-key"
+
+
+def _parse_size(value: str):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def _metric(value: float, unit: str, higher_is_better: bool) -> dict:
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def _timeit(fn, repeat: int) -> float:
+    """Returns the median wall time of `repeat` calls to `fn`."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def bench_loading(results: dict, repeat: int):
+    from app import database, moodboard_db
+
+    def cold_galleries():
+        database.galleries_db.clear()
+        database.galleries_mtime.clear()
+        database.gallery_images_lru.clear()
+        database.load_galleries_from_filesystem()
+
+    def cold_moodboards():
+        moodboard_db.moodboards_db.clear()
+        moodboard_db.moodboards_mtime.clear()
+        moodboard_db.moodboard_sections_lru.clear()
+        moodboard_db.load_moodboards_from_filesystem()
+
+    def first_gallery_access():
+        # Image lists are loaded on first access after the header-only startup
+        gallery = database.galleries_db["bench-gallery-0"]
+        gallery.attach_images(None)
+        database.gallery_images_lru.pop(gallery.id, None)
+        len(gallery.images)
+
+    results["load_galleries_cold"] = _metric(_timeit(cold_galleries, repeat), "s", False)
+    results["load_galleries_warm"] = _metric(
+        _timeit(database.load_galleries_from_filesystem, repeat), "s", False
+    )
+    results["load_moodboards_cold"] = _metric(_timeit(cold_moodboards, repeat), "s", False)
+    results["load_gallery_images_on_access"] = _metric(
+        _timeit(first_gallery_access, repeat), "s", False
+    )
+
+
+async def bench_requests(app, results: dict, gallery_id: str, requests: int):
+    from benchmarks.asgi_client import request
+
+    for name, url in (
+        ("get_galleries", "/api/v1/galleries"),
+        ("get_gallery", f"/api/v1/gallery?gallery_id={gallery_id}"),
+        ("get_moodboards", "/api/v1/moodboards"),
+    ):
+        response = await request(app, "GET", url)
+        assert response.status == 200, (url, response.status)
+        start = time.perf_counter()
+        for _ in range(requests):
+            await request(app, "GET", url)
+        elapsed = time.perf_counter() - start
+        results[f"{name}_rps"] = _metric(requests / elapsed, "req/s", True)
+        results[f"{name}_response_bytes"] = _metric(len(response.body), "B", False)
+
+
+async def bench_uploads(app, results: dict, count: int, size):
+    from benchmarks.asgi_client import encode_multipart, request
+
+    headers = {"X-Api-Key": API_KEY, "Content-Type": "application/json"}
+    created = await request(
+        app,
+        "POST",
+        "/api/v1/createGallery",
+        json.dumps({"name": "bench upload", "author": "bench"}).encode(),
+        headers,
+    )
+    assert created.status == 201, created.body
+    gallery_id = json.loads(created.body)["id"]
+
+    payloads = [make_jpeg(*size, seed=i) for i in range(min(count, 4))]
+    total_bytes = 0
+    start = time.perf_counter()
+    for i in range(count):
+        content = payloads[i % len(payloads)]
+        body, content_type = encode_multipart("image_file", f"bench_{i}.jpg", content)
+        response = await request(
+            app,
+            "POST",
+            f"/api/v1/uploadImageToGallery?gallery_id={gallery_id}",
+            body,
+            {"X-Api-Key": API_KEY, "Content-Type": content_type},
+        )
+        assert response.status == 201, response.body
+        total_bytes += len(content)
+    elapsed = time.perf_counter() - start
+    results["upload_images_per_s"] = _metric(count / elapsed, "img/s", True)
+    results["upload_mb_per_s"] = _metric(total_bytes / elapsed / 1e6, "MB/s", True)
+
+
+async def bench_zip(app, results: dict, gallery_id: str):
+    from benchmarks.asgi_client import request
+
+    url = f"/api/v1/download_zip/{gallery_id}"
+    start = time.perf_counter()
+    # The first call builds the archive in a background task, which runs
+    # before the ASGI call returns.
+    await request(app, "GET", url)
+    results["zip_build"] = _metric(time.perf_counter() - start, "s", False)
+
+    start = time.perf_counter()
+    response = await request(app, "GET", url)
+    elapsed = time.perf_counter() - start
+    assert response.headers.get("content-type") == "application/zip", response.body
+    results["zip_download_mb_per_s"] = _metric(len(response.body) / elapsed / 1e6, "MB/s", True)
+
+
+def bench_id_helpers(results: dict, iterations: int):
+    from app.utils import generate_readable_id, normalize_text
+
+    names = [
+        "Summer Wedding 2024",
+        "Весілля Олени та Івана",
+        "Café crème — été",
+        "   lots   of   spaces   ",
+        "x" * 80,
+    ]
+    start = time.perf_counter()
+    for i in range(iterations):
+        normalize_text(names[i % len(names)])
+    results["normalize_text_us"] = _metric(
+        (time.perf_counter() - start) / iterations * 1e6, "us", False
+    )
+
+    # Worst case: every candidate up to the last suffix is taken.
+    existing = {"summer-wedding-2024"} | {f"summer-wedding-2024-{n}" for n in range(1, 50)}
+    with tempfile.TemporaryDirectory() as empty_dir:
+        start = time.perf_counter()
+        for _ in range(iterations // 10):
+            generate_readable_id("Summer Wedding 2024", existing, Path(empty_dir))
+        elapsed = time.perf_counter() - start
+    results["generate_readable_id_50_collisions_us"] = _metric(
+        elapsed / (iterations // 10) * 1e6, "us", False
+    )
+
+
+def compare(current: dict, baseline_path: Path, threshold: float) -> int:
+    """Prints a comparison against a previous run. Returns the regression count."""
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)["results"]
+    regressions = 0
+    print(f"\n{'metric':45} {'baseline':>14} {'current':>14} {'change':>9}")
+    for name, metric in current.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]["value"], metric["value"]
+        change = (new - old) / old if old else 0.0
+        worse = -change if metric["higher_is_better"] else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:45} {old:14.4f} {new:14.4f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--galleries", type=int, default=50)
+    parser.add_argument("--images-per-gallery", type=int, default=200)
+    parser.add_argument("--moodboards", type=int, default=20)
+    parser.add_argument("--moodboard-sections", type=int, default=10)
+    parser.add_argument("--moodboard-section-images", type=int, default=20)
+    parser.add_argument("--zip-images", type=int, default=100)
+    parser.add_argument("--zip-image-size", type=_parse_size, default=(1600, 1200))
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--upload-size", type=_parse_size, default=(4000, 3000))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--helper-iterations", type=int, default=20000)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--compare", type=Path, help="previous results JSON")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="relative slowdown reported as a regression (default 0.10)",
+    )
+    args = parser.parse_args()
+
+    root = Path(tempfile.mkdtemp(prefix="photopia-bench-"))
+    try:
+        moodboards_root = root / "moodboards"
+        print(f"Generating synthetic library in {root} ...", file=sys.stderr)
+        # Metadata-only galleries for loading/listing, plus one with real files
+        # for the zip benchmark.
+        generate_galleries(root, args.galleries, args.images_per_gallery, write_files=False)
+        zip_gallery = generate_galleries(
+            root, 1, args.zip_images, image_size=args.zip_image_size, prefix="bench-zip"
+        )[0]
+        generate_moodboards(
+            moodboards_root,
+            args.moodboards,
+            args.moodboard_sections,
+            args.moodboard_section_images,
+            write_files=False,
+        )
+
+        os.environ["GALLERIES_ROOT_DIR"] = str(root)
+        os.environ["MOODBOARDS_ROOT_DIR"] = str(moodboards_root)
+        os.environ["REACT_BUILD_DIR"] = str(root / "no-frontend")
+        os.environ["apikey"] = API_KEY
+
+        start = time.perf_counter()
+        import main as app_main
+        from app import database, moodboard_db
+
+        # What the background warm-up does before /readyz succeeds
+        database.load_galleries_from_filesystem()
+        moodboard_db.load_moodboards_from_filesystem()
+
+        results = {"import_and_load": _metric(time.perf_counter() - start, "s", False)}
+        app = app_main.app
+
+        bench_loading(results, args.repeat)
+        asyncio.run(bench_requests(app, results, "bench-gallery-0", args.requests))
+        asyncio.run(bench_uploads(app, results, args.uploads, args.upload_size))
+        asyncio.run(bench_zip(app, results, zip_gallery))
+        bench_id_helpers(results, args.helper_iterations)
+
+        report = {
+            "meta": {
+                "date": datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            },
+            "results": results,
+        }
+        text = json.dumps(report, indent=2, default=str)
+        if args.output:
+            args.output.write_text(text)
+        print(text)
+
+        if args.compare:
+            if compare(results, args.compare, args.threshold):
+                sys.exit(1)
+
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
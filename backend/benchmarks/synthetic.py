@@ -0,0 +1,140 @@
+"""
+Synthetic library generator for the benchmarks.
+
+Writes galleries and moodboards in the same on-disk layout the application
+uses (metadata.yaml / moodboard.yaml plus image files), so the loaders and
+endpoints can be measured against libraries of any size.
+"""
+import io
+import random
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+import yaml
+from PIL import Image
+
+
+def make_jpeg(width: int, height: int, seed: int = 0) -> bytes:
+    """
+    Returns a JPEG of the given size. A gradient with some noise compresses
+    and decodes roughly like a photo, unlike a flat color.
+    """
+    rng = random.Random(seed)
+    base = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40 + rng.randint(0, 30))
+    img = Image.merge("RGB", (base, noise, base.rotate(90).resize((width, height))))
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def _write(path: Path, content: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def generate_galleries(
+    root: Path,
+    galleries: int,
+    images_per_gallery: int,
+    image_size=(64, 48),
+    write_files: bool = True,
+    prefix: str = "bench-gallery",
+) -> List[str]:
+    """
+    Creates `galleries` galleries with `images_per_gallery` images each under
+    `root`. With `write_files=False` only metadata is written, which is enough
+    for loader and listing benchmarks and much faster to generate.
+    """
+    content = make_jpeg(*image_size) if write_files else b""
+    ids = []
+    for g in range(galleries):
+        gallery_id = f"{prefix}-{g}"
+        gallery_dir = root / gallery_id
+        images = []
+        for i in range(images_per_gallery):
+            stem = f"IMG_{i:05d}"
+            full = f"{stem}.jpg"
+            small = f"{stem}__1920x1080.jpg"
+            thumb = f"{stem}__400x400.jpg"
+            if write_files:
+                _write(gallery_dir / "images_full" / full, content)
+                _write(gallery_dir / "images_small" / small, content)
+                _write(gallery_dir / "images_thumb" / thumb, content)
+            images.append(
+                {
+                    "id": str(uuid.uuid4()),
+                    "filename": stem,
+                    "sizes": {
+                        "full": f"/galleries/{gallery_id}/images_full/{full}",
+                        "small": f"/galleries/{gallery_id}/images_small/{small}",
+                        "thumb": f"/galleries/{gallery_id}/images_thumb/{thumb}",
+                    },
+                    "width": image_size[0],
+                    "height": image_size[1],
+                }
+            )
+        for sub in ("images_full", "images_small", "images_thumb"):
+            (gallery_dir / sub).mkdir(parents=True, exist_ok=True)
+        metadata = {
+            "id": gallery_id,
+            "name": f"Bench gallery {g}",
+            "author": "bench",
+            "lastUpdateDate": datetime.now().isoformat(),
+            "coverImageUrl": images[0]["sizes"]["thumb"] if images else None,
+            "images": images,
+        }
+        with open(gallery_dir / "metadata.yaml", "w") as f:
+            yaml.dump(metadata, f, sort_keys=False)
+        ids.append(gallery_id)
+    return ids
+
+
+def generate_moodboards(
+    root: Path,
+    moodboards: int,
+    sections: int,
+    images_per_section: int,
+    image_size=(64, 48),
+    write_files: bool = True,
+) -> List[str]:
+    """Creates moodboards alternating text and image sections under `root`."""
+    content = make_jpeg(*image_size) if write_files else b""
+    ids = []
+    for m in range(moodboards):
+        moodboard_id = f"bench-moodboard-{m}"
+        attached = root / moodboard_id / "attached_photos"
+        attached.mkdir(parents=True, exist_ok=True)
+        board_sections = []
+        for s in range(sections):
+            if s % 2:
+                board_sections.append({"type": "text", "text": f"Section {s} " * 20})
+                continue
+            images = []
+            for i in range(images_per_section):
+                filename = f"s{s}_{i:04d}.jpg"
+                if write_files:
+                    _write(attached / filename, content)
+                images.append(
+                    {
+                        "id": str(uuid.uuid4()),
+                        "url": f"/moodboard-media/{moodboard_id}/attached_photos/{filename}",
+                        "width": image_size[0],
+                        "height": image_size[1],
+                    }
+                )
+            board_sections.append({"type": "images", "view": "grid", "images": images})
+        metadata = {
+            "id": moodboard_id,
+            "name": f"Bench moodboard {m}",
+            "headerColor": "#111827",
+            "lastUpdateDate": datetime.now().isoformat(),
+            "sections": board_sections,
+        }
+        with open(root / moodboard_id / "moodboard.yaml", "w") as f:
+            yaml.dump(metadata, f, sort_keys=False)
+        ids.append(moodboard_id)
+    return ids
@@ -1,35 +1,151 @@
+import asyncio
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse, JSONResponse
 from pathlib import Path
 
 # Local imports from our new file structure
-from app.routers import galleries, moodboards
+from app.routers import backup, changes, galleries, moodboards, transfers, uploads, usage
 from app.dependencies import APIKeyAuthMiddleware
-from app.config import REACT_BUILD_DIR, GALLERIES_ROOT_DIR, MOODBOARDS_ROOT_DIR
+from app.config import (
+    REACT_BUILD_DIR,
+    GALLERIES_ROOT_DIR,
+    MOODBOARDS_ROOT_DIR,
+    PROFILING_ENABLED,
+)
+from app.attachments import sweep_unreferenced_attachments
+from app.uploads import expire_abandoned_uploads
+from app.apikeys import watch_api_keys
+from app.changes import watch_changes
+from app.usage import reconcile_usage
+from app.moodboard_preview import PREVIEW_DIR, open_graph_tags, render_previews
+from app.moodboard_db import find_moodboard
+from app.metrics import MetricsMiddleware, monitor_event_loop_lag, render_metrics
+from app.warmup import warm_up_caches, warmup_status, is_ready
+from app.storage_layout import LayoutStaticFiles
+from app.file_offload import OffloadStaticFiles
+from app.storage import media_files
+from app.thumb_cache import ThumbnailCacheFiles
+from app.thumb_pack import PackedFiles, compact_packs
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Starts and stops background tasks that live as long as the app."""
+    # Caches are filled in the background so the port is bound right away
+    warmup = asyncio.create_task(warm_up_caches())
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    attachment_sweeper = asyncio.create_task(sweep_unreferenced_attachments())
+    upload_sweeper = asyncio.create_task(expire_abandoned_uploads())
+    key_watcher = asyncio.create_task(watch_api_keys())
+    pack_compactor = asyncio.create_task(compact_packs())
+    change_watcher = asyncio.create_task(watch_changes())
+    usage_scanner = asyncio.create_task(reconcile_usage())
+    preview_renderer = asyncio.create_task(render_previews())
+    yield
+    preview_renderer.cancel()
+    usage_scanner.cancel()
+    change_watcher.cancel()
+    pack_compactor.cancel()
+    key_watcher.cancel()
+    upload_sweeper.cancel()
+    attachment_sweeper.cancel()
+    lag_monitor.cancel()
+    warmup.cancel()
+
 
 # Initialize the main FastAPI app
 app = FastAPI(
-    title="Image Gallery API", description="API for managing image galleries."
+    title="Image Gallery API",
+    description="API for managing image galleries.",
+    lifespan=lifespan,
 )
 
-# Add custom middleware for API key authentication on POST requests
+# API key authentication of mutating requests (POST/PUT/PATCH/DELETE)
 app.add_middleware(APIKeyAuthMiddleware)
 
+# Opt-in request profiling and slow-request log. Not installed at all unless
+# enabled, so it has no cost in normal operation.
+if PROFILING_ENABLED:
+    from app.profiling import ProfilingMiddleware
+
+    app.add_middleware(ProfilingMiddleware)
+    print("Request profiling is enabled")
+
+# Request latency per route. Added last so it is the outermost middleware and
+# also accounts for time spent in authentication.
+app.add_middleware(MetricsMiddleware)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    """Liveness: the server responds (and the cache warm-up didn't fail)."""
+    if warmup_status["state"] == "failed":
+        return JSONResponse(status_code=503, content={"status": "failed"})
+    return {"status": "ok"}
+
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """Readiness: the metadata caches are warm. Reports warm-up progress."""
+    return JSONResponse(status_code=200 if is_ready() else 503, content=warmup_status)
+
+
 # Include the API router for gallery endpoints
 app.include_router(galleries.router, prefix="/api/v1")
 
 # Include the API router for moodboard endpoints
 app.include_router(moodboards.router, prefix="/api/v1")
 
+# Include the API router for resumable uploads
+app.include_router(uploads.router, prefix="/api/v1")
+
+# Include the API router for copying images between galleries and moodboards
+app.include_router(transfers.router, prefix="/api/v1")
+
+# Include the API router for the change feed
+app.include_router(changes.router, prefix="/api/v1")
+
+# Include the API router for library export and restore
+app.include_router(backup.router, prefix="/api/v1")
+
+# Include the API router for storage usage statistics
+app.include_router(usage.router, prefix="/api/v1")
+
 # Mount static directories
-# Serve images from the galleries root directory
-app.mount("/galleries", StaticFiles(directory=GALLERIES_ROOT_DIR), name="galleries")
+# Serve images from the galleries root directory (through the storage layout
+# and packs), hot thumbnails from memory
+app.mount(
+    "/galleries",
+    media_files(
+        "galleries",
+        ThumbnailCacheFiles(
+            PackedFiles(LayoutStaticFiles(directory=GALLERIES_ROOT_DIR, mount_path="/galleries"))
+        ),
+    ),
+    name="galleries",
+)
 
-# Serve images from the moodboards root directory
+# Serve images from the moodboards root directory (the preview images are
+# immutable, not their state file)
 app.mount(
-    "/moodboard-media", StaticFiles(directory=MOODBOARDS_ROOT_DIR), name="moodboard-media"
+    "/moodboard-media",
+    media_files(
+        "moodboard-media",
+        OffloadStaticFiles(
+            directory=MOODBOARDS_ROOT_DIR, mount_path="/moodboard-media", immutable=f"*/{PREVIEW_DIR}/*.jpg"
+        ),
+    ),
+    name="moodboard-media",
 )
 
 # Mount the static directory for the React SPA build
@@ -85,7 +201,16 @@ if REACT_BUILD_DIR.exists():
             )
 
         with open(html_file, "r") as f:
-            return HTMLResponse(content=f.read())
+            content = f.read()
+
+        # Shared moodboard links get a title and preview card in link unfurls
+        parts = full_path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "m":
+            mb = find_moodboard(parts[1])
+            if mb:
+                tags = open_graph_tags(mb, str(request.base_url))
+                content = content.replace("</head>", tags + "</head>", 1)
+        return HTMLResponse(content=content)
 
 else:
     print(
@@ -0,0 +1,97 @@
+"""
+Export streams: a client going away mid-export must not leave worker
+threads behind. Run from backend/ with `python -m unittest discover tests`.
+"""
+import asyncio
+import io
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+_root = tempfile.TemporaryDirectory()
+os.environ["GALLERIES_ROOT_DIR"] = _root.name
+os.environ["apikey"] = "test-key"
+os.environ["REACT_BUILD_DIR"] = os.path.join(_root.name, "no-frontend")
+
+import numpy as np  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import main  # noqa: E402
+from app.routers import backup  # noqa: E402
+
+HEADERS = {"X-Api-Key": "test-key"}
+
+
+def _noise_jpeg(width: int, height: int) -> bytes:
+    """Incompressible, so the export spans several chunks."""
+    pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    out = io.BytesIO()
+    Image.fromarray(pixels).save(out, "JPEG", quality=95)
+    return out.getvalue()
+
+
+def _threads_in_chunk_queue() -> list:
+    stuck = []
+    for thread_id, frame in sys._current_frames().items():
+        while frame is not None:
+            code = frame.f_code
+            if code.co_name in ("get", "put") and code.co_filename.endswith(("backup.py", "queue.py")):
+                stuck.append(thread_id)
+                break
+            frame = frame.f_back
+    return stuck
+
+
+async def _export_then_disconnect():
+    """Streams a throttled export and disconnects after its first chunk."""
+    body_started = asyncio.Event()
+
+    async def receive():
+        await body_started.wait()
+        await asyncio.sleep(0.3)  # the next chunk is being waited for by then
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            body_started.set()
+
+    # The response itself, not through the middleware: its generator is
+    # waiting for the next chunk when the disconnect arrives
+    response = await backup.export(derivatives=True, rate_limit_mb=0.5, previous=None)
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "method": "POST", "path": "/api/v1/export"}
+    await asyncio.wait_for(response(scope, receive, send), timeout=30)
+
+
+class ExportDisconnectTest(unittest.TestCase):
+    def test_disconnect_mid_export_leaves_no_thread_behind(self):
+        with TestClient(main.app) as client:
+            gallery_id = client.post(
+                "/api/v1/createGallery", json={"name": "Export", "author": "test"}, headers=HEADERS
+            ).json()["id"]
+            for i in range(2):
+                response = client.post(
+                    f"/api/v1/uploadImageToGallery?gallery_id={gallery_id}",
+                    files={"image_file": (f"noise{i}.jpg", _noise_jpeg(2400, 1600), "image/jpeg")},
+                    headers=HEADERS,
+                )
+                self.assertEqual(response.status_code, 201)
+
+        # Not asyncio.run: it would wait for stuck executor threads forever
+        loop = asyncio.new_event_loop()
+        try:
+            for _ in range(3):
+                loop.run_until_complete(_export_then_disconnect())
+            # Getters poll once a second, the throttled producer notices on its next put
+            deadline = time.monotonic() + 10
+            while _threads_in_chunk_queue() and time.monotonic() < deadline:
+                time.sleep(0.2)
+            self.assertEqual(_threads_in_chunk_queue(), [])
+        finally:
+            loop.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
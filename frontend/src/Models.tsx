@@ -17,6 +17,8 @@ export interface ImageModel {
   sizes: ImageSizes;
   width?: number;
   height?: number;
+  placeholder?: string; // tiny base64 data URI
+  dominantColor?: string;
 }
 
 export interface Gallery {
@@ -34,6 +36,8 @@ export interface MoodboardImage {
   description?: string;
   width?: number;
   height?: number;
+  placeholder?: string; // tiny base64 data URI
+  dominantColor?: string;
 }
 
 export type MoodboardSectionType = 'text' | 'images';
@@ -52,6 +56,9 @@ export interface Moodboard {
   headerColor: string;
   lastUpdateDate?: string;
   coverImageUrl?: string;
+  coverPlaceholder?: string;
+  coverDominantColor?: string;
+  version?: number; // bumped on every save, sent back for conflict detection
   sections: MoodboardSection[];
 }
 
@@ -60,4 +67,9 @@ export interface MoodboardThumbnail {
   name: string;
   headerColor: string;
   coverImageUrl?: string;
+  coverPlaceholder?: string;
+  coverDominantColor?: string;
+  // Server-rendered collage of the moodboard, and its Open Graph card
+  previewUrl?: string;
+  cardUrl?: string;
 }
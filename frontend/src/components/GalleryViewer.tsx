@@ -87,7 +87,11 @@ export const GalleryViewer: React.FC<GalleryViewerProps> = ({
         {gallery.images.map((image) => (
           <motion.div
             key={image.id}
-            className="relative group w-48 h-48 rounded-lg overflow-hidden shadow-md bg-black/60"
+            className="relative group w-48 h-48 rounded-lg overflow-hidden shadow-md bg-black/60 bg-cover bg-center"
+            style={{
+              backgroundColor: image.dominantColor,
+              backgroundImage: image.placeholder ? `url(${image.placeholder})` : undefined,
+            }}
             whileHover={{ scale: 1.05 }}
           >
             {/* Checkbox */}
@@ -232,6 +232,8 @@ const EditMoodboardPage: React.FC = () => {
           url: string;
           width?: number;
           height?: number;
+          placeholder?: string;
+          dominantColor?: string;
         };
 
         setMoodboard((prev) => {
@@ -243,6 +245,8 @@ const EditMoodboardPage: React.FC = () => {
             url: uploaded.url,
             width: uploaded.width,
             height: uploaded.height,
+            placeholder: uploaded.placeholder,
+            dominantColor: uploaded.dominantColor,
             description: "",
           };
           sections[sectionIndex] = {
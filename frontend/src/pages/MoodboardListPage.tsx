@@ -98,11 +98,15 @@ const MoodboardListPage: React.FC = () => {
                                     className="relative block overflow-hidden rounded-lg shadow-xl cursor-pointer transform transition-transform duration-300 hover:scale-105 h-64"
                                     style={{ borderTop: `4px solid ${moodboard.headerColor}` }}
                                 >
-                                    {moodboard.coverImageUrl ? (
+                                    {moodboard.previewUrl ?? moodboard.coverImageUrl ? (
                                         <img
-                                            src={moodboard.coverImageUrl}
+                                            src={moodboard.previewUrl ?? moodboard.coverImageUrl}
                                             alt={`Cover for ${moodboard.name}`}
-                                            className="w-full h-64 object-cover object-center transition-transform duration-300 group-hover:scale-110"
+                                            className="w-full h-64 object-cover object-center bg-cover bg-center transition-transform duration-300 group-hover:scale-110"
+                                            style={{
+                                                backgroundColor: moodboard.coverDominantColor,
+                                                backgroundImage: moodboard.coverPlaceholder ? `url(${moodboard.coverPlaceholder})` : undefined,
+                                            }}
                                             onError={(e) => {
                                                 e.currentTarget.src = "https://placehold.co/600x600/1f2937/d1d5db?text=Image+Not+Found";
                                                 e.currentTarget.onerror = null;